@@ -0,0 +1,135 @@
+#! /usr/bin/env python3
+############################################################
+# Copyright(c) 2017, Sara Mirzaee                          #
+############################################################
+import argparse
+import time
+import numpy as np
+from minopy.lib import utils as iut
+
+
+def cmd_line_parse(iargs=None):
+    parser = argparse.ArgumentParser(description='Benchmark the phase linking kernels on simulated samples')
+    parser.add_argument('-k', '--kernel', dest='kernel', type=str, default='covariance',
+                        choices=['covariance', 'ks', 'eigen'], help='Kernel to benchmark (default: covariance)')
+    parser.add_argument('-n', '--n_image', dest='n_image', type=int, nargs='+', default=[30, 60, 150, 300],
+                        help='Number of images to test')
+    parser.add_argument('-s', '--num_shp', dest='num_shp', type=int, nargs='+', default=[20, 60, 171],
+                        help='Number of SHPs to test')
+    parser.add_argument('-p', '--num_pixel', dest='num_pixel', type=int, default=200,
+                        help='Number of pixels in each batch (default: 200)')
+    parser.add_argument('-r', '--repeat', dest='repeat', type=int, default=3,
+                        help='Number of repeats, the best time is reported (default: 3)')
+    inps = parser.parse_args(args=iargs)
+    return inps
+
+
+def simulate_samples(num_pixel, n_image, num_shp):
+    """ Random circular gaussian samples in the stacked format of process_patch_c """
+    samples = np.random.randn(num_pixel, n_image, num_shp) + 1j * np.random.randn(num_pixel, n_image, num_shp)
+    return np.ascontiguousarray(samples, dtype=np.complex64)
+
+
+def simulate_amplitudes(num_pixel, n_image):
+    """ Sorted Rayleigh amplitudes of the center pixel and its neighbours, half of them with a different scale """
+    scale = np.where(np.arange(num_pixel) % 2, 1.0, 1.5)[:, None]
+    ref = np.sort(np.random.rayleigh(1.0, n_image)).astype(np.float32)
+    test = np.sort(np.random.rayleigh(scale, (num_pixel, n_image)), axis=1).astype(np.float32)
+    return ref, test
+
+
+def simulate_neighbour_samples(num_pixel, n_image, num_shp, gamma=0.6):
+    """ Samples of a line of pixels with coherence gamma, each pixel takes the num_shp samples starting at its
+    position so that neighbours share most of their SHPs """
+    num_samples = num_pixel + num_shp
+    phase = np.exp(1j * np.cumsum(np.random.randn(n_image)))[:, None]
+    common = (np.random.randn(1, num_samples) + 1j * np.random.randn(1, num_samples)) / np.sqrt(2)
+    noise = (np.random.randn(n_image, num_samples) + 1j * np.random.randn(n_image, num_samples)) / np.sqrt(2)
+    data = phase * (np.sqrt(gamma) * common + np.sqrt(1 - gamma) * noise)
+    samples = np.lib.stride_tricks.sliding_window_view(data, num_shp, axis=1)[:, 0:num_pixel, :]
+    return np.ascontiguousarray(samples.transpose(1, 0, 2), dtype=np.complex64)
+
+
+def best_time(func, repeat):
+    out = np.inf
+    for i in range(repeat):
+        t0 = time.time()
+        func()
+        out = min(out, time.time() - t0)
+    return out
+
+
+def benchmark_covariance(inps):
+    """ Element wise loop kernel against the batched BLAS estimator of the coherence matrices """
+    print('{:>8} {:>8} {:>12} {:>12} {:>8} {:>10}'.format('n_image', 'num_shp', 'loop (s)', 'batch (s)',
+                                                        'speedup', 'max_diff'))
+    for n_image in inps.n_image:
+        for num_shp in inps.num_shp:
+            samples = simulate_samples(inps.num_pixel, n_image, num_shp)
+            num_shps = np.full(inps.num_pixel, num_shp, dtype=np.int32)
+
+            t_loop = best_time(lambda: [iut.est_corr_loop_py(samples[p]) for p in range(inps.num_pixel)], inps.repeat)
+            t_batch = best_time(lambda: iut.est_corr_batch_py(samples, num_shps), inps.repeat)
+
+            diff = np.abs(np.asarray(iut.est_corr_loop_py(samples[0])) - iut.est_corr_batch_py(samples, num_shps)[0])
+            print('{:>8} {:>8} {:>12.4f} {:>12.4f} {:>8.1f} {:>10.2e}'.format(n_image, num_shp, t_loop, t_batch,
+                                                                            t_loop / t_batch, diff.max()))
+    return
+
+
+def benchmark_ks(inps):
+    """ Quadratic search of the union against the merge based KS distance, with and without early exit """
+    print('{:>8} {:>12} {:>12} {:>12} {:>8} {:>8}'.format('n_image', 'loop (s)', 'merge (s)', 'early (s)',
+                                                        'speedup', 'max_diff'))
+    for n_image in inps.n_image:
+        ref, test = simulate_amplitudes(inps.num_pixel, n_image)
+        threshold = iut.ks_lut_cy(n_image, n_image, 0.01)
+
+        t_loop = best_time(lambda: [iut.ecdf_distance_loop_py(ref, x) for x in test], inps.repeat)
+        t_merge = best_time(lambda: [iut.ks_distance_py(ref, x) for x in test], inps.repeat)
+        t_early = best_time(lambda: [iut.ks_distance_py(ref, x, threshold) for x in test], inps.repeat)
+
+        diff = max([abs(iut.ecdf_distance_loop_py(ref, x) - iut.ks_distance_py(ref, x)) for x in test])
+        print('{:>8} {:>12.4f} {:>12.4f} {:>12.4f} {:>8.1f} {:>8.1e}'.format(n_image, t_loop, t_merge, t_early,
+                                                                          t_loop / t_early, diff))
+    return
+
+
+def benchmark_eigen(inps):
+    """ Batched LAPACK eigen solver against the power iteration started from the previous pixel """
+    print('{:>8} {:>8} {:>12} {:>12} {:>8} {:>10} {:>10} {:>10}'.format('n_image', 'num_shp', 'lapack (s)',
+                                                                     'iter (s)', 'speedup', 'iterations',
+                                                                     'fallbacks', 'max_diff'))
+    for n_image in inps.n_image:
+        for num_shp in inps.num_shp:
+            samples = simulate_neighbour_samples(inps.num_pixel, n_image, num_shp)
+            coh = iut.est_corr_batch_py(samples, np.full(inps.num_pixel, num_shp, dtype=np.int32))
+            which = np.full(inps.num_pixel, 2, dtype=np.int32)
+
+            t_lapack = best_time(lambda: iut.eigh_select_batch_py(coh, which), inps.repeat)
+            t_iter = best_time(lambda: iut.eigh_iterative_batch_py(coh, which), inps.repeat)
+
+            vec_lapack = iut.eigh_select_batch_py(coh, which)[1]
+            vec_iter, stats = iut.eigh_iterative_batch_py(coh, which)[1:3]
+            diff = np.abs(np.angle(vec_lapack * np.conj(vec_iter))).max()
+            print('{:>8} {:>8} {:>12.4f} {:>12.4f} {:>8.1f} {:>10.1f} {:>10} {:>10.2e}'.format(
+                n_image, num_shp, t_lapack, t_iter, t_lapack / t_iter, stats[1] / max(1, stats[0] - stats[2]),
+                stats[2], diff))
+    return
+
+
+def main(iargs=None):
+    inps = cmd_line_parse(iargs)
+
+    if inps.kernel == 'covariance':
+        benchmark_covariance(inps)
+    elif inps.kernel == 'ks':
+        benchmark_ks(inps)
+    elif inps.kernel == 'eigen':
+        benchmark_eigen(inps)
+
+    return
+
+
+if __name__ == '__main__':
+    main()
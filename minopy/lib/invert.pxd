@@ -14,7 +14,7 @@ cdef class CPhaseLink:
     cdef bytes slc_stack, RSLCfile
     cdef int range_window, azimuth_window, patch_size, n_image, width, length
     cdef int shp_size, mini_stack_default_size, num_box, total_num_mini_stacks
-    cdef float distance_thresh
+    cdef float distance_thresh, amp_cache_size, eig_tolerance
     cdef bint sequential
     cdef dict metadata
     cdef list all_date_list
@@ -22,10 +22,15 @@ cdef class CPhaseLink:
     cdef int[::1] sample_rows, sample_cols
     cdef int reference_row, reference_col
     cdef float complex[:, :, ::1] patch_slc_images
-    cdef int ps_shp
+    cdef int ps_shp, num_threads, max_compressed_slc
     cdef readonly list box_list
-    cdef readonly bytes out_dir
+    cdef readonly bytes out_dir, patch_out_dir
     cdef readonly int time_lag
-    cdef bytes mask_file
+    cdef bytes mask_file, eig_solver
+    cdef bytes compressed_file, inverted_date_file, shp_cache_file
+    cdef bint update, save_coherence, virtual_dataset
+    cdef bytes coherence_file
+    cdef readonly bytes stream_journal
+    cdef int num_compressed, first_new_image
 
 
@@ -7,11 +7,20 @@ cimport utils as iut
 import utils as iut
 import os
 from libc.stdio cimport printf
-from minopy.objects.slcStack import slcStack
+from minopy.objects.slcStack import slcStack, tune_patch_size
 import h5py
 import time
+import shutil
+from multiprocessing import shared_memory
+from mintpy.utils import readfile
 from isceobj.Util.ImageUtil import ImageLib as IML
 
+# axis of the rows of the patch outputs, to merge the outputs of sub patches
+PATCH_OUTPUT_ROW_AXIS = {'phase_ref.npy': 1, 'datum_shift.npy': 1, 'compressed_slc.npy': 1, 'tempCoh.npy': 1,
+                         'shp.npy': 0, 'mask_ps.npy': 0, 'amp_dispersion.npy': 0, 'shp_mask.npy': 0,
+                         'coherence.npy': 0, 'coherence_scale.npy': 0}
+# axis of the rows of the datasets of the patch file phase_series.h5 of the virtual concatenation
+PATCH_FILE_ROW_AXIS = {'phase': 1, 'amplitude': 1, 'temporalCoherence': 1, 'shp': 0, 'mask': 0}
 
 
 cdef void write_wrapped(list date_list, bytes out_dir, int width, int length, bytes RSLCfile, bytes date):
@@ -55,6 +64,112 @@ cdef void write_hdf5_block_2D_int(object fhandle, int[:, ::1] data, bytes datase
     return
 
 
+def write_stream(object output_queue, bytes RSLCfile, bytes mask_ps_file, bytes amp_dispersion_file, int n_image,
+                 int length, int width, bytes journal_file, int prefix, dict sub_patch_of):
+    """
+    Single writer of the streaming inversion, runs in its own process: writes the outputs of the patches sent
+    by the workers (see iut.write_patch_outputs) to phase_series.h5, maskPS.h5 and ampDispersion, created by
+    CPhaseLink.initiate_stream, until None is received. Each written patch is flushed and then appended to the
+    completion journal, a split patch once all its sub patches are written; sub_patch_of maps the sub patches
+    to their patch and prefix is the length of the patch output directory in the patch folders
+    """
+    cdef object fhandle, psf, journal, amp_dispersion_memmap
+    cdef bytes out_folder
+    cdef cnp.ndarray[int, ndim=1] box
+    cdef dict outputs, num_written = {}
+    cdef str key, parent
+    cdef list block
+    cdef double time0
+
+    with h5py.File(RSLCfile.decode('UTF-8'), 'a') as fhandle, \
+            h5py.File(mask_ps_file.decode('UTF-8'), 'a') as psf, \
+            open(journal_file.decode('UTF-8'), 'a') as journal:
+        amp_dispersion_memmap = np.memmap(amp_dispersion_file.decode('UTF-8'), mode='r+', dtype='float32',
+                                          shape=(length, width))
+        while True:
+            message = output_queue.get()
+            if message is None:
+                break
+            out_folder, box, outputs = message
+            time0 = time.time()
+
+            outputs['tempCoh'][outputs['tempCoh'] < 0] = 0
+            block = [0, n_image, box[1], box[3], box[0], box[2]]
+            write_hdf5_block_3D(fhandle, outputs['phase'], b'phase', block)
+            write_hdf5_block_3D(fhandle, outputs['amplitude'], b'amplitude', block)
+            block = [0, 2, box[1], box[3], box[0], box[2]]
+            write_hdf5_block_3D(fhandle, outputs['tempCoh'], b'temporalCoherence', block)
+            block = [box[1], box[3], box[0], box[2]]
+            write_hdf5_block_2D_int(fhandle, outputs['shp'], b'shp', block)
+            write_hdf5_block_2D_int(psf, outputs['mask_ps'], b'mask', block)
+            amp_dispersion_memmap[box[1]:box[3], box[0]:box[2]] = outputs['amp_dispersion']
+            fhandle.flush()
+            psf.flush()
+            amp_dispersion_memmap.flush()
+
+            key = out_folder[prefix:].decode('UTF-8')
+            journal.write(key + '\n')
+            if key in sub_patch_of:
+                parent, num_sub = sub_patch_of[key]
+                num_written[parent] = num_written.get(parent, 0) + 1
+                if num_written[parent] == num_sub:
+                    journal.write(parent + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+            print('    {} written to phase_series.h5 in {:.1f} s'.format(key, time.time() - time0))
+        amp_dispersion_memmap = None
+    return
+
+
+class CompressedSlcStack:
+    """ Stack of the compressed SLCs of the inverted mini stacks followed by the new images of slcStack.h5,
+    read like slcStack by process_patch_c when the inversion is updated with new images """
+
+    def __init__(self, slc_stack_obj, compressed_file, new_date_list):
+        self.slc_stack_obj = slc_stack_obj
+        self.compressed_file = compressed_file
+        self.new_date_list = new_date_list
+
+    def read(self, datasetName='slc', box=None, print_msg=True):
+        with h5py.File(self.compressed_file, 'r') as f:
+            compressed_slc = f['slc'][:, box[1]:box[3], box[0]:box[2]]
+        slc = self.slc_stack_obj.read(datasetName=self.new_date_list, box=box, print_msg=print_msg)
+        slc = slc.reshape(len(self.new_date_list), box[3] - box[1], box[2] - box[0])
+        return np.concatenate([compressed_slc, slc]).astype(np.complex64)
+
+
+class SharedStripStack:
+    """ Strip of the SLC stack read once and published in shared memory to the workers inverting the patches of
+    the strip, read like slcStack by process_patch_c for boxes inside the strip. Only the name of the shared
+    memory is pickled, the process that loaded the strip releases it """
+
+    def __init__(self, slc_stack_obj, strip_box):
+        data = slc_stack_obj.read(datasetName='slc', box=tuple(strip_box[0:4]), print_msg=False)
+        self.strip_box = strip_box
+        self.shape = (data.shape[0], strip_box[3] - strip_box[1], strip_box[2] - strip_box[0])
+        self.nbytes = 8 * self.shape[0] * self.shape[1] * self.shape[2]
+        self.shm = shared_memory.SharedMemory(create=True, size=self.nbytes)
+        self.name = self.shm.name
+        np.ndarray(self.shape, dtype=np.complex64, buffer=self.shm.buf)[:] = data.reshape(self.shape)
+
+    def __getstate__(self):
+        return {'strip_box': self.strip_box, 'shape': self.shape, 'nbytes': self.nbytes, 'name': self.name,
+                'shm': None}
+
+    def read(self, datasetName='slc', box=None, print_msg=True):
+        shm = shared_memory.SharedMemory(name=self.name)
+        strip = np.ndarray(self.shape, dtype=np.complex64, buffer=shm.buf)
+        data = strip[:, box[1] - self.strip_box[1]:box[3] - self.strip_box[1],
+                     box[0] - self.strip_box[0]:box[2] - self.strip_box[0]].copy()
+        del strip
+        shm.close()
+        return data
+
+    def release(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
 cdef class CPhaseLink:
 
     def __init__(self, object inps):
@@ -69,6 +184,11 @@ cdef class CPhaseLink:
         self.azimuth_window = np.int32(inps.azimuth_window)
         self.patch_size = np.int32(inps.patch_size)
         self.ps_shp = np.int32(inps.ps_shp)
+        self.eig_solver = inps.eig_solver.encode('UTF-8')
+        self.num_threads = max(1, np.int32(inps.num_threads))
+        self.amp_cache_size = np.float32(inps.amp_cache_size)
+        self.eig_tolerance = np.float32(inps.eig_tolerance)
+        self.max_compressed_slc = max(0, np.int32(inps.max_compressed_slc))
         self.out_dir = self.work_dir + b'/inverted'
         os.makedirs(self.out_dir.decode('UTF-8'), exist_ok='True')
 
@@ -80,6 +200,15 @@ cdef class CPhaseLink:
         self.n_image, self.length, self.width = self.slcStackObj.get_size()
         self.time_lag = inps.time_lag
 
+        if inps.tune_patch_size:
+            with h5py.File(inps.slc_stack, 'r') as f:
+                chunks = f['slc'].chunks
+            self.patch_size = tune_patch_size(self.patch_size, chunks, self.n_image, self.length, self.width,
+                                              self.range_window, self.azimuth_window, int(inps.num_worker),
+                                              inps.memory_budget)
+            print('Patch size {} for the chunks {} of slc, {} workers and a memory budget of {} GB'.format(
+                self.patch_size, chunks, inps.num_worker, inps.memory_budget))
+
 
         # total number of neighbouring pixels
         self.shp_size = self.range_window * self.azimuth_window
@@ -111,6 +240,77 @@ cdef class CPhaseLink:
             self.sequential = True
         else:
             self.sequential = False
+
+        self.patch_out_dir = self.out_dir
+        self.compressed_file = self.out_dir + b'/compressed_slc.h5'
+        self.inverted_date_file = self.out_dir + b'/inverted_date_list.txt'
+        self.num_compressed = 0
+        self.first_new_image = 0
+        self.update = inps.update
+        if inps.shp_cache:
+            self.shp_cache_file = self.out_dir + b'/shp_cache.h5'
+        else:
+            self.shp_cache_file = b'None'
+        self.coherence_file = self.out_dir + b'/coherence_matrix.h5'
+        self.stream_journal = self.out_dir + b'/stream_journal.txt'
+        self.save_coherence = inps.save_coherence
+        if self.update and self.save_coherence:
+            print('The coherence matrices of an update inversion are not saved, they include the compressed SLCs')
+            self.save_coherence = False
+        self.virtual_dataset = inps.virtual_dataset
+        if self.update and self.virtual_dataset:
+            print('phase_series.h5 of an update inversion is extended in place, it is not a virtual dataset')
+            self.virtual_dataset = False
+        if self.update:
+            self.prepare_update()
+        return
+
+    def prepare_update(self):
+        """
+        Sets the inversion of the images added to slcStack.h5 since the last sequential inversion:
+        the stack of each patch is the compressed SLCs of the inverted mini stacks followed by the new images,
+        the patches are written to out_dir/update
+        """
+        from minopy.objects.utils import update_or_skip_inversion
+        cdef int n_stack
+
+        if not os.path.exists(self.compressed_file.decode('UTF-8')):
+            raise FileNotFoundError('{} does not exist, invert the stack with a sequential method before '
+                                    'updating it'.format(self.compressed_file.decode('UTF-8')))
+
+        if not os.path.exists(self.inverted_date_file.decode('UTF-8')):
+            with h5py.File(self.RSLCfile.decode('UTF-8'), 'r') as f:
+                inverted_dates = [date.decode('UTF-8') for date in f['date'][:]]
+            with open(self.inverted_date_file.decode('UTF-8'), 'w') as f:
+                f.write('\n'.join(inverted_dates) + '\n')
+
+        with open(self.inverted_date_file.decode('UTF-8'), 'r') as f:
+            inverted_dates = f.read().split()
+
+        self.patch_out_dir = self.out_dir + b'/update'
+        updated_index, _ = update_or_skip_inversion(self.inverted_date_file.decode('UTF-8'), self.all_date_list)
+        if updated_index is None:
+            self.first_new_image = self.n_image
+            self.box_list, self.num_box = [], 0
+            return
+
+        if self.all_date_list[:updated_index] != inverted_dates:
+            raise ValueError('The inverted dates in {} are not the first dates of {}'.format(
+                self.inverted_date_file.decode('UTF-8'), self.slc_stack.decode('UTF-8')))
+
+        self.first_new_image = updated_index
+        with h5py.File(self.compressed_file.decode('UTF-8'), 'r') as f:
+            self.num_compressed = f['slc'].shape[0]
+        self.total_num_mini_stacks = max(1, (self.n_image - self.first_new_image) // self.mini_stack_default_size)
+        self.slcStackObj = CompressedSlcStack(self.slcStackObj, self.compressed_file.decode('UTF-8'),
+                                              self.all_date_list[self.first_new_image:])
+
+        n_stack = self.num_compressed + self.n_image - self.first_new_image
+        if self.shp_test == b'ks':
+            self.distance_thresh = iut.ks_lut_cy(n_stack, n_stack, 0.01)
+        print('Update inversion: {} compressed SLCs of {} inverted images and {} new images in {} mini stacks'.format(
+            self.num_compressed, self.first_new_image, self.n_image - self.first_new_image,
+            self.total_num_mini_stacks))
         return
 
     def patch_slice(self):
@@ -171,15 +371,7 @@ cdef class CPhaseLink:
             if 'phase' in RSLC.keys():
                 RSLC['phase'].resize(self.n_image, 0)
             else:
-                self.metadata['FILE_TYPE'] = 'timeseries' #'phase'
-                self.metadata['DATA_TYPE'] = 'float32'
-                self.metadata['data_type'] = 'FLOAT'
-                self.metadata['description'] = 'Inverted wrapped phase time series'
-                self.metadata['file_name'] = self.RSLCfile.decode('UTF-8')
-                self.metadata['family'] = 'wrappedphase'
-
-                for key, value in self.metadata.items():
-                    RSLC.attrs[key] = value
+                self.write_phase_series_attrs(RSLC)
 
                 RSLC.create_dataset('phase',
                                     shape=(self.n_image, self.length, self.width),
@@ -222,15 +414,7 @@ cdef class CPhaseLink:
 
         with h5py.File(mask_ps_file.decode('UTF-8'), 'a') as psf:
             if not 'mask' in psf.keys():
-                self.metadata['FILE_TYPE'] = 'mask' #'phase'
-                self.metadata['DATA_TYPE'] = 'int32'
-                self.metadata['data_type'] = 'BYTE'
-                self.metadata['description'] = 'PS mask'
-                self.metadata['file_name'] = mask_ps_file.decode('UTF-8')
-                self.metadata['family'] = 'PS mask'
-
-                for key, value in self.metadata.items():
-                    psf.attrs[key] = value
+                self.write_mask_ps_attrs(psf)
 
                 psf.create_dataset('mask',
                                     shape=(self.length, self.width),
@@ -241,6 +425,121 @@ cdef class CPhaseLink:
 
         return
 
+    def write_phase_series_attrs(self, object RSLC):
+        self.metadata['FILE_TYPE'] = 'timeseries' #'phase'
+        self.metadata['DATA_TYPE'] = 'float32'
+        self.metadata['data_type'] = 'FLOAT'
+        self.metadata['description'] = 'Inverted wrapped phase time series'
+        self.metadata['file_name'] = self.RSLCfile.decode('UTF-8')
+        self.metadata['family'] = 'wrappedphase'
+
+        for key, value in self.metadata.items():
+            RSLC.attrs[key] = value
+        return
+
+    def write_mask_ps_attrs(self, object psf):
+        self.metadata['FILE_TYPE'] = 'mask' #'phase'
+        self.metadata['DATA_TYPE'] = 'int32'
+        self.metadata['data_type'] = 'BYTE'
+        self.metadata['description'] = 'PS mask'
+        self.metadata['file_name'] = (self.work_dir + b'/maskPS.h5').decode('UTF-8')
+        self.metadata['family'] = 'PS mask'
+
+        for key, value in self.metadata.items():
+            psf.attrs[key] = value
+        return
+
+    def unpatch_virtual(self):
+        """
+        Concatenates the patches without copying them: phase_series.h5 and maskPS.h5 are virtual datasets mapping
+        the patch files PATCHES/PATCH_<index>/phase_series.h5 into the full frame, so the PATCHES folder must be
+        kept with them. Patches inverted without their patch file get it from their saved outputs
+        """
+        cdef object fhandle, psf, layout
+        cdef int index
+        cdef cnp.ndarray[int, ndim=1] box
+        cdef str name, patch_file
+        cdef bytes mask_ps_file = self.work_dir + b'/maskPS.h5'
+        cdef list patch_files = []
+        cdef dict shapes = {'phase': (self.n_image, self.length, self.width),
+                            'amplitude': (self.n_image, self.length, self.width),
+                            'temporalCoherence': (2, self.length, self.width),
+                            'shp': (self.length, self.width),
+                            'mask': (self.length, self.width)}
+
+        for out_file in [self.RSLCfile, mask_ps_file]:
+            if os.path.exists(out_file.decode('UTF-8')):
+                print('Deleting old {} ...'.format(os.path.basename(out_file.decode('UTF-8'))))
+                os.remove(out_file.decode('UTF-8'))
+
+        for index, box in enumerate(self.box_list):
+            patch_file = self.out_dir.decode('UTF-8') + '/PATCHES/PATCH_{:04.0f}/phase_series.h5'.format(index)
+            if not os.path.exists(patch_file):
+                patch_dir = os.path.dirname(patch_file)
+                iut.write_patch_file(patch_file, np.load(patch_dir + '/phase_ref.npy', allow_pickle=True),
+                                     np.load(patch_dir + '/shp.npy', allow_pickle=True),
+                                     np.load(patch_dir + '/tempCoh.npy', allow_pickle=True),
+                                     np.load(patch_dir + '/mask_ps.npy', allow_pickle=True))
+            patch_files.append(patch_file)
+
+        print('Write phase_series.h5 and maskPS.h5 as virtual datasets of the {} patch files'.format(self.num_box))
+        with h5py.File(self.RSLCfile.decode('UTF-8'), 'w') as fhandle, \
+                h5py.File(mask_ps_file.decode('UTF-8'), 'w') as psf:
+            self.write_phase_series_attrs(fhandle)
+            self.write_mask_ps_attrs(psf)
+
+            for name, shape in shapes.items():
+                layout = h5py.VirtualLayout(shape=shape, dtype=np.int32 if name in ['shp', 'mask'] else np.float32)
+                for index, box in enumerate(self.box_list):
+                    # source paths relative to the virtual file, the folder can be moved as a whole
+                    layout[(slice(None),) * (len(shape) - 2) + (slice(box[1], box[3]), slice(box[0], box[2]))] = \
+                        h5py.VirtualSource(os.path.relpath(patch_files[index], os.path.dirname(
+                            (mask_ps_file if name == 'mask' else self.RSLCfile).decode('UTF-8'))), name,
+                            shape=shape[:len(shape) - 2] + (box[3] - box[1], box[2] - box[0]))
+                (psf if name == 'mask' else fhandle).create_virtual_dataset(name, layout, fillvalue=0)
+
+            fhandle.create_dataset('date', data=np.array(self.all_date_list, dtype=np.string_))
+            fhandle.create_dataset('bperp', data=np.array(self.prep_baselines, dtype=np.float32))
+
+            self.write_shp_file(fhandle)
+            self.write_temporal_coherence(fhandle)
+
+        print('write amplitude dispersion file from the PS pre-screen')
+        amp_dispersion_memmap = self.open_amp_dispersion()
+        for index, box in enumerate(self.box_list):
+            patch_dir = os.path.dirname(patch_files[index])
+            if os.path.exists(patch_dir + '/amp_dispersion.npy'):
+                amp_dispersion_memmap[box[1]:box[3], box[0]:box[2]] = np.load(patch_dir + '/amp_dispersion.npy',
+                                                                              allow_pickle=True)
+        amp_dispersion_memmap = None
+
+        if os.path.exists(os.path.dirname(patch_files[0]) + '/compressed_slc.npy'):
+            self.write_compressed_slc()
+
+        self.write_shp_cache()
+        self.write_coherence_matrix()
+        return
+
+    def materialize_virtual_output(self):
+        """ Copies the virtual datasets of phase_series.h5 from the patch files into the file, to be extended """
+        cdef object fhandle, data
+        cdef str name
+        cdef cnp.ndarray[int, ndim=1] box
+
+        with h5py.File(self.RSLCfile.decode('UTF-8'), 'a') as fhandle:
+            for name in ['phase', 'amplitude', 'shp', 'temporalCoherence']:
+                if not fhandle[name].is_virtual:
+                    continue
+                print('Copy the virtual dataset {} of phase_series.h5 from the patch files'.format(name))
+                data = fhandle.create_dataset(name + '_copy', shape=fhandle[name].shape,
+                                              maxshape=(None,) + fhandle[name].shape[1:] if name in ['phase', 'amplitude']
+                                              else fhandle[name].shape, chunks=True, dtype=fhandle[name].dtype)
+                for box in self.box_list:
+                    data[..., box[1]:box[3], box[0]:box[2]] = fhandle[name][..., box[1]:box[3], box[0]:box[2]]
+                del fhandle[name]
+                fhandle.move(name + '_copy', name)
+        return
+
     def get_datakwargs(self):
 
         cdef dict data_kwargs = {
@@ -248,7 +547,7 @@ cdef class CPhaseLink:
             "azimuth_window" : self.azimuth_window,
             "width" : self.width,
             "length" : self.length,
-            "n_image" : self.n_image,
+            "n_image" : self.num_compressed + self.n_image - self.first_new_image,
             "slcStackObj" : self.slcStackObj,
             "distance_threshold" : self.distance_thresh,
             "def_sample_rows" : np.array(self.sample_rows),
@@ -260,9 +559,18 @@ cdef class CPhaseLink:
             "default_mini_stack_size" : self.mini_stack_default_size,
             'ps_shp': self.ps_shp,
             "shp_test": self.shp_test,
-            "out_dir": self.out_dir,
+            "out_dir": self.patch_out_dir,
             "time_lag": self.time_lag,
             "mask_file": self.mask_file,
+            "eig_solver": self.eig_solver,
+            "num_threads": self.num_threads,
+            "amp_cache_size": self.amp_cache_size,
+            "eig_tolerance": self.eig_tolerance,
+            "max_compressed_slc": self.max_compressed_slc,
+            "num_compressed": self.num_compressed,
+            "shp_cache_file": self.shp_cache_file,
+            "save_coherence": self.save_coherence,
+            "patch_file": self.virtual_dataset,
         }
         return data_kwargs
 
@@ -283,6 +591,201 @@ cdef class CPhaseLink:
         print('time used: {:02.0f} mins {:02.1f} secs.\n'.format(m, s))
         return
 
+    def halo_box(self, cnp.ndarray[int, ndim=1] box):
+        """ Box of the SLCs read to invert a patch, with the half window halo """
+        return iut.get_big_box_cy(box, self.range_window, self.azimuth_window, self.width, self.length)
+
+    def strip_boxes(self, list box_list, double max_bytes=0):
+        """
+        Groups the patches into the strips of rows of the patch grid, each strip is read once for all its patches.
+        With max_bytes, a row is split into strips of neighbouring patches whose SLCs fit in max_bytes
+        Returns a list of (strip box, indices of its patches), the strip box is the union of the halo boxes
+        """
+        cdef dict strips = {}
+        cdef list boxes, piece, pieces, strip_list = []
+        cdef cnp.ndarray[int, ndim=1] box, halo
+        cdef cnp.ndarray[int, ndim=2] halo_boxes
+
+        for box in box_list:
+            strips.setdefault((box[1], box[3]), []).append(box)
+        for boxes in strips.values():
+            boxes.sort(key=lambda patch_box: patch_box[0])
+            piece = []
+            pieces = [piece]
+            for box in boxes:
+                halo = self.halo_box(box)
+                if len(piece) > 0 and max_bytes > 0 and 8. * self.n_image * (halo[3] - halo[1]) * (
+                        halo[2] - self.halo_box(piece[0])[0]) > max_bytes:
+                    piece = []
+                    pieces.append(piece)
+                piece.append(box)
+            for piece in pieces:
+                halo_boxes = np.array([self.halo_box(patch_box) for patch_box in piece], dtype=np.int32)
+                strip_list.append((np.array([halo_boxes[:, 0].min(), halo_boxes[:, 1].min(), halo_boxes[:, 2].max(),
+                                             halo_boxes[:, 3].max()], dtype=np.int32),
+                                   [patch_box[4] for patch_box in piece]))
+        return strip_list
+
+    def load_strip(self, cnp.ndarray[int, ndim=1] strip_box):
+        """ Reads a strip of the stack to shared memory, see strip_boxes """
+        return SharedStripStack(self.slcStackObj, strip_box)
+
+    def estimate_patch_cost(self, list box_list):
+        """
+        Relative cost of inverting each patch, n_image^2 * num_shp + n_image^3 for each pixel in the mask:
+        the coherence estimation and the phase linking. The SHP counts of the previous inversion are taken from
+        phase_series.h5 if it exists and the patch is inverted in it, otherwise each pixel is assumed to have half
+        the window as SHPs. The streaming output resets phase_series.h5, the costs are estimated before it
+        Returns the costs of the patches
+        """
+        cdef int index, n = self.num_compressed + self.n_image - self.first_new_image
+        cdef cnp.ndarray[int, ndim=1] box
+        cdef cnp.ndarray[double, ndim=1] costs = np.zeros(len(box_list), dtype=np.float64)
+        cdef object fhandle = None
+        cdef cnp.ndarray valid, num_shp
+
+        if os.path.exists(self.RSLCfile.decode('UTF-8')):
+            fhandle = h5py.File(self.RSLCfile.decode('UTF-8'), 'r')
+            if 'shp' not in fhandle:
+                fhandle.close()
+                fhandle = None
+
+        for index, box in enumerate(box_list):
+            if os.path.exists(self.mask_file.decode('UTF-8')):
+                valid = readfile.read(self.mask_file.decode('UTF-8'), box=(box[0], box[1], box[2], box[3]))[0] != 0
+            else:
+                valid = np.ones((box[3] - box[1], box[2] - box[0]), dtype=np.bool_)
+            if fhandle is not None:
+                num_shp = fhandle['shp'][box[1]:box[3], box[0]:box[2]][valid].astype(np.float64)
+            if fhandle is None or not np.any(num_shp > 1):
+                # a patch not inverted yet keeps the SHP count of 1 that initiate_output fills the file with
+                num_shp = np.full(np.count_nonzero(valid), self.shp_size / 2., dtype=np.float64)
+            costs[index] = np.sum(n ** 2 * np.maximum(num_shp, 1) + float(n) ** 3)
+
+        if fhandle is not None:
+            fhandle.close()
+        return costs
+
+    def split_patch(self, cnp.ndarray[int, ndim=1] box, int num_sub):
+        """
+        Splits a patch into strips of rows inverted as sub patches in out_dir/PATCHES/PATCH_<index>/PATCHES,
+        the pixels are inverted independently so the merged sub patches are the same as the patch
+        Returns the sub patch boxes, box[4] is the index of the sub patch
+        """
+        cdef cnp.ndarray[int, ndim=1] rows = np.unique(np.linspace(box[1], box[3], num_sub + 1).astype(np.int32))
+        return [np.array([box[0], rows[i], box[2], rows[i + 1], i], dtype=np.int32) for i in range(rows.shape[0] - 1)]
+
+    def merge_sub_patches(self, cnp.ndarray[int, ndim=1] box, list sub_boxes):
+        """
+        Merges the outputs of the sub patches of a patch along the rows, writes its completion flag and removes
+        the sub patches. Outputs missing in a sub patch without pixels in the mask are zeros
+        """
+        cdef str name, patch_dir = self.patch_out_dir.decode('UTF-8') + '/PATCHES/PATCH_{:04.0f}'.format(box[4])
+        cdef list sub_dirs = [patch_dir + '/PATCHES/PATCH_{:04.0f}'.format(sub_box[4]) for sub_box in sub_boxes]
+        cdef int axis, row
+        cdef object merged, part
+        cdef list shape
+
+        for name, axis in PATCH_OUTPUT_ROW_AXIS.items():
+            parts = [np.load(sub_dir + '/' + name, mmap_mode='r') if os.path.exists(sub_dir + '/' + name) else None
+                     for sub_dir in sub_dirs]
+            part = next((part for part in parts if part is not None), None)
+            if part is None:
+                continue
+            shape = list(part.shape)
+            shape[axis] = box[3] - box[1]
+            merged = np.lib.format.open_memmap(patch_dir + '/' + name, mode='w+', dtype=part.dtype, shape=tuple(shape))
+            row = 0
+            for sub_box, part in zip(sub_boxes, parts):
+                if part is not None:
+                    merged[(slice(None),) * axis + (slice(row, row + sub_box[3] - sub_box[1]),)] = part
+                row += sub_box[3] - sub_box[1]
+            merged.flush()
+            del merged
+
+        if os.path.exists(sub_dirs[0] + '/phase_series.h5'):
+            with h5py.File(patch_dir + '/phase_series.h5', 'w') as merged:
+                for name, axis in PATCH_FILE_ROW_AXIS.items():
+                    row = 0
+                    for sub_box, sub_dir in zip(sub_boxes, sub_dirs):
+                        with h5py.File(sub_dir + '/phase_series.h5', 'r') as part:
+                            if not name in merged:
+                                shape = list(part[name].shape)
+                                shape[axis] = box[3] - box[1]
+                                merged.create_dataset(name, shape=tuple(shape), chunks=True, dtype=part[name].dtype)
+                            merged[name][(slice(None),) * axis + (slice(row, row + sub_box[3] - sub_box[1]),)] = \
+                                part[name][:]
+                        row += sub_box[3] - sub_box[1]
+
+        np.save(patch_dir + '/flag.npy', [1])
+        shutil.rmtree(patch_dir + '/PATCHES')
+        return
+
+    def write_shp_file(self, object fhandle):
+        """ Writes the number of SHPs of phase_series.h5 to the ISCE file shp """
+        print('write shp file')
+        shp_file = self.work_dir + b'/shp'
+
+        if not os.path.exists(shp_file.decode('UTF-8')):
+            shp_memmap = np.memmap(shp_file.decode('UTF-8'), mode='write', dtype='int16',
+                                       shape=(self.length, self.width))
+            IML.renderISCEXML(shp_file.decode('UTF-8'), bands=1, nyy=self.length, nxx=self.width,
+                              datatype='int16', scheme='BIL')
+        else:
+            shp_memmap = np.memmap(shp_file.decode('UTF-8'), mode='r+', dtype='int16',
+                                       shape=(self.length, self.width))
+
+        shp_memmap[:, :] = fhandle['shp'][:, :]
+        shp_memmap = None
+        return
+
+    def open_amp_dispersion(self):
+        """ Memory map of the ISCE file ampDispersion of the amplitude dispersion of the PS pre-screen """
+        amp_dispersion_file = self.out_dir + b'/ampDispersion'
+
+        if not os.path.exists(amp_dispersion_file.decode('UTF-8')):
+            amp_dispersion_memmap = np.memmap(amp_dispersion_file.decode('UTF-8'), mode='write', dtype='float32',
+                                              shape=(self.length, self.width))
+            IML.renderISCEXML(amp_dispersion_file.decode('UTF-8'), bands=1, nyy=self.length, nxx=self.width,
+                              datatype='float32', scheme='BIL')
+        else:
+            amp_dispersion_memmap = np.memmap(amp_dispersion_file.decode('UTF-8'), mode='r+', dtype='float32',
+                                              shape=(self.length, self.width))
+        return amp_dispersion_memmap
+
+    def write_temporal_coherence(self, object fhandle):
+        """ Writes the temporal coherence of phase_series.h5 to the ISCE files tempCoh_average and tempCoh_full """
+        print('write averaged temporal coherence file from mini stacks')
+        temp_coh_file = self.out_dir + b'/tempCoh_average'
+
+        if not os.path.exists(temp_coh_file.decode('UTF-8')):
+            temp_coh_memmap = np.memmap(temp_coh_file.decode('UTF-8'), mode='write', dtype='float32',
+                                       shape=(self.length, self.width))
+            IML.renderISCEXML(temp_coh_file.decode('UTF-8'), bands=1, nyy=self.length, nxx=self.width,
+                              datatype='float32', scheme='BIL')
+        else:
+            temp_coh_memmap = np.memmap(temp_coh_file.decode('UTF-8'), mode='r+', dtype='float32',
+                                       shape=(self.length, self.width))
+
+        temp_coh_memmap[:, :] = fhandle['temporalCoherence'][0, :, :]
+        temp_coh_memmap = None
+
+        print('write temporal coherence file from full stack')
+        temp_coh_file = self.out_dir + b'/tempCoh_full'
+
+        if not os.path.exists(temp_coh_file.decode('UTF-8')):
+            temp_coh_memmap = np.memmap(temp_coh_file.decode('UTF-8'), mode='write', dtype='float32',
+                                       shape=(self.length, self.width))
+            IML.renderISCEXML(temp_coh_file.decode('UTF-8'), bands=1, nyy=self.length, nxx=self.width,
+                              datatype='float32', scheme='BIL')
+        else:
+            temp_coh_memmap = np.memmap(temp_coh_file.decode('UTF-8'), mode='r+', dtype='float32',
+                                       shape=(self.length, self.width))
+
+        temp_coh_memmap[:, :] = fhandle['temporalCoherence'][1, :, :]
+        temp_coh_memmap = None
+        return
+
     def unpatch(self):
         cdef list block
         cdef object fhandle, psf
@@ -292,6 +795,14 @@ cdef class CPhaseLink:
         cdef float complex[:, :, ::1] rslc_ref
         cdef cnp.ndarray[float, ndim=3] temp_coh
 
+        if self.update:
+            self.unpatch_update()
+            return
+
+        if self.virtual_dataset:
+            self.unpatch_virtual()
+            return
+
         if os.path.exists(self.RSLCfile.decode('UTF-8')):
             print('Deleting old phase_series.h5 ...')
             os.remove(self.RSLCfile.decode('UTF-8'))
@@ -308,7 +819,12 @@ cdef class CPhaseLink:
             
             for index, box in enumerate(self.box_list):
                 patch_dir = self.out_dir + ('/PATCHES/PATCH_{:04.0f}'.format(index)).encode('UTF-8')
-                rslc_ref = np.load(patch_dir.decode('UTF-8') + '/phase_ref.npy', allow_pickle=True)
+                if os.path.exists(patch_dir.decode('UTF-8') + '/phase_ref.npy'):
+                    rslc_ref = np.load(patch_dir.decode('UTF-8') + '/phase_ref.npy', allow_pickle=True)
+                else:
+                    # patch inverted for the virtual concatenation
+                    with h5py.File(patch_dir.decode('UTF-8') + '/phase_series.h5', 'r') as pf:
+                        rslc_ref = (pf['amplitude'][:] * np.exp(1j * pf['phase'][:])).astype(np.complex64)
                 temp_coh = np.load(patch_dir.decode('UTF-8') + '/tempCoh.npy', allow_pickle=True)
                 shp = np.load(patch_dir.decode('UTF-8') + '/shp.npy', allow_pickle=True)
                 mask_ps = np.load(patch_dir.decode('UTF-8') + '/mask_ps.npy', allow_pickle=True)
@@ -332,52 +848,20 @@ cdef class CPhaseLink:
                 block = [0, 2, box[1], box[3], box[0], box[2]]
                 write_hdf5_block_3D(fhandle, temp_coh, b'temporalCoherence', block)
 
-            
-            print('write shp file')
-            shp_file = self.work_dir + b'/shp'
-
-            if not os.path.exists(shp_file.decode('UTF-8')):
-                shp_memmap = np.memmap(shp_file.decode('UTF-8'), mode='write', dtype='int16',
-                                           shape=(self.length, self.width))
-                IML.renderISCEXML(shp_file.decode('UTF-8'), bands=1, nyy=self.length, nxx=self.width,
-                                  datatype='int16', scheme='BIL')
-            else:
-                shp_memmap = np.memmap(shp_file.decode('UTF-8'), mode='r+', dtype='int16',
-                                           shape=(self.length, self.width))
-
-            shp_memmap[:, :] = fhandle['shp'][:, :]
-            shp_memmap = None
-
-
-            print('write averaged temporal coherence file from mini stacks')
-            temp_coh_file = self.out_dir + b'/tempCoh_average'
 
-            if not os.path.exists(temp_coh_file.decode('UTF-8')):
-                temp_coh_memmap = np.memmap(temp_coh_file.decode('UTF-8'), mode='write', dtype='float32',
-                                           shape=(self.length, self.width))
-                IML.renderISCEXML(temp_coh_file.decode('UTF-8'), bands=1, nyy=self.length, nxx=self.width,
-                                  datatype='float32', scheme='BIL')
-            else:
-                temp_coh_memmap = np.memmap(temp_coh_file.decode('UTF-8'), mode='r+', dtype='float32',
-                                           shape=(self.length, self.width))
-
-            temp_coh_memmap[:, :] = fhandle['temporalCoherence'][0, :, :]
-            temp_coh_memmap = None
+            self.write_shp_file(fhandle)
 
-            print('write temporal coherence file from full stack')
-            temp_coh_file = self.out_dir + b'/tempCoh_full'
+            self.write_temporal_coherence(fhandle)
 
-            if not os.path.exists(temp_coh_file.decode('UTF-8')):
-                temp_coh_memmap = np.memmap(temp_coh_file.decode('UTF-8'), mode='write', dtype='float32',
-                                           shape=(self.length, self.width))
-                IML.renderISCEXML(temp_coh_file.decode('UTF-8'), bands=1, nyy=self.length, nxx=self.width,
-                                  datatype='float32', scheme='BIL')
-            else:
-                temp_coh_memmap = np.memmap(temp_coh_file.decode('UTF-8'), mode='r+', dtype='float32',
-                                           shape=(self.length, self.width))
+            print('write amplitude dispersion file from the PS pre-screen')
+            amp_dispersion_memmap = self.open_amp_dispersion()
 
-            temp_coh_memmap[:, :] = fhandle['temporalCoherence'][1, :, :]
-            temp_coh_memmap = None
+            for index, box in enumerate(self.box_list):
+                patch_dir = self.out_dir + ('/PATCHES/PATCH_{:04.0f}'.format(index)).encode('UTF-8')
+                if os.path.exists(patch_dir.decode('UTF-8') + '/amp_dispersion.npy'):
+                    amp_dispersion_memmap[box[1]:box[3], box[0]:box[2]] = np.load(
+                        patch_dir.decode('UTF-8') + '/amp_dispersion.npy', allow_pickle=True)
+            amp_dispersion_memmap = None
 
             print('close HDF5 file phase_series.h5.')
 
@@ -390,6 +874,258 @@ cdef class CPhaseLink:
                block = [box[1], box[3], box[0], box[2]]
                write_hdf5_block_2D_int(psf, mask_ps, b'mask', block)
 
+        patch_dir = self.out_dir + b'/PATCHES/PATCH_0000'
+        if os.path.exists(patch_dir.decode('UTF-8') + '/compressed_slc.npy'):
+            self.write_compressed_slc()
+
+        self.write_shp_cache()
+        self.write_coherence_matrix()
+
+        return
+
+    def stream_journal_entries(self):
+        """ Patches and sub patches written by the streaming inversion, from the completion journal """
+        if not os.path.exists(self.stream_journal.decode('UTF-8')):
+            return set()
+        with open(self.stream_journal.decode('UTF-8'), 'r') as f:
+            return set([line.strip() for line in f if line.strip()])
+
+    def stream_complete(self):
+        """ True if the streaming inversion has written all the patches to phase_series.h5 """
+        cdef set written = self.stream_journal_entries()
+        return len(written) > 0 and all(['PATCHES/PATCH_{:04.0f}'.format(box[4]) in written for box in self.box_list])
+
+    def initiate_stream(self):
+        """
+        Prepares phase_series.h5 and maskPS.h5 for the streaming inversion. Without a completion journal, the old
+        outputs are deleted and an empty journal is started, otherwise the inversion resumes writing to them
+        """
+        if self.update:
+            raise ValueError('The update of a sequential inversion is written from the patches, '
+                             'the streaming output is not supported')
+
+        if not os.path.exists(self.stream_journal.decode('UTF-8')):
+            for out_file in [self.RSLCfile, self.work_dir + b'/maskPS.h5']:
+                if os.path.exists(out_file.decode('UTF-8')):
+                    print('Deleting old {} ...'.format(os.path.basename(out_file.decode('UTF-8'))))
+                    os.remove(out_file.decode('UTF-8'))
+            open(self.stream_journal.decode('UTF-8'), 'w').close()
+        self.initiate_output()
+        self.open_amp_dispersion()
+        return
+
+    def stream_writer_args(self, dict sub_patch_of):
+        """ Arguments of write_stream after the output queue, plain values so that the writer also starts in a
+        spawned process """
+        return (self.RSLCfile, self.work_dir + b'/maskPS.h5', self.out_dir + b'/ampDispersion', self.n_image,
+                self.length, self.width, self.stream_journal, len(self.patch_out_dir) + 1, sub_patch_of)
+
+    def finish_stream(self):
+        """
+        Writes the files derived from phase_series.h5 after all the patches are streamed to it and the products
+        that are still saved in the patches: compressed SLCs, SHP cache and coherence matrices
+        """
+        cdef object fhandle
+        with h5py.File(self.RSLCfile.decode('UTF-8'), 'r') as fhandle:
+            self.write_shp_file(fhandle)
+            self.write_temporal_coherence(fhandle)
+
+        patch_dir = self.out_dir + b'/PATCHES/PATCH_0000'
+        if os.path.exists(patch_dir.decode('UTF-8') + '/compressed_slc.npy'):
+            self.write_compressed_slc()
+
+        self.write_shp_cache()
+        self.write_coherence_matrix()
+        return
+
+    def write_shp_cache(self):
+        """
+        Writes the packed SHP masks of the patches to shp_cache.h5, one dataset per SHP test, threshold, window
+        and number of images, so that later inversions of the same stack skip the SHP tests
+        """
+        cdef object sf
+        cdef int index, n_stack = self.num_compressed + self.n_image - self.first_new_image
+        cdef cnp.ndarray[int, ndim=1] box
+        cdef bytes patch_dir
+        cdef str shp_key = iut.shp_cache_key(self.shp_test, self.distance_thresh, self.azimuth_window,
+                                             self.range_window, n_stack)
+
+        if self.shp_cache_file == b'None':
+            return
+
+        with h5py.File(self.shp_cache_file.decode('UTF-8'), 'a') as sf:
+            for index, box in enumerate(self.box_list):
+                patch_dir = self.patch_out_dir + ('/PATCHES/PATCH_{:04.0f}'.format(index)).encode('UTF-8')
+                if not os.path.exists(patch_dir.decode('UTF-8') + '/shp_mask.npy'):
+                    continue
+                shp_mask = np.load(patch_dir.decode('UTF-8') + '/shp_mask.npy', allow_pickle=True)
+                if shp_key not in sf:
+                    print('write SHPs to {} as {}'.format(self.shp_cache_file.decode('UTF-8'), shp_key))
+                    sf.create_dataset(shp_key,
+                                      shape=(self.length, self.width, shp_mask.shape[2]),
+                                      chunks=True,
+                                      dtype=np.uint8)
+                    sf[shp_key].attrs['shp_test'] = self.shp_test.decode('UTF-8')
+                    sf[shp_key].attrs['distance_threshold'] = self.distance_thresh
+                    sf[shp_key].attrs['azimuth_window'] = self.azimuth_window
+                    sf[shp_key].attrs['range_window'] = self.range_window
+                    sf[shp_key].attrs['n_image'] = n_stack
+                sf[shp_key][box[1]:box[3], box[0]:box[2], :] = shp_mask
+        return
+
+    def write_compressed_slc(self):
+        """
+        Writes the compressed SLCs of the mini stacks of a sequential inversion to compressed_slc.h5 and the
+        inverted dates to inverted_date_list.txt, the state to update the inversion when new images are acquired
+        """
+        cdef object cf
+        cdef int index, num_mini_stacks
+        cdef cnp.ndarray[int, ndim=1] box
+        cdef bytes patch_dir
+
+        if os.path.exists(self.compressed_file.decode('UTF-8')):
+            os.remove(self.compressed_file.decode('UTF-8'))
+
+        print('write compressed SLCs of the mini stacks to compressed_slc.h5')
+        with h5py.File(self.compressed_file.decode('UTF-8'), 'a') as cf:
+            for index, box in enumerate(self.box_list):
+                patch_dir = self.out_dir + ('/PATCHES/PATCH_{:04.0f}'.format(index)).encode('UTF-8')
+                compressed_slc = np.load(patch_dir.decode('UTF-8') + '/compressed_slc.npy', allow_pickle=True)
+                if index == 0:
+                    num_mini_stacks = compressed_slc.shape[0]
+                    for key, value in self.metadata.items():
+                        cf.attrs[key] = value
+                    cf.attrs['FILE_TYPE'] = 'slc'
+                    cf.attrs['DATA_TYPE'] = 'complex64'
+                    cf.attrs['description'] = 'Compressed SLCs of the mini stacks of the sequential inversion'
+                    cf.attrs['file_name'] = self.compressed_file.decode('UTF-8')
+                    cf.create_dataset('slc',
+                                      shape=(num_mini_stacks, self.length, self.width),
+                                      maxshape=(None, self.length, self.width),
+                                      chunks=True,
+                                      dtype=np.complex64)
+                    # index of the first image of each mini stack
+                    cf.create_dataset('first_image',
+                                      data=np.arange(num_mini_stacks, dtype=np.int32) * self.mini_stack_default_size,
+                                      maxshape=(None,))
+                cf['slc'][:, box[1]:box[3], box[0]:box[2]] = compressed_slc
+
+        with open(self.inverted_date_file.decode('UTF-8'), 'w') as f:
+            f.write('\n'.join(self.all_date_list) + '\n')
+        return
+
+    def write_coherence_matrix(self):
+        """
+        Writes the coherence matrices saved by the patches to coherence_matrix.h5: 'coherence' has the upper
+        triangle of the matrix of each pixel without its diagonal, row by row, and 'scale' the root mean power
+        of its images, read them with minopy.objects.invert_pixel.read_coherence_matrix
+        """
+        cdef object cf
+        cdef int index, r, num_pack = self.n_image * (self.n_image - 1) // 2
+        cdef int chunk_size = max(1, int(np.sqrt(1024 ** 2 / (8. * num_pack))))    # chunks of about 1 MB
+        cdef cnp.ndarray[int, ndim=1] box
+        cdef list patch_dirs = [self.out_dir.decode('UTF-8') + '/PATCHES/PATCH_{:04.0f}'.format(index)
+                                for index in range(len(self.box_list))]
+
+        if not any([os.path.exists(patch_dir + '/coherence.npy') for patch_dir in patch_dirs]):
+            return
+
+        print('write coherence matrices of the pixels to {}'.format(self.coherence_file.decode('UTF-8')))
+        with h5py.File(self.coherence_file.decode('UTF-8'), 'w') as cf:
+            cf.attrs['n_image'] = self.n_image
+            cf.attrs['description'] = 'Packed upper triangle of the coherence matrices without the diagonal'
+            cf.create_dataset('coherence',
+                              shape=(self.length, self.width, num_pack),
+                              chunks=(min(chunk_size, self.length), min(chunk_size, self.width), num_pack),
+                              dtype=np.complex64)
+            cf.create_dataset('scale',
+                              shape=(self.length, self.width, self.n_image),
+                              chunks=True,
+                              dtype=np.float32)
+            cf.create_dataset('date', data=np.array(self.all_date_list, dtype=np.string_))
+
+            for index, box in enumerate(self.box_list):
+                if not os.path.exists(patch_dirs[index] + '/coherence.npy'):
+                    continue
+                coh_packed = np.load(patch_dirs[index] + '/coherence.npy', mmap_mode='r')
+                for r in range(0, coh_packed.shape[0], chunk_size):
+                    cf['coherence'][box[1] + r:min(box[1] + r + chunk_size, box[3]), box[0]:box[2], :] = \
+                        coh_packed[r:r + chunk_size]
+                cf['scale'][box[1]:box[3], box[0]:box[2], :] = np.load(patch_dirs[index] + '/coherence_scale.npy')
+        return
+
+    def unpatch_update(self):
+        """
+        Extends phase_series.h5 in place with the phases of the new images, shifts the phases of the inverted
+        mini stacks by their new datum and adds the compressed SLCs of the new mini stacks to compressed_slc.h5
+        """
+        cdef object fhandle, cf
+        cdef int index, k, num_old, num_new, n_old = self.first_new_image
+        cdef cnp.ndarray[int, ndim=1] box
+        cdef bytes patch_dir
+        cdef cnp.ndarray[int, ndim=1] first_image, last_image
+
+        if n_old == self.n_image:
+            print('No new images to add to {}'.format(self.RSLCfile.decode('UTF-8')))
+            return
+
+        self.materialize_virtual_output()
+        print('Extend phase_series.h5 with {} new images'.format(self.n_image - n_old))
+        with h5py.File(self.RSLCfile.decode('UTF-8'), 'a') as fhandle, \
+                h5py.File(self.compressed_file.decode('UTF-8'), 'a') as cf:
+            first_image = cf['first_image'][:].astype(np.int32)
+            last_image = np.append(first_image[1:], n_old).astype(np.int32)
+            num_old = first_image.shape[0]
+            num_new = self.total_num_mini_stacks
+
+            fhandle['phase'].resize(self.n_image, 0)
+            fhandle['amplitude'].resize(self.n_image, 0)
+            cf['slc'].resize(num_old + num_new, 0)
+            cf['first_image'].resize((num_old + num_new,))
+            cf['first_image'][num_old:] = n_old + np.arange(num_new, dtype=np.int32) * self.mini_stack_default_size
+
+            for index, box in enumerate(self.box_list):
+                patch_dir = self.patch_out_dir + ('/PATCHES/PATCH_{:04.0f}'.format(index)).encode('UTF-8')
+                rslc_ref = np.load(patch_dir.decode('UTF-8') + '/phase_ref.npy', allow_pickle=True)
+                datum_shift = np.load(patch_dir.decode('UTF-8') + '/datum_shift.npy', allow_pickle=True)
+                temp_coh = np.load(patch_dir.decode('UTF-8') + '/tempCoh.npy', allow_pickle=True)
+                temp_coh[temp_coh < 0] = 0
+
+                print('-' * 50)
+                print("Update block {}/{} : {}".format(index, self.num_box, box[0:4]))
+
+                block = [n_old, self.n_image, box[1], box[3], box[0], box[2]]
+                write_hdf5_block_3D(fhandle, np.angle(rslc_ref), b'phase', block)
+                write_hdf5_block_3D(fhandle, np.abs(rslc_ref), b'amplitude', block)
+
+                # new datum of the inverted mini stacks
+                phase = fhandle['phase'][0:n_old, box[1]:box[3], box[0]:box[2]]
+                for k in range(num_old):
+                    phase[first_image[k]:last_image[k]] += datum_shift[k]
+                fhandle['phase'][0:n_old, box[1]:box[3], box[0]:box[2]] = np.angle(np.exp(1j * phase))
+
+                # average temporal coherence of all mini stacks, full stack one of the compressed and new images
+                block = [0, 2, box[1], box[3], box[0], box[2]]
+                temp_coh_old = fhandle['temporalCoherence'][0, box[1]:box[3], box[0]:box[2]]
+                temp_coh[0] = (temp_coh_old * num_old + temp_coh[0] * num_new) / (num_old + num_new)
+                write_hdf5_block_3D(fhandle, temp_coh, b'temporalCoherence', block)
+
+                cf['slc'][num_old:, box[1]:box[3], box[0]:box[2]] = np.load(
+                    patch_dir.decode('UTF-8') + '/compressed_slc.npy', allow_pickle=True)
+
+            del fhandle['date']
+            fhandle.create_dataset('date', data=np.array(self.all_date_list, dtype=np.string_))
+            del fhandle['bperp']
+            fhandle.create_dataset('bperp', data=np.array(self.prep_baselines, dtype=np.float32))
+
+            self.write_temporal_coherence(fhandle)
+
+        with open(self.inverted_date_file.decode('UTF-8'), 'w') as f:
+            f.write('\n'.join(self.all_date_list) + '\n')
+
+        self.write_shp_cache()
+        shutil.rmtree(self.patch_out_dir.decode('UTF-8'))
+        print('close HDF5 file phase_series.h5.')
         return
 
 
@@ -5,14 +5,22 @@ from Cython.Build import cythonize
 from setuptools import Extension, setup
 #from Cython.Build import cythonize
 import numpy
+import sys
 
 #ext_modules=[
 #    Extension("utils",    ["utils.pyx"], include_dirs=[numpy.get_include()], extra_compile_args=['-fopenmp'], extra_link_args=['-fopenmp']),
 #    Extension("invert",   ["invert.pyx"], include_dirs=[numpy.get_include()]),
 #]
 
+# OpenMP for the parallel pixel loops of process_patch_c, the default clang of macOS does not support it
+if sys.platform == 'darwin':
+    openmp_args = []
+else:
+    openmp_args = ['-fopenmp']
+
 ext_modules=[
-    Extension("utils",    ["utils.pyx"], include_dirs=[numpy.get_include()]),
+    Extension("utils",    ["utils.pyx"], include_dirs=[numpy.get_include()], extra_compile_args=openmp_args,
+              extra_link_args=openmp_args),
     Extension("invert",   ["invert.pyx"], include_dirs=[numpy.get_include()]),
 ]
 
@@ -1,12 +1,13 @@
 cimport numpy as cnp
 cimport cython
+from posix.time cimport timespec
 
 ctypedef float float
 
-cdef bint isnanc(float complex)
+cdef bint isnanc(float complex) noexcept nogil
 cdef cnp.ndarray[int, ndim=1] get_big_box_cy(cnp.ndarray[int, ndim=1], int, int, int, int)
-cdef float cargf_r(float complex)
-cdef double cargd_r(float complex)
+cdef float cargf_r(float complex) noexcept nogil
+cdef double cargd_r(float complex) noexcept nogil
 cdef float[::1] absmat1(float complex[::1])
 cdef float[:, ::1] absmat2(float complex[:, ::1])
 cdef float[::1] angmat(float complex[::1])
@@ -19,44 +20,140 @@ cdef float complex[:,::1] multiply_elementwise_dc(float[:, :], float complex[:,
 cdef float complex multiplymat11(float complex[::1], float complex[::1])
 cdef float complex[:,::1] multiplymat22(float complex[:, :], float complex[:, ::1])
 cdef float complex[::1] multiplymat12(float complex[::1], float complex[:, ::1])
-cdef float complex[::1] EVD_phase_estimation_cy(float complex[:, ::1])
-cdef float complex[::1] EMI_phase_estimation_cy(float complex[:, ::1], float[:, ::1])
-cdef float[::1] optimize_lbfgs(double[::1], float complex[:, ::1])
-cpdef double optphase_cy(double[::1], float complex[:, ::1])
-cdef float complex[::1] PTA_L_BFGS_cy(float complex[:, ::1], float[:, ::1])
+cdef void eigh_workspace_size_cy(int, int*, int*, int*) noexcept nogil
+cdef int eigh_single_cy(float complex[:, ::1], int, float complex[::1], float*, float complex[::1], float[::1],
+                        int[::1]) noexcept nogil
+cdef int eigh_select_batch_cy(float complex[:, :, ::1], int[::1], float[::1], float complex[:, ::1], int[::1], int)
+cdef int eigh_iterative_cy(float complex[:, ::1], int, float complex[::1], float complex[::1], float complex[:, ::1], float,
+                           int, float*) noexcept nogil
+cdef int eigh_iterative_batch_cy(float complex[:, :, ::1], int[::1], float[::1], float complex[:, ::1], float, int[::1], int)
+cpdef tuple eigh_iterative_batch_py(float complex[:, :, ::1], int[::1], float tolerance=*, int num_threads=*)
+cpdef tuple eigh_select_batch_py(float complex[:, :, ::1], int[::1], int num_threads=*)
+cdef int pta_coordinate_descent_cy(float complex[:, ::1], float complex[::1], float, int) noexcept nogil
 cdef float[:,::1] outer_product(float[::1], float[::1])
 cdef float complex[:,::1] divide_elementwise(float complex[:, ::1], float[:, ::1])
 cdef float complex[:, ::1] cov2corr_cy(float complex[:,::1])
 cdef float complex[:,::1] transposemat2(float complex[:, :])
+cdef void est_cov_blas_cy(float complex*, int, int, int, float complex[:, ::1]) noexcept nogil
+cdef void est_cov_band_blas_cy(float complex*, int, int, int, int, float complex[:, ::1]) noexcept nogil
+cdef void cov2corr_band_inplace_cy(float complex[:, ::1], int) noexcept nogil
+cdef void cov2corr_inplace_cy(float complex[:, ::1]) noexcept nogil
+cdef void pack_coherence_cy(float complex[:, ::1], float complex[::1]) noexcept nogil
+cdef void est_corr_batch_cy(float complex[:, :, ::1], int[::1], float complex[:, :, ::1], int, int,
+                            int) noexcept nogil
+cpdef cnp.ndarray est_corr_batch_py(float complex[:, :, ::1], int[::1], int num_threads=*)
 cdef float complex[:,::1] est_corr_cy(float complex[:,::1])
 cdef float complex[:,::1] est_cov_cy(float complex[:,::1])
 cpdef float complex[:,::1] est_cov_py(float complex[:,::1])
 cpdef float complex[:,::1] est_corr_py(float complex[:,::1])
+cpdef float complex[:,::1] est_corr_loop_py(float complex[:,::1])
 cdef float sum1d(float[::1])
-cdef tuple test_PS_cy(float complex[:, ::1], float[::1])
+cdef tuple test_PS_cy(float complex[:, ::1], float)
+cdef tuple test_PS_eig_cy(float complex[:, ::1], float, float, float complex[::1])
 cdef float norm_complex(float complex[::1])
 cdef float complex[::1] squeeze_images(float complex[::1], float complex[:, ::1], cnp.intp_t)
-cdef tuple phase_linking_process_cy(float complex[:, ::1], int, bytes, bint, int)
+cdef int emi_matrix_cy(float complex[:, ::1], float complex[:, ::1], float[:, :, ::1], float[::1], int[::1]) noexcept nogil
+cdef float complex normalize_cov_cy(float complex, float complex, float complex) noexcept nogil
+cdef void sample_moments_cy(float complex[:, ::1], int, float[::1], float[::1]) noexcept nogil
+
+cdef int banded_inverse_cy(float[:, ::1], int, float[:, ::1]) noexcept nogil
+cdef int pta_banded_descent_cy(float complex[:, ::1], int, float complex[::1], float, int) noexcept nogil
+cdef float gam_pta_banded_cy(float complex[:, ::1], int, float complex[::1]) noexcept nogil
+cdef int stbas_phase_estimation_cy(float complex[:, ::1], int, float complex[::1], float complex[:, :, ::1],
+                                   float[:, :, ::1], float complex[::1], float[::1], int[::1], int[::1]) noexcept nogil
+
+cdef class PhaseLinkWorkspace:
+    cdef float complex[:, :, :, ::1] cmats
+    cdef float[:, :, :, ::1] fmats
+    cdef float complex[:, :, ::1] cvecs
+    cdef float[:, ::1] scale
+    cdef float complex[:, ::1] cwork
+    cdef float[:, ::1] rwork
+    cdef int[:, ::1] iwork
+    cdef int[:, ::1] stats
+    cdef double[:, ::1] stack_time
+    cdef float complex[:, :, ::1] csamples
+
+# a phase linking kernel estimates the phase vector from a coherence matrix:
+# (coherence, time lag, phase vector, work space, thread), returns 0 on success
+ctypedef int (*phase_link_kernel_t)(float complex[:, ::1], int, float complex[::1], PhaseLinkWorkspace,
+                                    int) noexcept nogil
+
+# what a phase linking estimator needs, see register_phase_linking_estimator
+cpdef enum EstimatorNeeds:
+    ESTIMATOR_EMI_MATRIX = 1    # |coh|^-1 o coh with the regularized inverse of |coh|
+    ESTIMATOR_EIGEN_PAIR = 2    # the estimate is one eigen pair (of the EMI matrix if needed), can be batched
+    ESTIMATOR_BANDED = 4        # only the pairs less than the time lag apart
+    ESTIMATOR_SEQUENTIAL = 8    # can be used on mini stacks with squeezed images
+
+ctypedef struct estimator_t:
+    phase_link_kernel_t kernel
+    int needs
+    bint sequential
+
+cdef int evd_kernel_cy(float complex[:, ::1], int, float complex[::1], PhaseLinkWorkspace, int) noexcept nogil
+cdef int emi_kernel_cy(float complex[:, ::1], int, float complex[::1], PhaseLinkWorkspace, int) noexcept nogil
+cdef int pta_kernel_cy(float complex[:, ::1], int, float complex[::1], PhaseLinkWorkspace, int) noexcept nogil
+cdef int stbas_kernel_cy(float complex[:, ::1], int, float complex[::1], PhaseLinkWorkspace, int) noexcept nogil
+cdef object estimator_capsule(phase_link_kernel_t)
+cdef estimator_t get_estimator_cy(bytes) except *
+cdef double elapsed_cy(timespec*) noexcept nogil
+cdef int mini_stack_end_cy(int, int, int, int, int) noexcept nogil
+cdef int phase_linking_pixel_cy(float complex[:, ::1], float[::1], estimator_t, int, int, int, int, int,
+                                float complex[:, ::1], int, float complex[::1], float*, PhaseLinkWorkspace,
+                                int) noexcept nogil
+cdef tuple phase_linking_process_cy(float complex[:, ::1], int, bytes, bint, int, int[::1] inversion_stats=*,
+                                    float complex[:, ::1] coh=*)
 cpdef tuple phase_linking_process_py(float complex[:, ::1], int, bytes, bint, int)
-cpdef tuple sequential_phase_linking_py(float complex[:,::1], bytes, int, int)
-cdef tuple sequential_phase_linking_cy(float complex[:,::1], bytes, int, int)
+cpdef tuple phase_linking_coh_py(float complex[:, ::1], float[::1], bytes, int lag=*, int mini_stack_size=*,
+                                 int max_compressed=*)
+cpdef tuple sequential_phase_linking_py(float complex[:,::1], bytes, int, int, int max_compressed=*)
+cdef tuple sequential_phase_linking_cy(float complex[:,::1], bytes, int, int, int[::1] inversion_stats=*,
+                                       int max_compressed=*)
 cdef float complex[::1] datum_connect_cy(float complex[:, ::1], float complex[::1], int)
 cpdef float complex[::1] datum_connect_py(float complex[:, ::1], float complex[::1], int)
 cdef float searchsorted_max(cnp.ndarray[float, ndim=1], cnp.ndarray[float, ndim=1], cnp.ndarray[float, ndim=1])
 cdef void sorting(cnp.ndarray[float, ndim=1])
-cdef float ecdf_distance(cnp.ndarray[float, ndim=1], cnp.ndarray[float, ndim=1])
-cdef float ks_lut_cy(int, int, float)
+cpdef float ecdf_distance_loop_py(cnp.ndarray[float, ndim=1], cnp.ndarray[float, ndim=1])
+cpdef float ks_lut_cy(int, int, float)
 cdef cnp.ndarray[float, ndim=1] concat_cy(cnp.ndarray[float, ndim=1], cnp.ndarray[float, ndim=1])
-cdef int count(cnp.ndarray[long, ndim=2], long)
+cdef int compare_float(const void*, const void*) noexcept nogil
+cdef float ks_distance_cy(float*, float*, int, int, float) noexcept nogil
+cpdef float ks_distance_py(cnp.ndarray[float, ndim=1], cnp.ndarray[float, ndim=1], float distance_threshold=*)
+cdef void ks_window_test_cy(float complex[:, :, ::1], int, int, int[::1], int[::1], float, int[:, ::1], float[::1]) noexcept nogil
+cdef float* sorted_amplitude_cy(float[:, :, ::1], float complex[:, :, ::1], bint, int, int, float*) noexcept nogil
+cdef void ks_pair_test_cy(float[:, :, ::1], float complex[:, :, ::1], bint, unsigned char[:, ::1], int, int[::1],
+                          int[::1], int, int, float, unsigned char[:, :, ::1], float[::1]) noexcept nogil
+cdef void pair_test_cy(cnp.ndarray[float, ndim=3], float complex[:, :, ::1], bint, unsigned char[:, ::1], int, int[::1],
+                       int[::1], int, int, float, bytes, unsigned char[:, :, ::1])
+cdef void window_from_pairs_cy(unsigned char[:, :, ::1], int, int, int[::1], int[::1], int, int,
+                               int[:, ::1]) noexcept nogil
+cdef void window_test_cy(float complex[:, :, ::1], int, int, int[::1], int[::1], float, bytes, int[:, ::1])
+cdef int shp_flood_fill_cy(int[:, ::1], int, int, int[::1], int[::1], int, int, int[:, ::1]) noexcept nogil
+cdef void shp_to_mask_cy(int[:, ::1], unsigned char[::1]) noexcept nogil
+cdef int shp_from_mask_cy(unsigned char[::1], int, int, int[::1], int[::1], int[:, ::1]) noexcept nogil
+cpdef str shp_cache_key(bytes, float, int, int, int)
+cdef int[:, ::1] shp_from_test_cy(int[:, ::1], int, int, int[::1], int[::1], int, int)
 cdef int[:, ::1] get_shp_row_col_c((int, int), float complex[:, :, ::1], cnp.ndarray[int, ndim=1], cnp.ndarray[int, ndim=1],
                                    int, int, int, int, float, bytes)
 cdef float[::1] mean_along_axis_x(float[:, ::1])
 cdef float gam_pta_c(float[:, ::1], float complex[::1])
+cdef float complex unit_phasor_cy(float complex) noexcept nogil
+cdef float gam_pta_coh_cy(float complex[:, ::1], float complex[::1]) noexcept nogil
+cdef float gam_pta_band_cy(float complex[:, ::1], int, float complex[::1]) noexcept nogil
+cdef void gam_pta_batch_cy(float complex[:, :, ::1], float complex[:, ::1], float[::1], int) noexcept nogil
+cpdef cnp.ndarray gam_pta_batch_py(float complex[:, :, ::1], float complex[:, ::1], int num_threads=*)
 cdef int ks2smapletest_cy(cnp.ndarray[float, ndim=1], cnp.ndarray[float, ndim=1], float)
 cdef int ttest_indtest_cy(cnp.ndarray[float, ndim=1], cnp.ndarray[float, ndim=1], float)
 cdef int ADtest_cy(cnp.ndarray[float, ndim=1], cnp.ndarray[float, ndim=1], float)
 cpdef float[:, :] inverse_float_matrix(float[:, ::1])
+cpdef cnp.ndarray amplitude_dispersion_py(cnp.ndarray)
+cpdef cnp.ndarray compress_slc_py(cnp.ndarray, cnp.ndarray, int, int)
+cpdef void write_patch_file(str, cnp.ndarray, cnp.ndarray, cnp.ndarray, cnp.ndarray)
+cdef void write_patch_outputs(bytes, cnp.ndarray, cnp.ndarray, cnp.ndarray, cnp.ndarray, cnp.ndarray, object, int,
+                              object, object, object, bint)
 cdef float complex[:, ::1] normalize_samples(float complex[:, ::1])
-cdef int is_semi_pos_def_chol_cy(float[:, ::1])
-cdef tuple regularize_matrix_cy(float[:, ::1])
+cdef int regularization_shift_cy(float[::1], float*) noexcept nogil
+cdef int regularize_inverse_cy(float[:, ::1], float[:, ::1], float[:, ::1], float[::1], float[::1], int[::1]) noexcept nogil
+cpdef tuple regularize_inverse_py(float[:, ::1])
 cdef float complex[:, ::1] mask_diag(float complex[:, ::1], int)
\ No newline at end of file
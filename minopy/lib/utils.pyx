@@ -3,19 +3,60 @@
 cimport cython
 import os
 import numpy as np
+import h5py
 cimport numpy as cnp
 from scipy import linalg as LA
 from scipy.linalg import lapack as lap
-from libc.math cimport sqrt, exp, isnan
-from scipy.optimize import minimize
-from skimage.measure._ccomp import label_cython as clabel
+from libc.math cimport sqrt, exp, isnan, fabs
+from libc.float cimport FLT_EPSILON
+from libc.stdlib cimport qsort
+from posix.time cimport clock_gettime, timespec, CLOCK_MONOTONIC
+from cython.parallel cimport prange, parallel, threadid
+from scipy.linalg.cython_blas cimport cgemm, cherk
+from cpython.pycapsule cimport PyCapsule_New, PyCapsule_GetPointer
+from scipy.linalg.cython_lapack cimport cheevr, chbevx, cpotrf, cpotrs, spbtrf, spotrf, spotri, ssbev, ssyevd
 from scipy.stats import anderson_ksamp, ttest_ind
 from mintpy.utils import ptime
 from mintpy.utils import readfile
 import time
 
+# lag masks of mask_diag for each (number of images, lag)
+cdef dict LAG_MASKS = {}
 
-cdef extern from "complex.h":
+# memory (bytes) of the stacked samples and coherence matrices of one block of pixels in process_patch_c
+cdef double BATCH_MEMORY_SIZE = 64e6
+
+# counters of the inversions of a patch
+cdef enum:
+    STAT_PTA_INVERSIONS = 0
+    STAT_PTA_SWEEPS = 1
+    STAT_PTA_NOT_CONVERGED = 2
+    STAT_REGULARIZED = 3
+    STAT_SEQUENTIAL_PIXELS = 4
+    NUM_STATS = 5
+
+# stopping criteria of the PTA coordinate descent: largest change of the unit phasors in a sweep, number of sweeps
+cdef float PTA_TOLERANCE = 1e-4
+cdef int PTA_MAX_ITERATIONS = 200
+
+# eigen pair selection of the batched eigen solver
+cdef enum:
+    EIG_SKIP = 0
+    EIG_SMALLEST = 1
+    EIG_LARGEST = 2
+
+# maximum number of power or inverse iterations before falling back to the full eigen solver
+cdef int EIG_MAX_ITERATIONS = 50
+
+# amplitude dispersion (std / mean) below which a pixel with few SHPs is a PS candidate
+cdef float PS_AMP_DISPERSION = 0.39
+
+# phase linking estimators by name: (capsule of the phase_link_kernel_t, EstimatorNeeds flags)
+cdef dict PHASE_LINKING_ESTIMATORS = {}
+cdef char* KERNEL_CAPSULE_NAME = b'minopy.phase_link_kernel_t'
+
+
+cdef extern from "complex.h" nogil:
     float complex cexpf(float complex z)
     float complex conjf(float complex z)
     float crealf(float complex z)
@@ -29,29 +70,30 @@ cdef extern from "complex.h":
     float fmaxf(float x, float y)
     float fminf(float x, float y)
 
-cdef inline bint isnanc(float complex x):
+cdef inline bint isnanc(float complex x) noexcept nogil:
     cdef bint res = isnan(crealf(x)) or isnan(cimagf(x))
     return res
 
-cdef inline float cargf_r(float complex z):
+cdef inline float cargf_r(float complex z) noexcept nogil:
     cdef float res
     res = cargf(z)
     if isnan(res):
         res = 0
     return res
 
-cdef inline double cargd_r(float complex z):
+cdef inline double cargd_r(float complex z) noexcept nogil:
     cdef double res = cargf(z)
     if isnan(res):
         res = 0
     return res
 
 cdef cnp.ndarray[int, ndim=1] get_big_box_cy(cnp.ndarray[int, ndim=1] box, int range_window, int azimuth_window, int width, int length):
+    """ Box of the SLCs read for a patch: the patch and the half window halo of the centred windows of its pixels """
     cdef cnp.ndarray[int, ndim=1] big_box = np.arange(4, dtype=np.int32)
-    big_box[0] = box[0] - range_window
-    big_box[1] = box[1] - azimuth_window
-    big_box[2] = box[2] + range_window
-    big_box[3] = box[3] + azimuth_window
+    big_box[0] = box[0] - (range_window - 1) // 2
+    big_box[1] = box[1] - (azimuth_window - 1) // 2
+    big_box[2] = box[2] + (range_window - 1) // 2
+    big_box[3] = box[3] + (azimuth_window - 1) // 2
 
     if big_box[0] <= 0:
         big_box[0] = 0
@@ -193,86 +235,240 @@ cdef inline float complex[::1] multiplymat12(float complex[::1] x, float complex
 
 
 cdef inline float complex[:, ::1] mask_diag(float complex[:, ::1] coh, int lag):
+    """ Sets the coherence of the pairs at least lag images apart to zero, the masks are cached per (n, lag) """
     cdef int n = coh.shape[0]
-    cdef int[:, ::1] N = np.ones((n, n), dtype=np.int32)
-    cdef int[:, ::1] mask = np.triu(N, lag) + np.tril(N, -lag)
-    cdef float complex[:, ::1] masked_coh = np.zeros((n, n), dtype=np.complex64)
-    cdef cnp.intp_t i, t
-    for i in range(n):
-        for t in range(n):
-            if mask[i,t] == 0:
-                masked_coh[i, t] = coh[i, t]
-    return masked_coh
+    cdef cnp.ndarray mask
+
+    if (n, lag) not in LAG_MASKS:
+        mask = np.abs(np.subtract.outer(np.arange(n), np.arange(n))) < lag
+        LAG_MASKS[(n, lag)] = mask.astype(np.complex64)
+    return np.asarray(coh) * LAG_MASKS[(n, lag)]
+
+
+cdef void eigh_workspace_size_cy(int n, int* lwork, int* lrwork, int* liwork) noexcept nogil:
+    """ Work space sizes of LAPACK cheevr for a single eigen pair of n x n matrices, see eigh_single_cy """
+    cdef char jobz = b'V'
+    cdef char rng = b'I'
+    cdef char uplo = b'L'
+    cdef int il = 1, m, stat, query = -1
+    cdef float vl = 0, vu = 0, abstol = 0, w, rwork_query
+    cdef float complex a, z, work_query
+    cdef int isuppz[2]
+    cdef int iwork_query
+
+    cheevr(&jobz, &rng, &uplo, &n, &a, &n, &vl, &vu, &il, &il, &abstol, &m, &w, &z, &n, &isuppz[0],
+           &work_query, &query, &rwork_query, &query, &iwork_query, &query, &stat)
+    lwork[0] = max(<int>crealf(work_query), 2 * n)
+    lrwork[0] = max(<int>rwork_query, 24 * n)
+    liwork[0] = max(iwork_query, 10 * n)
+    return
 
 
-cdef inline float complex[::1] EVD_phase_estimation_cy(float complex[:, ::1] coh):
-    """ Estimates the phase values based on eigen value decomosition """
-    cdef float[::1] eigen_value
-    cdef float complex[:, :] eigen_vector
+cdef int eigh_single_cy(float complex[:, ::1] mat, int which, float complex[::1] vec, float* eig_value,
+                        float complex[::1] cwork, float[::1] rwork, int[::1] iwork) noexcept nogil:
+    """ Solves a Hermitian eigen problem for a single eigen pair (LAPACK cheevr).
+    :param mat: n x n Hermitian matrix, its rows may be strided (a corner of a larger matrix), it is overwritten
+    :param which: EIG_SMALLEST or EIG_LARGEST
+    :param vec: selected eigen vector, referenced to the phase of its first element
+    :param cwork: work space of size n + lwork, rwork: n + lrwork, iwork: 2 + liwork, see eigh_workspace_size_cy
+    Returns 0 on success, nonzero if the solver failed
+    """
+    cdef char jobz = b'V'
+    cdef char rng = b'I'
+    cdef char uplo = b'L'
+    cdef int n = mat.shape[0]
+    cdef int lda = mat.strides[0] // sizeof(float complex)
+    cdef int lwork = cwork.shape[0] - n, lrwork = rwork.shape[0] - n, liwork = iwork.shape[0] - 2
+    cdef int i, m, stat, il = n if which == EIG_LARGEST else 1
+    cdef float vl = 0, vu = 0, abstol = 0
     cdef float complex x0
-    cdef cnp.intp_t i, n = coh.shape[0]
-    cdef float complex[::1] vec = np.zeros(n, dtype=np.complex64)
-
-    eigen_value, eigen_vector = lap.cheevd(coh)[0:2]
-
-    x0 = cexpf(1j * cargf_r(eigen_vector[0, n-1]))
 
+    # the C ordered Hermitian matrix is its conjugate in column major order, so are the eigen vectors
+    cheevr(&jobz, &rng, &uplo, &n, &mat[0, 0], &lda, &vl, &vu, &il, &il, &abstol, &m, &rwork[0], &cwork[0], &n,
+           &iwork[0], &cwork[n], &lwork, &rwork[n], &lrwork, &iwork[2], &liwork, &stat)
+    if stat != 0 or m != 1:
+        return 1
+    eig_value[0] = rwork[0]
+    x0 = cexpf(1j * cargf_r(conjf(cwork[0])))
     for i in range(n):
-        vec[i] = eigen_vector[i, n-1] * conjf(x0)
-
-    return vec
-
-
-cdef inline float complex[::1] EMI_phase_estimation_cy(float complex[:, ::1] coh, float[:, ::1] abscoh):
-    """ Estimates the phase values based on EMI decomosition (Homa Ansari, 2018 paper) """
-    cdef float[:, :] invabscoh
-    cdef int stat
-    cdef cnp.intp_t i, n = coh.shape[0]
-    cdef float complex[:, ::1] M
-    cdef float[::1] eigen_value
-    cdef float complex[:, :] eigen_vector
-    cdef float complex[::1] vec = np.zeros(n, dtype=np.complex64)
-    cdef float complex x0
-
-    invabscoh = inverse_float_matrix(abscoh)
-    M = multiply_elementwise_dc(invabscoh, coh)
-    eigen_value, eigen_vector = lap.cheevd(M)[0:2]
-
-    x0 = cexpf(1j * cargf_r(eigen_vector[0, 0]))
+        vec[i] = conjf(cwork[i]) * conjf(x0)
+    return 0
+
+
+cdef int eigh_select_batch_cy(float complex[:, :, ::1] mats, int[::1] which, float[::1] eig_values,
+                              float complex[:, ::1] eig_vectors, int[::1] info, int num_threads):
+    """ Solves a stack of Hermitian eigen problems for a single eigen pair each (LAPACK cheevr).
+    :param mats: n_pixel x n x n Hermitian matrices, they are overwritten
+    :param which: EIG_SMALLEST or EIG_LARGEST to select the eigen pair of each matrix, EIG_SKIP to skip it
+    :param eig_values: selected eigen value of each matrix
+    :param eig_vectors: selected eigen vector of each matrix, referenced to the phase of its first element
+    :param info: status of each matrix, nonzero if the solver failed
+    :param num_threads: number of OpenMP threads sharing the matrices
+    Returns the number of failed matrices
+    """
+    cdef int n = mats.shape[1]
+    cdef int tid, lwork, lrwork, liwork, num_failed = 0
+    cdef float complex[:, ::1] cwork
+    cdef float[:, ::1] rwork
+    cdef int[:, ::1] iwork
+    cdef cnp.intp_t p
+
+    eigh_workspace_size_cy(n, &lwork, &lrwork, &liwork)
+    cwork = np.zeros((num_threads, n + lwork), dtype=np.complex64)
+    rwork = np.zeros((num_threads, n + lrwork), dtype=np.float32)
+    iwork = np.zeros((num_threads, 2 + liwork), dtype=np.int32)
+
+    with nogil, parallel(num_threads=num_threads):
+        tid = threadid()
+        for p in prange(mats.shape[0], schedule='dynamic'):
+            info[p] = 0
+            if which[p] != EIG_SKIP:
+                info[p] = eigh_single_cy(mats[p], which[p], eig_vectors[p], &eig_values[p], cwork[tid], rwork[tid],
+                                         iwork[tid])
+                if info[p] != 0:
+                    num_failed += 1
+
+    return num_failed
+
+
+cpdef tuple eigh_select_batch_py(float complex[:, :, ::1] mats, int[::1] which, int num_threads=1):
+    """ Solves a stack of Hermitian eigen problems for a single eigen pair each (LAPACK cheevr). """
+    cdef float complex[:, :, ::1] work_mats = np.array(mats, dtype=np.complex64)
+    cdef float[::1] eig_values = np.zeros(mats.shape[0], dtype=np.float32)
+    cdef float complex[:, ::1] eig_vectors = np.zeros((mats.shape[0], mats.shape[1]), dtype=np.complex64)
+    cdef int[::1] info = np.zeros(mats.shape[0], dtype=np.int32)
+
+    eigh_select_batch_cy(work_mats, which, eig_values, eig_vectors, info, num_threads)
+    return np.asarray(eig_values), np.asarray(eig_vectors), np.asarray(info)
+
+
+cdef int eigh_iterative_cy(float complex[:, ::1] mat, int which, float complex[::1] vec, float complex[::1] work,
+                           float complex[:, ::1] factor, float tolerance, int max_iterations,
+                           float* eig_value) noexcept nogil:
+    """ Single eigen pair of a Hermitian matrix by power (EIG_LARGEST) or inverse (EIG_SMALLEST) iteration.
+    :param vec: start vector on input, the eigen vector on return
+    :param work: work space of size n
+    :param factor: work space of size n x n for the Cholesky factor of the inverse iteration
+    Returns the number of iterations, 0 if the residual |A v - lambda v| did not drop below tolerance * |lambda|
+    """
+    cdef char uplo = b'L'
+    cdef int i, t, it, stat, nrhs = 1, n = mat.shape[0]
+    cdef float norm = 0, lam, res
 
     for i in range(n):
-            vec[i] = eigen_vector[i, 0] * conjf(x0)
-    return vec
-
-
-cpdef inline double optphase_cy(double[::1] x0, float complex[:, ::1] inverse_gam):
-    cdef cnp.intp_t n
-    cdef float complex[::1] x
-    cdef float complex[::1] y
-    cdef float complex u = 0
-    cdef double out = 1
-    cdef int i
-
-    n = x0.shape[0]
-    x = expmati(np.float32(x0))
+        norm += crealf(vec[i]) ** 2 + cimagf(vec[i]) ** 2
+    if norm == 0:
+        for i in range(n):
+            vec[i] = 1
+        norm = n
+    norm = sqrtf(norm)
     for i in range(n):
-        x[i] = x[i] - conjf(x[0])
-    y = multiplymat12(conjmat1(x), inverse_gam)
-    u = multiplymat11(y, x)
-    out = cabsf(clogf(u))
-    return  out
-
-cdef inline float[::1] optimize_lbfgs(double[::1] x0, float complex[:, ::1] inverse_gam):
-    cdef double[::1] res
-    cdef float[::1] out = np.zeros(x0.shape[0], dtype=np.float32)
-    cdef cnp.intp_t i
+        vec[i] = vec[i] / norm
+
+    if which == EIG_SMALLEST:
+        # the C ordered matrix is its conjugate in column major order, so the solution is conjugated too
+        for i in range(n):
+            for t in range(n):
+                factor[i, t] = mat[i, t]
+        cpotrf(&uplo, &n, &factor[0, 0], &n, &stat)
+        if stat != 0:
+            return 0
+
+    for it in range(1, max_iterations + 1):
+        lam = 0
+        for i in range(n):
+            work[i] = 0
+            for t in range(n):
+                work[i] = work[i] + mat[i, t] * vec[t]
+            lam += crealf(conjf(vec[i]) * work[i])
+        res = 0
+        for i in range(n):
+            res += cabsf(work[i] - lam * vec[i]) ** 2
+        if sqrtf(res) <= tolerance * fabs(lam):
+            eig_value[0] = lam
+            return it
+
+        if which == EIG_SMALLEST:
+            for i in range(n):
+                work[i] = conjf(vec[i])
+            cpotrs(&uplo, &n, &nrhs, &factor[0, 0], &n, &work[0], &n, &stat)
+            for i in range(n):
+                work[i] = conjf(work[i])
+        norm = 0
+        for i in range(n):
+            norm += crealf(work[i]) ** 2 + cimagf(work[i]) ** 2
+        if norm == 0:
+            return 0
+        norm = sqrtf(norm)
+        for i in range(n):
+            vec[i] = work[i] / norm
+    return 0
+
+
+cdef int eigh_iterative_batch_cy(float complex[:, :, ::1] mats, int[::1] which, float[::1] eig_values,
+                                 float complex[:, ::1] eig_vectors, float tolerance, int[::1] stats, int num_threads):
+    """ Solves a stack of Hermitian eigen problems for a single eigen pair each by power or inverse iteration.
+    The pixels are split in contiguous chunks, each pixel starts from the eigen vector of the previous one.
+    :param which: EIG_SMALLEST, EIG_LARGEST or EIG_SKIP like eigh_select_batch_cy, set to EIG_SKIP where it converged
+    :param stats: adds the number of matrices, iterations and the matrices that did not converge
+    Returns the number of matrices that did not converge, they are left for eigh_select_batch_cy
+    """
+    cdef int n = mats.shape[1], num_mats = mats.shape[0]
+    cdef int num_chunks = max(1, min(num_threads, num_mats))
+    cdef int c, p, p0, p1, i, prev, num_failed = 0
+    cdef int[::1] iterations = np.zeros(num_mats, dtype=np.int32)
+    cdef float complex[:, ::1] vec = np.zeros((num_chunks, n), dtype=np.complex64)
+    cdef float complex[:, ::1] work = np.zeros((num_chunks, n), dtype=np.complex64)
+    cdef float complex[:, :, ::1] factor = np.zeros((num_chunks, n, n), dtype=np.complex64)
+    cdef float complex x0
 
-    res = minimize(optphase_cy, x0, args=inverse_gam, method='L-BFGS-B', options={'gtol': 1e-6, 'disp': False}).x
+    with nogil:
+        for c in prange(num_chunks, num_threads=num_chunks, schedule='static', chunksize=1):
+            p0 = c * num_mats // num_chunks
+            p1 = (c + 1) * num_mats // num_chunks
+            prev = -1
+            for p in range(p0, p1):
+                if which[p] == EIG_SKIP:
+                    continue
+                for i in range(n):
+                    vec[c, i] = eig_vectors[prev, i] if prev >= 0 and which[prev] == which[p] else 0
+                iterations[p] = eigh_iterative_cy(mats[p], which[p], vec[c], work[c], factor[c], tolerance,
+                                                  EIG_MAX_ITERATIONS, &eig_values[p])
+                prev = -1
+                if iterations[p] > 0:
+                    x0 = cexpf(1j * cargf_r(vec[c, 0]))
+                    for i in range(n):
+                        eig_vectors[p, i] = vec[c, i] * conjf(x0)
+                    prev = p
+
+    for p in range(num_mats):
+        if which[p] == EIG_SKIP:
+            continue
+        stats[0] += 1
+        if iterations[p] > 0:
+            stats[1] += iterations[p]
+            which[p] = EIG_SKIP
+        else:
+            stats[2] += 1
+            num_failed += 1
+    return num_failed
 
-    for i in range(x0.shape[0]):
-        out[i] = res[i] - res[0]
 
-    return out
+cpdef tuple eigh_iterative_batch_py(float complex[:, :, ::1] mats, int[::1] which, float tolerance=1e-4,
+                                   int num_threads=1):
+    """ Solves a stack of Hermitian eigen problems for a single eigen pair each by power or inverse iteration,
+    the matrices that do not converge are solved by LAPACK cheevr.
+    """
+    cdef float complex[:, :, ::1] work_mats = np.array(mats, dtype=np.complex64)
+    cdef int[::1] work_which = np.array(which, dtype=np.int32)
+    cdef float[::1] eig_values = np.zeros(mats.shape[0], dtype=np.float32)
+    cdef float complex[:, ::1] eig_vectors = np.zeros((mats.shape[0], mats.shape[1]), dtype=np.complex64)
+    cdef int[::1] info = np.zeros(mats.shape[0], dtype=np.int32)
+    cdef int[::1] stats = np.zeros(3, dtype=np.int32)
+
+    eigh_iterative_batch_cy(work_mats, work_which, eig_values, eig_vectors, tolerance, stats, num_threads)
+    eigh_select_batch_cy(work_mats, work_which, eig_values, eig_vectors, info, num_threads)
+    return np.asarray(eig_values), np.asarray(eig_vectors), np.asarray(stats)
 
 
 cpdef float[:, :] inverse_float_matrix(float[:, ::1] x):
@@ -285,28 +481,35 @@ cpdef float[:, :] inverse_float_matrix(float[:, ::1] x):
 
     return res
 
-cdef inline float complex[::1] PTA_L_BFGS_cy(float complex[:, ::1] coh, float[:, ::1] abscoh):
-    """ Uses L-BFGS method to optimize PTA function and estimate phase values. """
-    cdef cnp.intp_t i, n_image = coh.shape[0]
-    cdef float complex[::1] x
-    cdef float[::1] amp, res
-    cdef double[::1] x0,
-    cdef float[:, :] invabscoh
-    cdef int stat
-    cdef float complex[:, ::1] inverse_gam
-    cdef float complex[::1] vec = np.zeros(n_image, dtype=np.complex64)
-
-    x = EMI_phase_estimation_cy(coh, abscoh)
-    x0 = angmatd(x)
-    amp = absmat1(x)
-
-    invabscoh = inverse_float_matrix(abscoh)
-    inverse_gam = multiply_elementwise_dc(invabscoh, coh)
-    res = optimize_lbfgs(x0, inverse_gam)
-    for i in range(n_image):
-        vec[i] = amp[i] * cexpf(1j * res[i])
-
-    return vec
+cdef int pta_coordinate_descent_cy(float complex[:, ::1] inverse_gam, float complex[::1] x, float tolerance,
+                                   int max_iterations) noexcept nogil:
+    """ Minimizes the PTA cost x^H (|coh|^-1 o coh) x over unit phasors x by cyclic coordinate descent.
+    The gradient of the cost with respect to phase k is 2 Im(conj(x_k) (M x)_k), with the other phases fixed
+    it vanishes at the minimum x_k = -s / |s|, s = sum_(l != k) M_kl x_l, which is set in place.
+    :param x: unit phasors of the start point, the solution on return
+    Returns the number of sweeps, max_iterations if it did not converge
+    """
+    cdef int i, t, k, n = x.shape[0]
+    cdef float complex temp
+    cdef float amp, change
+
+    for k in range(max_iterations):
+        change = 0
+        for i in range(n):
+            temp = 0
+            for t in range(n):
+                if t != i:
+                    temp = temp + inverse_gam[i, t] * x[t]
+            amp = cabsf(temp)
+            if amp == 0:
+                continue
+            temp = -temp / amp
+            if cabsf(temp - x[i]) > change:
+                change = cabsf(temp - x[i])
+            x[i] = temp
+        if change < tolerance:
+            return k + 1
+    return max_iterations
 
 
 cdef inline float[:,::1] outer_product(float[::1] x, float[::1] y):
@@ -356,50 +559,173 @@ cdef inline float complex[:,::1] transposemat2(float complex[:, :] x):
             y[j, i] = x[i, j]
     return y
 
-cdef inline float complex[:,::1] est_corr_cy(float complex[:,::1] ccg):
-    """ Estimate Correlation matrix from an ensemble."""
+cdef inline void est_cov_blas_cy(float complex* ccg, int n_image, int num_shp, int ld,
+                                 float complex[:, ::1] cov_mat) noexcept nogil:
+    """ Estimates the covariance matrix of an ensemble with one Hermitian rank-k update (BLAS cherk).
+    :param ccg: pointer to a C ordered n_image x ld block of samples, only the first num_shp columns are used
+    :param cov_mat: n_image x n_image output matrix
+    """
+    cdef char uplo = b'U'
+    cdef char trans = b'C'
+    cdef float alpha = 1. / num_shp
+    cdef float beta = 0
+    cdef int n = n_image
+    cdef int k = num_shp
+    cdef int lda = ld
+    cdef int ldc = n_image
     cdef cnp.intp_t i, t
-    cdef float complex[:,::1] cov_mat, corr_matrix
 
-    cov_mat = multiplymat22(ccg,  conjmat2(transposemat2(ccg)))
+    # The row major samples are seen by BLAS as their (ld x n_image) transpose, so A^H A in column major
+    # order is ccg * ccg^H in row major order with its lower triangle filled.
+    cherk(&uplo, &trans, &n, &k, &alpha, ccg, &lda, &beta, &cov_mat[0, 0], &ldc)
 
-    for i in range(cov_mat.shape[0]):
-        for t in range(cov_mat.shape[1]):
-            cov_mat[i, t] /= ccg.shape[1]
-    corr_matrix = cov2corr_cy(cov_mat)
+    for i in range(n_image):
+        for t in range(i):
+            cov_mat[t, i] = conjf(cov_mat[i, t])
+    return
 
-    return corr_matrix
 
-cdef inline float complex[:,::1] est_cov_cy(float complex[:,::1] ccg):
-    """ Estimate Correlation matrix from an ensemble."""
-    cdef cnp.intp_t i, t
-    cdef float complex[:,::1] cov_mat
+cdef inline void est_cov_band_blas_cy(float complex* ccg, int n_image, int num_shp, int ld, int lag,
+                                      float complex[:, ::1] cov_mat) noexcept nogil:
+    """ est_cov_blas_cy of the pairs of images less than lag apart, one matrix product (BLAS cgemm) for each block
+    of lag rows with the columns up to lag after it. The other entries of cov_mat are not set.
+    """
+    cdef char transa = b'C'
+    cdef char transb = b'N'
+    cdef float complex alpha = 1. / num_shp
+    cdef float complex beta = 0
+    cdef int m, n, k = num_shp, lda = ld, ldc = n_image
+    cdef cnp.intp_t i, t, b, r0, r1, c1
+
+    for b in range((n_image + lag - 1) // lag):
+        r0 = b * lag
+        r1 = min(r0 + lag, n_image)
+        c1 = min(r1 + lag - 1, n_image)
+        m = c1 - r0
+        n = r1 - r0
+        # column major A^H B of the (ld x n_image) transposed samples, see est_cov_blas_cy
+        cgemm(&transa, &transb, &m, &n, &k, &alpha, ccg + r0 * ld, &lda, ccg + r0 * ld, &lda, &beta,
+              &cov_mat[r0, r0], &ldc)
+        for i in range(r0, r1):
+            for t in range(r1, c1):
+                cov_mat[t, i] = conjf(cov_mat[i, t])
+    return
 
-    cov_mat = multiplymat22(ccg,  conjmat2(transposemat2(ccg)))
 
-    for i in range(cov_mat.shape[0]):
-        for t in range(cov_mat.shape[1]):
-            cov_mat[i, t] /= ccg.shape[1]
+cdef inline void cov2corr_band_inplace_cy(float complex[:, ::1] cov_mat, int lag) noexcept nogil:
+    """ cov2corr_inplace_cy of the pairs of images less than lag apart """
+    cdef cnp.intp_t i, t, n = cov_mat.shape[0]
+    cdef float vi, vt
 
-    return cov_mat
+    for i in range(n):
+        vi = sqrtf(cabsf(cov_mat[i, i]))
+        for t in range(max(0, i - lag + 1), i):
+            vt = sqrtf(cabsf(cov_mat[t, t]))
+            if cov_mat[i, t] != 0:
+                cov_mat[i, t] = cov_mat[i, t] / (vi * vt)
+            cov_mat[t, i] = conjf(cov_mat[i, t])
 
-cpdef float complex[:,::1] est_cov_py(float complex[:,::1] ccg):
+    for i in range(n):
+        if cov_mat[i, i] != 0:
+            cov_mat[i, i] = cov_mat[i, i] / cabsf(cov_mat[i, i])
+    return
+
+
+cdef inline void cov2corr_inplace_cy(float complex[:, ::1] cov_mat) noexcept nogil:
+    """ Converts covariance matrix to correlation/coherence matrix in place. """
+    cdef cnp.intp_t i, t, n = cov_mat.shape[0]
+    cdef float vi, vt
+
+    for i in range(n):
+        vi = sqrtf(cabsf(cov_mat[i, i]))
+        for t in range(i):
+            vt = sqrtf(cabsf(cov_mat[t, t]))
+            if cov_mat[i, t] != 0:
+                cov_mat[i, t] = cov_mat[i, t] / (vi * vt)
+            cov_mat[t, i] = conjf(cov_mat[i, t])
+
+    for i in range(n):
+        if cov_mat[i, i] != 0:
+            cov_mat[i, i] = cov_mat[i, i] / cabsf(cov_mat[i, i])
+    return
+
+
+cdef void pack_coherence_cy(float complex[:, ::1] coh, float complex[::1] packed) noexcept nogil:
+    """ Upper triangle of a coherence matrix without its diagonal, row by row (the order of numpy.triu_indices) """
+    cdef int i, t, m = 0, n = coh.shape[0]
+
+    for i in range(n):
+        for t in range(i + 1, n):
+            packed[m] = coh[i, t]
+            m += 1
+    return
+
+
+cdef void est_corr_batch_cy(float complex[:, :, ::1] samples, int[::1] num_shp,
+                            float complex[:, :, ::1] coh_mats, int num_threads, int lag,
+                            int band_shp) noexcept nogil:
+    """ Estimates the coherence matrices of a block of pixels from their stacked SHP samples.
+    :param samples: n_pixel x n_image x max_shp, the first num_shp[p] columns are the SHPs of pixel p
+    :param num_shp: number of SHPs of each pixel, pixels with zero SHPs are skipped
+    :param coh_mats: n_pixel x n_image x n_image output coherence matrices
+    :param num_threads: number of OpenMP threads sharing the pixels
+    :param lag: with 0 < lag < n_image, only the pairs of images less than lag apart are estimated for the pixels
+                with more than band_shp SHPs, the other entries of their matrices are not set. 0 for all pairs
+    """
+    cdef cnp.intp_t p
+    cdef int n_image = samples.shape[1]
+    cdef int max_shp = samples.shape[2]
+
+    for p in prange(samples.shape[0], num_threads=num_threads, schedule='dynamic'):
+        if num_shp[p] > band_shp and 0 < lag < n_image:
+            est_cov_band_blas_cy(&samples[p, 0, 0], n_image, num_shp[p], max_shp, lag, coh_mats[p])
+            cov2corr_band_inplace_cy(coh_mats[p], lag)
+        elif num_shp[p] > 0:
+            est_cov_blas_cy(&samples[p, 0, 0], n_image, num_shp[p], max_shp, coh_mats[p])
+            cov2corr_inplace_cy(coh_mats[p])
+    return
+
+
+cpdef cnp.ndarray est_corr_batch_py(float complex[:, :, ::1] samples, int[::1] num_shp, int num_threads=1):
+    """ Estimates the coherence matrices of a block of pixels from their stacked SHP samples."""
+    cdef cnp.intp_t n_image = samples.shape[1]
+    cdef cnp.ndarray[float complex, ndim=3] coh_mats = np.zeros((samples.shape[0], n_image, n_image),
+                                                                dtype=np.complex64)
+    est_corr_batch_cy(samples, num_shp, coh_mats, num_threads, 0, 0)
+    return coh_mats
+
+
+cdef inline float complex[:,::1] est_corr_cy(float complex[:,::1] ccg):
     """ Estimate Correlation matrix from an ensemble."""
-    cdef cnp.intp_t i, t
-    cdef float complex[:,::1] cov_mat
+    cdef cnp.intp_t n = ccg.shape[0]
+    cdef float complex[:,::1] corr_matrix = np.empty((n, n), dtype=np.complex64)
 
-    cov_mat = multiplymat22(ccg,  conjmat2(transposemat2(ccg)))
+    est_cov_blas_cy(&ccg[0, 0], n, ccg.shape[1], ccg.shape[1], corr_matrix)
+    cov2corr_inplace_cy(corr_matrix)
 
-    for i in range(cov_mat.shape[0]):
-        for t in range(cov_mat.shape[1]):
-            cov_mat[i, t] /= ccg.shape[1]
+    return corr_matrix
+
+cdef inline float complex[:,::1] est_cov_cy(float complex[:,::1] ccg):
+    """ Estimate Correlation matrix from an ensemble."""
+    cdef cnp.intp_t n = ccg.shape[0]
+    cdef float complex[:,::1] cov_mat = np.empty((n, n), dtype=np.complex64)
+
+    est_cov_blas_cy(&ccg[0, 0], n, ccg.shape[1], ccg.shape[1], cov_mat)
 
     return cov_mat
 
+cpdef float complex[:,::1] est_cov_py(float complex[:,::1] ccg):
+    """ Estimate Correlation matrix from an ensemble."""
+    return est_cov_cy(ccg)
+
 cpdef float complex[:,::1] est_corr_py(float complex[:,::1] ccg):
     """ Estimate Correlation matrix from an ensemble."""
+    return est_corr_cy(ccg)
+
+cpdef float complex[:,::1] est_corr_loop_py(float complex[:,::1] ccg):
+    """ Reference (element wise loop) estimate of the correlation matrix, kept for validation and benchmarks."""
     cdef cnp.intp_t i, t
-    cdef float complex[:,::1] corr_matrix
+    cdef float complex[:,::1] cov_mat, corr_matrix
 
     cov_mat = multiplymat22(ccg,  conjmat2(transposemat2(ccg)))
 
@@ -418,41 +744,49 @@ cdef inline float sum1d(float[::1] x):
     return out
 
 
-cdef tuple test_PS_cy(float complex[:, ::1] coh_mat, float[::1] amplitude):
+cdef tuple test_PS_cy(float complex[:, ::1] coh_mat, float amp_dispersion):
     """ checks if the pixel is PS """
 
-    cdef cnp.intp_t i, t, ns = coh_mat.shape[0]
+    cdef cnp.intp_t i, ns = coh_mat.shape[0]
     cdef float[::1] Eigen_value
-    cdef float[::1] amplitude_diff = np.empty(ns, dtype=np.float32)
     cdef cnp.ndarray[float complex, ndim=2] Eigen_vector
     cdef float complex[::1] vec = np.zeros(ns, dtype=np.complex64)
-    cdef float s, temp_quality, amp_dispersion, amp_diff_dispersion
     cdef float complex x0
-    
-    #amplitude_diff = np.zeros(n, dtype=np.float32)
+
     Eigen_value, Eigen_vector = lap.cheevd(coh_mat)[0:2]
 
-    s = 0
+    x0 = cexpf(1j * cargf_r(Eigen_vector[0, ns - 1]))
+
     for i in range(ns):
-        s += abs(Eigen_value[i])**2
-        # amplitude_diff[i] = amplitude[i]-amplitude[0]
+        vec[i] = Eigen_vector[i, ns-1] * conjf(x0)
 
-    s = sqrt(s)
-    # amp_diff_dispersion = np.std(amplitude_diff)/np.mean(amplitude)
-    amp_dispersion = np.std(amplitude)/np.mean(amplitude)
+    return test_PS_eig_cy(coh_mat, amp_dispersion, Eigen_value[ns-1], vec)
 
-    if Eigen_value[ns-1]*(100 / s) > 80 and amp_dispersion < 0.39:
 
-        temp_quality = 1
-    else:
-        x0 = cexpf(1j * cargf_r(Eigen_vector[0, ns - 1]))
+cdef tuple test_PS_eig_cy(float complex[:, ::1] coh_mat, float amp_dispersion, float top_value,
+                          float complex[::1] top_vector):
+    """ checks if the pixel is PS given its amplitude dispersion (see amplitude_dispersion_py), the largest
+    eigen value and its phase referenced eigen vector
+    """
+
+    cdef cnp.intp_t i, t, ns = coh_mat.shape[0]
+    cdef float s = 0, temp_quality
 
+    # sum of the squared eigen values of a hermitian matrix is its squared frobenius norm
+    if amp_dispersion < PS_AMP_DISPERSION:
         for i in range(ns):
-            vec[i] = Eigen_vector[i, ns-1] * conjf(x0)
+            for t in range(ns):
+                s += cabsf(coh_mat[i, t])**2
+        s = sqrt(s)
 
-        temp_quality = gam_pta_c(angmat2(coh_mat), vec)
+    if amp_dispersion < PS_AMP_DISPERSION and top_value*(100 / s) > 80:
+
+        temp_quality = 1
+        top_vector = np.zeros(ns, dtype=np.complex64)
+    else:
+        temp_quality = gam_pta_coh_cy(coh_mat, top_vector)
 
-    return temp_quality, vec
+    return temp_quality, top_vector
 
 cdef inline float norm_complex(float complex[::1] x):
     cdef cnp.intp_t n = x.shape[0]
@@ -482,196 +816,705 @@ cdef inline float complex[::1] squeeze_images(float complex[::1] x, float comple
 
     return out
 
-cdef inline int is_semi_pos_def_chol_cy(float[:, ::1] x):
-    """ Checks the positive semi definitness of a matrix. desired: res=0 """
-    cdef int res
-    try:
-        LA.cholesky(x)
-        res = 0
-    except:
-        res = 1
-    return res
+cdef int regularization_shift_cy(float[::1] values, float* shift) noexcept nogil:
+    """ Diagonal shift of regularize_inverse_cy from the ascending eigen values of a symmetric matrix.
+    Returns -1 if no shift 1e-6 * (2^k - 1), k < 100 is large enough
+    """
+    cdef int k = 0, n = values.shape[0]
+    cdef float jitter = 1e-6
+    cdef float margin = n * FLT_EPSILON * fabs(values[n - 1])
+
+    shift[0] = 0
+    while values[0] + shift[0] <= margin:
+        if k == 100:
+            return -1
+        shift[0] += jitter
+        jitter *= 2
+        k += 1
+    return 0
+
+
+cdef int regularize_inverse_cy(float[:, ::1] mat, float[:, ::1] inverse, float[:, ::1] vectors, float[::1] values,
+                               float[::1] work, int[::1] iwork) noexcept nogil:
+    """ Inverse of a symmetric matrix, shifted to be positive definite if its Cholesky factorization fails.
+    The diagonal shift is the first of 1e-6 * (2^k - 1), k < 100 that brings the smallest eigen value above
+    n * eps * largest eigen value, like adding a doubling jitter until the factorization passes but found from
+    one eigen decomposition.
+    :param mat: n x n symmetric matrix, regularized in place
+    :param inverse: n x n inverse of the regularized matrix
+    :param vectors: n x n work space, values: n work space
+    :param work: work space of size 1 + 6n + 2n^2, iwork: work space of size 3 + 5n
+    The rows of the matrices may be strided (a corner of a larger matrix).
+    Returns 0 if the matrix is positive definite, 1 if it was regularized, -1 if it could not be regularized
+    """
+    cdef char uplo = b'L'
+    cdef char jobz = b'V'
+    cdef int i, t, k, stat, n = mat.shape[0]
+    cdef int lwork = work.shape[0], liwork = iwork.shape[0]
+    cdef int ldi = inverse.strides[0] // sizeof(float), ldv = vectors.strides[0] // sizeof(float)
+    cdef float shift = 0, temp
+
+    # the symmetric C ordered matrix is the same in column major order
+    for i in range(n):
+        for t in range(n):
+            inverse[i, t] = mat[i, t]
+    spotrf(&uplo, &n, &inverse[0, 0], &ldi, &stat)
+    if stat == 0:
+        spotri(&uplo, &n, &inverse[0, 0], &ldi, &stat)
+    if stat == 0:
+        for i in range(n):
+            for t in range(i + 1, n):
+                inverse[t, i] = inverse[i, t]
+        return 0
 
+    for i in range(n):
+        for t in range(n):
+            vectors[i, t] = mat[i, t]
+    ssyevd(&jobz, &uplo, &n, &vectors[0, 0], &ldv, &values[0], &work[0], &lwork, &iwork[0], &liwork, &stat)
+    if stat != 0:
+        return -1
 
-cdef inline tuple regularize_matrix_cy(float[:, ::1] M):
-    """ Regularizes a matrix to make it positive semi definite. """
-    cdef int status = 1
-    cdef cnp.intp_t i, t = 0
-    cdef float[:, ::1] N = np.zeros((M.shape[0], M.shape[1]), dtype=np.float32)
-    cdef float en = 1e-6
+    if regularization_shift_cy(values, &shift) < 0:
+        return -1
+    for i in range(n):
+        mat[i, i] += shift
+    # the eigen vectors are the rows of the C ordered array
+    for i in range(n):
+        for t in range(i, n):
+            temp = 0
+            for k in range(n):
+                temp = temp + vectors[k, i] * vectors[k, t] / (values[k] + shift)
+            inverse[i, t] = temp
+            inverse[t, i] = temp
+    return 1
+
+
+cpdef tuple regularize_inverse_py(float[:, ::1] M):
+    """ Regularizes a symmetric matrix to make it positive definite and inverts it.
+    Returns status (0 positive definite, 1 regularized, -1 failed), the regularized matrix and its inverse
+    """
+    cdef int n = M.shape[0]
+    cdef float[:, ::1] N = np.array(M, dtype=np.float32)
+    cdef float[:, ::1] inverse = np.zeros((n, n), dtype=np.float32)
+    cdef float[:, ::1] vectors = np.zeros((n, n), dtype=np.float32)
+    cdef float[::1] values = np.zeros(n, dtype=np.float32)
+    cdef float[::1] work = np.zeros(1 + 6 * n + 2 * n * n, dtype=np.float32)
+    cdef int[::1] iwork = np.zeros(3 + 5 * n, dtype=np.int32)
+    cdef int status = regularize_inverse_cy(N, inverse, vectors, values, work, iwork)
+    return status, N, inverse
+
+
+cdef int emi_matrix_cy(float complex[:, ::1] coh, float complex[:, ::1] out, float[:, :, ::1] fmats,
+                       float[::1] rwork, int[::1] iwork) noexcept nogil:
+    """ |coh|^-1 o coh of the EMI estimator, |coh| is regularized by regularize_inverse_cy.
+    :param out: n x n output matrix, not set if the regularization failed
+    :param fmats: 3 x n x n work space, larger matrices are used by their corner
+    :param rwork: work space of size n + 1 + 6n + 2n^2, iwork: 3 + 5n
+    Returns the status of regularize_inverse_cy
+    """
+    cdef int i, t, status, n = coh.shape[0]
+    cdef float[:, ::1] abscoh = fmats[0, :n, :n]
+    cdef float[:, ::1] invabscoh = fmats[1, :n, :n]
 
-    for i in range(M.shape[0]):
-        for t in range(M.shape[1]):
-            N[i, t] = M[i, t]
+    for i in range(n):
+        for t in range(n):
+            abscoh[i, t] = cabsf(coh[i, t])
+    status = regularize_inverse_cy(abscoh, invabscoh, fmats[2, :n, :n], rwork[:n], rwork[n:], iwork)
+    if status >= 0:
+        for i in range(n):
+            for t in range(n):
+                out[i, t] = invabscoh[i, t] * coh[i, t]
+    return status
+
+
+cdef inline float complex normalize_cov_cy(float complex cov, float complex var1, float complex var2) noexcept nogil:
+    """ Coherence from a covariance and the variances of its two images like cov2corr_inplace_cy """
+    cdef float scale = sqrtf(cabsf(var1)) * sqrtf(cabsf(var2))
+    if cov == 0 or scale == 0:
+        return 0
+    return cov / scale
+
+
+cdef void sample_moments_cy(float complex[:, ::1] samples, int num_shp, float[::1] amplitude,
+                            float[::1] scale) noexcept nogil:
+    """ Mean amplitude and root mean power of each image over the first num_shp samples """
+    cdef int i, t
+    cdef float temp, power
 
-    t = 0
-    while t < 100:
-        status = is_semi_pos_def_chol_cy(N)
-        if status == 0:
-            break
-        else:
-            for i in range(M.shape[0]):
-                N[i, i] += en
-            en *= 2
-            t += 1
-    return status, N
+    for i in range(samples.shape[0]):
+        temp = 0
+        power = 0
+        for t in range(num_shp):
+            temp += cabsf(samples[i, t])
+            power += crealf(samples[i, t]) ** 2 + cimagf(samples[i, t]) ** 2
+        amplitude[i] = temp / num_shp
+        scale[i] = sqrtf(power / num_shp)
+    return
 
-cdef inline tuple phase_linking_process_cy(float complex[:, ::1] ccg_sample, int stepp, bytes method, bint squeez, int lag):
-    """Inversion of phase based on a selected method among PTA, EVD and EMI """
 
-    cdef float complex[:, ::1] coh_mat
-    cdef float[:, ::1] abscoh
-    cdef float complex[::1] res
-    cdef cnp.intp_t n1 = ccg_sample.shape[1]
-    cdef float complex[::1] squeezed
-    cdef float quality
-    cdef int status
+cdef int banded_inverse_cy(float[:, ::1] band, int kd, float[:, ::1] inverse_band) noexcept nogil:
+    """ Band of the inverse of a symmetric positive definite band matrix from its Cholesky factor (Takahashi
+    recursion): the entries of the inverse within the band only depend on each other and on the factor, so they
+    are found in n * kd^2 operations without the dense inverse.
+    :param band: lower band storage of the factor L from spbtrf, band[j, d] = L[j + d, j]
+    :param inverse_band: lower band storage of the inverse, inverse_band[j, d] = inv[j + d, j]
+    """
+    cdef int i, j, k, n = band.shape[0]
+    cdef float temp
+
+    for i in range(n - 1, -1, -1):
+        for j in range(min(n - 1, i + kd), i - 1, -1):
+            temp = 1 / band[i, 0] if j == i else 0
+            for k in range(i + 1, min(n - 1, i + kd) + 1):
+                # inv[k, j] from the band, the inverse is symmetric
+                if k <= j:
+                    temp -= band[i, k - i] * inverse_band[k, j - k]
+                else:
+                    temp -= band[i, k - i] * inverse_band[j, k - j]
+            inverse_band[i, j - i] = temp / band[i, 0]
+    return 0
 
-    coh_mat = est_corr_cy(ccg_sample)
-    if method.decode('utf-8') == 'StBAS':
-        coh_mat = mask_diag(coh_mat, lag)
 
-    if method.decode('utf-8') == 'PTA' or method.decode('utf-8') == 'sequential_PTA' or method.decode('utf-8')=='StBAS':
-        status, abscoh = regularize_matrix_cy(absmat2(coh_mat))
-        if status == 0:
-            res = PTA_L_BFGS_cy(coh_mat, abscoh)
-        else:
-            res = EVD_phase_estimation_cy(coh_mat)
-    elif method.decode('utf-8') == 'EMI' or method.decode('utf-8') == 'sequential_EMI':
-        status, abscoh = regularize_matrix_cy(absmat2(coh_mat))
-        if status == 0:
-            res = EMI_phase_estimation_cy(coh_mat, abscoh)
-        else:
-            res = EVD_phase_estimation_cy(coh_mat)
-    else:
-        res = EVD_phase_estimation_cy(coh_mat)
+cdef int pta_banded_descent_cy(float complex[:, ::1] band, int kd, float complex[::1] x, float tolerance,
+                               int max_iterations) noexcept nogil:
+    """ pta_coordinate_descent_cy of a Hermitian band matrix in lower band storage, band[j, d] = M[j + d, j].
+    Returns the number of sweeps, max_iterations if it did not converge
+    """
+    cdef int i, t, k, n = x.shape[0]
+    cdef float complex temp
+    cdef float amp, change
+
+    for k in range(max_iterations):
+        change = 0
+        for i in range(n):
+            temp = 0
+            for t in range(max(0, i - kd), i):
+                temp = temp + band[t, i - t] * x[t]
+            for t in range(i + 1, min(n - 1, i + kd) + 1):
+                temp = temp + conjf(band[i, t - i]) * x[t]
+            amp = cabsf(temp)
+            if amp == 0:
+                continue
+            temp = -temp / amp
+            if cabsf(temp - x[i]) > change:
+                change = cabsf(temp - x[i])
+            x[i] = temp
+        if change < tolerance:
+            return k + 1
+    return max_iterations
+
+
+cdef float gam_pta_banded_cy(float complex[:, ::1] coh_mat, int lag, float complex[::1] vec) noexcept nogil:
+    """ gam_pta_coh_cy of coh_mat with the pairs at least lag images apart set to zero (mask_diag).
+    Their unit phasor is 1, so they add sum_i conj(u_i) sum_(k >= i + lag) u_k found with a suffix sum.
+    """
+    cdef int i, k, n = vec.shape[0]
+    cdef float complex temp, suffix = 0
+    cdef float out = 0
 
-    quality = gam_pta_c(angmat2(coh_mat), res)
+    for i in range(n - 1, -1, -1):
+        if i + lag < n:
+            suffix = suffix + unit_phasor_cy(vec[i + lag])
+        temp = suffix
+        for k in range(i + 1, min(n, i + lag)):
+            temp = temp + unit_phasor_cy(coh_mat[i, k]) * unit_phasor_cy(vec[k])
+        out += crealf(conjf(unit_phasor_cy(vec[i])) * temp)
+
+    return out * 2 / (n * n - n)
+
+
+cdef int stbas_phase_estimation_cy(float complex[:, ::1] coh, int lag, float complex[::1] vec,
+                                   float complex[:, :, ::1] cmats, float[:, :, ::1] fmats, float complex[::1] cwork,
+                                   float[::1] rwork, int[::1] iwork, int[::1] stats) noexcept nogil:
+    """ PTA of the coherence matrix masked to the pairs less than lag images apart (StBAS) in band storage.
+    Same as pta_kernel_cy of mask_diag(coh, lag): |coh|^-1 o coh is zero outside the band as well,
+    so the factorization, the band of the inverse and the PTA sweeps scale with n * lag instead of n^2.
+    :param lag: 0 < lag < n
+    :param cmats: 3 x n x n and fmats: 3 x n x n work spaces, cwork, rwork, iwork: see PhaseLinkWorkspace
+    Returns 0 on success, 1 if the eigen solver failed, -1 if |coh| could not be regularized
+    """
+    cdef char uplo = b'L'
+    cdef char jobz_n = b'N'
+    cdef char jobz_v = b'V'
+    cdef char rng = b'I'
+    cdef int i, d, stat, num_sweeps, m, il = 1, one = 1, n = coh.shape[0], kd = lag - 1
+    cdef float[:, ::1] band = fmats[0], inverse_band = fmats[1], values_band = fmats[2]
+    cdef float complex[:, ::1] mat_band = cmats[0], eig_band = cmats[1], q = cmats[2]
+    cdef int ldf = band.strides[0] // sizeof(float), ldc = mat_band.strides[0] // sizeof(float complex)
+    cdef float vl = 0, vu = 0, abstol = 0, shift = 0
+    cdef float complex x0
 
-    if squeez:
-        squeezed = squeeze_images(res, ccg_sample, stepp)
+    # |coh| in lower band storage, band[j, d] = |coh[j + d, j]|, the C ordered array is column major (ldf x n)
+    for i in range(n):
+        for d in range(min(lag, n - i)):
+            band[i, d] = cabsf(coh[i + d, i])
+            values_band[i, d] = band[i, d]
+    spbtrf(&uplo, &n, &kd, &band[0, 0], &ldf, &stat)
+    if stat != 0:
+        ssbev(&jobz_n, &uplo, &n, &kd, &values_band[0, 0], &ldf, &rwork[0], &rwork[0], &one, &rwork[n], &stat)
+        if stat != 0 or regularization_shift_cy(rwork[:n], &shift) < 0:
+            return -1
+        for i in range(n):
+            for d in range(min(lag, n - i)):
+                band[i, d] = cabsf(coh[i + d, i]) + (shift if d == 0 else 0)
+        spbtrf(&uplo, &n, &kd, &band[0, 0], &ldf, &stat)
+        if stat != 0:
+            return -1
+        stats[STAT_REGULARIZED] += 1
+    banded_inverse_cy(band, kd, inverse_band)
+
+    # M = |coh|^-1 o coh in lower band storage, given to LAPACK as is since the band is built from M itself
+    for i in range(n):
+        for d in range(min(lag, n - i)):
+            mat_band[i, d] = inverse_band[i, d] * coh[i + d, i]
+            eig_band[i, d] = mat_band[i, d]
+    chbevx(&jobz_v, &rng, &uplo, &n, &kd, &eig_band[0, 0], &ldc, &q[0, 0], &ldc, &vl, &vu, &il, &il, &abstol, &m,
+           &rwork[0], &cwork[0], &n, &cwork[n], &rwork[n], &iwork[0], &iwork[5 * n], &stat)
+    if stat != 0 or m != 1:
+        return 1
 
-        return res, squeezed, quality
-    else:
-        return res, 0, quality
+    for i in range(n):
+        vec[i] = unit_phasor_cy(cwork[i])
+    num_sweeps = pta_banded_descent_cy(mat_band, kd, vec, PTA_TOLERANCE, PTA_MAX_ITERATIONS)
+    stats[STAT_PTA_INVERSIONS] += 1
+    stats[STAT_PTA_SWEEPS] += num_sweeps
+    stats[STAT_PTA_NOT_CONVERGED] += num_sweeps == PTA_MAX_ITERATIONS
 
+    x0 = conjf(vec[0])
+    for i in range(n):
+        vec[i] = cabsf(cwork[i]) * vec[i] * x0
+    return 0
 
-cpdef tuple phase_linking_process_py(float complex[:, ::1] ccg_sample, int stepp, bytes method, bint squeez, int lag):
-    """Inversion of phase based on a selected method among PTA, EVD and EMI """
 
-    cdef float complex[:, ::1] coh_mat
-    cdef float[:, ::1] abscoh
-    cdef float complex[::1] res
-    cdef cnp.intp_t n1 = ccg_sample.shape[1]
-    cdef float complex[::1] squeezed
-    cdef float quality
-    cdef int status
+cdef class PhaseLinkWorkspace:
+    """ Work space of the phase linking kernels and phase_linking_pixel_cy, one slice per OpenMP thread.
+    It is sized once per patch so that the pixels are inverted without memory allocations.
+    A kernel may use cmats[tid, 0:3] and fmats[tid] as n x n matrices (or their corners), cwork[tid], rwork[tid],
+    iwork[tid] and adds its counters to stats[tid], the other arrays belong to phase_linking_pixel_cy.
+    stack_time[tid, s] is the time spent by the thread on mini stack s of the sequential estimator,
+    csamples[tid] holds the samples of the squeezed images of a pixel of up to max_samples SHPs.
+    """
 
-    coh_mat = est_corr_cy(ccg_sample)
-    if method.decode('utf-8') == 'StBAS':
-        coh_mat = mask_diag(coh_mat, lag)
+    def __init__(self, int n_image, int num_mini_stacks, int num_threads, int max_samples=0):
+        cdef int lwork, lrwork, liwork
+
+        eigh_workspace_size_cy(n_image, &lwork, &lrwork, &liwork)
+        self.cmats = np.zeros((num_threads, 5, n_image, n_image), dtype=np.complex64)
+        self.fmats = np.zeros((num_threads, 3, n_image, n_image), dtype=np.float32)
+        self.cvecs = np.zeros((num_threads, 2 * num_mini_stacks + 1, n_image), dtype=np.complex64)
+        self.scale = np.zeros((num_threads, n_image), dtype=np.float32)
+        self.cwork = np.zeros((num_threads, n_image + max(lwork, n_image)), dtype=np.complex64)
+        self.rwork = np.zeros((num_threads, n_image + max(lrwork, 1 + 6 * n_image + 2 * n_image ** 2)),
+                              dtype=np.float32)
+        self.iwork = np.zeros((num_threads, max(2 + liwork, 3 + 5 * n_image)), dtype=np.int32)
+        self.stats = np.zeros((num_threads, NUM_STATS), dtype=np.int32)
+        self.stack_time = np.zeros((num_threads, num_mini_stacks), dtype=np.float64)
+        self.csamples = np.zeros((num_threads, num_mini_stacks, max_samples), dtype=np.complex64)
+
+
+cdef int evd_kernel_cy(float complex[:, ::1] coh, int lag, float complex[::1] vec, PhaseLinkWorkspace ws,
+                       int tid) noexcept nogil:
+    """ EVD: eigen vector of the largest eigen value of the coherence matrix """
+    cdef int i, t, n = coh.shape[0]
+    cdef float complex[:, ::1] eig_mat = ws.cmats[tid, 1, :n, :n]
+    cdef float eig_value
 
-    if method.decode('utf-8') == 'PTA' or method.decode('utf-8') == 'sequential_PTA' or method.decode('utf-8')=='StBAS':
-        status, abscoh = regularize_matrix_cy(absmat2(coh_mat))
-        if status == 0:
-            res = PTA_L_BFGS_cy(coh_mat, abscoh)
-        else:
-            res = EVD_phase_estimation_cy(coh_mat)
-    elif method.decode('utf-8') == 'EMI' or method.decode('utf-8') == 'sequential_EMI':
-        status, abscoh = regularize_matrix_cy(absmat2(coh_mat))
-        if status == 0:
-            res = EMI_phase_estimation_cy(coh_mat, abscoh)
-        else:
-            res = EVD_phase_estimation_cy(coh_mat)
-    else:
-        res = EVD_phase_estimation_cy(coh_mat)
+    for i in range(n):
+        for t in range(n):
+            eig_mat[i, t] = coh[i, t]
+    return eigh_single_cy(eig_mat, EIG_LARGEST, vec, &eig_value, ws.cwork[tid], ws.rwork[tid], ws.iwork[tid])
 
-    quality = gam_pta_c(angmat2(coh_mat), res)
 
-    if squeez:
-        squeezed = squeeze_images(res, ccg_sample, stepp)
+cdef int emi_kernel_cy(float complex[:, ::1] coh, int lag, float complex[::1] vec, PhaseLinkWorkspace ws,
+                       int tid) noexcept nogil:
+    """ EMI: eigen vector of the smallest eigen value of |coh|^-1 o coh (Homa Ansari, 2018 paper).
+    Falls back to EVD if |coh| can not be regularized, |coh|^-1 o coh is left in ws.cmats[tid, 0] otherwise.
+    """
+    cdef int i, t, status, n = coh.shape[0]
+    cdef float complex[:, ::1] inverse_gam = ws.cmats[tid, 0, :n, :n]
+    cdef float complex[:, ::1] eig_mat = ws.cmats[tid, 1, :n, :n]
+    cdef float eig_value
+
+    status = emi_matrix_cy(coh, inverse_gam, ws.fmats[tid], ws.rwork[tid], ws.iwork[tid])
+    if status == 1:
+        ws.stats[tid, STAT_REGULARIZED] += 1
+    if status < 0:
+        return evd_kernel_cy(coh, lag, vec, ws, tid)
+    for i in range(n):
+        for t in range(n):
+            eig_mat[i, t] = inverse_gam[i, t]
+    return eigh_single_cy(eig_mat, EIG_SMALLEST, vec, &eig_value, ws.cwork[tid], ws.rwork[tid], ws.iwork[tid])
 
-        return res, squeezed, quality
-    else:
-        return res, 0, quality
 
+cdef int pta_kernel_cy(float complex[:, ::1] coh, int lag, float complex[::1] vec, PhaseLinkWorkspace ws,
+                       int tid) noexcept nogil:
+    """ PTA: coordinate descent of the PTA cost x^H (|coh|^-1 o coh) x from EMI, see pta_coordinate_descent_cy """
+    cdef int i, t, status, num_sweeps, n = coh.shape[0]
+    cdef float complex[:, ::1] inverse_gam = ws.cmats[tid, 0, :n, :n]
+    cdef float complex[:, ::1] eig_mat = ws.cmats[tid, 1, :n, :n]
+    cdef float complex[::1] x
+    cdef float complex x0
+    cdef float eig_value
 
-cdef inline tuple sequential_phase_linking_cy(float complex[:,::1] full_stack_complex_samples,
-                                        bytes method, int mini_stack_default_size,
-                                        int total_num_mini_stacks):
-    """ phase linking of each pixel sequentially and applying a datum shift at the end """
+    status = emi_matrix_cy(coh, inverse_gam, ws.fmats[tid], ws.rwork[tid], ws.iwork[tid])
+    if status == 1:
+        ws.stats[tid, STAT_REGULARIZED] += 1
+    if status < 0:
+        return evd_kernel_cy(coh, lag, vec, ws, tid)
+    for i in range(n):
+        for t in range(n):
+            eig_mat[i, t] = inverse_gam[i, t]
+    status = eigh_single_cy(eig_mat, EIG_SMALLEST, vec, &eig_value, ws.cwork[tid], ws.rwork[tid], ws.iwork[tid])
+    if status != 0:
+        return status
 
-    cdef int i, t, sstep, first_line, last_line, num_lines
-    cdef int a1, a2, ns = full_stack_complex_samples.shape[1]
-    cdef cnp.intp_t n_image = full_stack_complex_samples.shape[0]
-    cdef float complex[::1] vec_refined = np.zeros((n_image), dtype=np.complex64)
-    cdef float complex[:, ::1] mini_stack_complex_samples
-    cdef float complex[::1] res, squeezed_images_0
-    cdef float temp_quality, quality
-    cdef float complex[:, ::1] squeezed_images = np.zeros((total_num_mini_stacks,
-                                                           full_stack_complex_samples.shape[1]),
-                                                           dtype=np.complex64)
+    x = ws.cwork[tid, :n]
+    for i in range(n):
+        x[i] = unit_phasor_cy(vec[i])
+    num_sweeps = pta_coordinate_descent_cy(ws.cmats[tid, 0, :n, :n], x, PTA_TOLERANCE, PTA_MAX_ITERATIONS)
+    ws.stats[tid, STAT_PTA_INVERSIONS] += 1
+    ws.stats[tid, STAT_PTA_SWEEPS] += num_sweeps
+    ws.stats[tid, STAT_PTA_NOT_CONVERGED] += num_sweeps == PTA_MAX_ITERATIONS
 
-    quality = 0
-    temp_quality = 0
+    x0 = conjf(x[0])
+    for i in range(n):
+        vec[i] = cabsf(vec[i]) * x[i] * x0
+    return 0
 
-    for sstep in range(total_num_mini_stacks):
 
-        first_line = sstep * mini_stack_default_size
-        if sstep == total_num_mini_stacks - 1:
-            last_line = n_image
+cdef int stbas_kernel_cy(float complex[:, ::1] coh, int lag, float complex[::1] vec, PhaseLinkWorkspace ws,
+                         int tid) noexcept nogil:
+    """ StBAS: PTA of the coherence of the pairs less than lag images apart, solved in band storage by
+    stbas_phase_estimation_cy, EVD of the masked coherence if its |coh| can not be regularized.
+    """
+    cdef int i, t, status, n = coh.shape[0]
+    cdef float complex[:, ::1] masked_coh
+
+    if lag <= 0 or lag >= n:
+        return pta_kernel_cy(coh, lag, vec, ws, tid)
+    status = stbas_phase_estimation_cy(coh, lag, vec, ws.cmats[tid], ws.fmats[tid], ws.cwork[tid], ws.rwork[tid],
+                                       ws.iwork[tid], ws.stats[tid])
+    if status >= 0:
+        return status
+    masked_coh = ws.cmats[tid, 2, :n, :n]
+    for i in range(n):
+        for t in range(n):
+            masked_coh[i, t] = coh[i, t] if abs(i - t) < lag else 0
+    return evd_kernel_cy(masked_coh, lag, vec, ws, tid)
+
+
+cdef object estimator_capsule(phase_link_kernel_t kernel):
+    """ Wraps a phase linking kernel for register_phase_linking_estimator """
+    return PyCapsule_New(<void*>kernel, KERNEL_CAPSULE_NAME, NULL)
+
+
+def register_phase_linking_estimator(bytes name, object kernel, int needs):
+    """ Registers a phase linking estimator for process_patch_c and phase_linking_process_py.
+    The name is resolved once per patch to its kernel, so the pixels are dispatched without string comparisons.
+    Estimators of other extension modules cimport phase_link_kernel_t and estimator_capsule from this module and
+    register in the main process before the workers are started.
+    :param name: method name, sequential_<name> if the estimator can be used on mini stacks
+    :param kernel: capsule of a phase_link_kernel_t, see estimator_capsule
+    :param needs: sum of EstimatorNeeds flags
+    """
+    if name.startswith(b'sequential_'):
+        raise ValueError('the sequential_ prefix is added to estimators with ESTIMATOR_SEQUENTIAL')
+    PyCapsule_GetPointer(kernel, KERNEL_CAPSULE_NAME)
+    PHASE_LINKING_ESTIMATORS[name] = (kernel, needs)
+    return
+
+
+def phase_linking_estimators():
+    """ Names of the registered phase linking methods """
+    cdef list names = []
+    for name, (kernel, needs) in PHASE_LINKING_ESTIMATORS.items():
+        names.append(name.decode('UTF-8'))
+        if needs & ESTIMATOR_SEQUENTIAL:
+            names.append('sequential_' + name.decode('UTF-8'))
+    return names
+
+
+cdef estimator_t get_estimator_cy(bytes method) except *:
+    """ Resolves a registered phase linking method name, sequential_<name> for its sequential estimator """
+    cdef estimator_t estimator
+    cdef bytes name = method
+
+    estimator.sequential = method.startswith(b'sequential_')
+    if estimator.sequential:
+        name = method[11:]
+    if name not in PHASE_LINKING_ESTIMATORS or (estimator.sequential and
+                                               not PHASE_LINKING_ESTIMATORS[name][1] & ESTIMATOR_SEQUENTIAL):
+        raise ValueError('Unknown phase linking method {}, available: {}'.format(
+            method.decode('UTF-8'), ', '.join(phase_linking_estimators())))
+    kernel, estimator.needs = PHASE_LINKING_ESTIMATORS[name]
+    estimator.kernel = <phase_link_kernel_t>PyCapsule_GetPointer(kernel, KERNEL_CAPSULE_NAME)
+    return estimator
+
+
+register_phase_linking_estimator(b'EVD', estimator_capsule(evd_kernel_cy), ESTIMATOR_EIGEN_PAIR | ESTIMATOR_SEQUENTIAL)
+register_phase_linking_estimator(b'EMI', estimator_capsule(emi_kernel_cy),
+                                 ESTIMATOR_EMI_MATRIX | ESTIMATOR_EIGEN_PAIR | ESTIMATOR_SEQUENTIAL)
+register_phase_linking_estimator(b'PTA', estimator_capsule(pta_kernel_cy), ESTIMATOR_EMI_MATRIX | ESTIMATOR_SEQUENTIAL)
+register_phase_linking_estimator(b'StBAS', estimator_capsule(stbas_kernel_cy), ESTIMATOR_EMI_MATRIX | ESTIMATOR_BANDED)
+
+
+cdef inline double elapsed_cy(timespec* start) noexcept nogil:
+    """ Seconds since start, start is reset to now """
+    cdef timespec now
+    cdef double seconds
+
+    clock_gettime(CLOCK_MONOTONIC, &now)
+    seconds = (now.tv_sec - start.tv_sec) + (now.tv_nsec - start.tv_nsec) * 1e-9
+    start[0] = now
+    return seconds
+
+
+cdef inline int mini_stack_end_cy(int q, int num_stored, int num_squeezed, int mini_stack_size,
+                                  int n) noexcept nogil:
+    """ End of the images of squeezed image q of phase_linking_pixel_cy, num_stored for a stored compressed image
+    and n for the last mini stack and beyond """
+    if q < num_stored:
+        return num_stored
+    if q >= num_squeezed - 1:
+        return n
+    return num_stored + (q - num_stored + 1) * mini_stack_size
+
+
+cdef int phase_linking_pixel_cy(float complex[:, ::1] coh, float[::1] scale, estimator_t estimator, int lag,
+                                int mini_stack_size, int num_mini_stacks, int max_compressed, int num_stored,
+                                float complex[:, ::1] samples, int num_samples, float complex[::1] vec,
+                                float* quality, PhaseLinkWorkspace ws, int tid) noexcept nogil:
+    """ Phase linking of one pixel from its full stack coherence matrix without memory allocations.
+    Same as phase_linking_process_cy and sequential_phase_linking_cy followed by datum_connect_cy.
+    The coherence of the raw images of a mini stack is a block of the full stack coherence, the squeezed images
+    are linear combinations of the raw images, so their coherence is also found from the full stack coherence
+    and the image powers instead of from the samples.
+    :param coh: n x n full stack coherence matrix
+    :param scale: root mean power of each image, see sample_moments_cy
+    :param estimator: resolved by get_estimator_cy
+    :param lag: time lag of ESTIMATOR_BANDED estimators, the temporal coherence is on the pairs less than lag
+                images apart
+    :param max_compressed: number of previous compressed images in a mini stack, all if 0. Limits the mini stack
+                           size to max_compressed + mini_stack_size so the time per mini stack does not grow with
+                           the stack, the datum of all mini stacks is still connected with all compressed images
+    :param num_stored: number of compressed images of earlier inversions leading the stack, the mini stacks are
+                       the images after them. vec of a stored image is the datum shift of its mini stack
+    :param samples: the SHP samples of the pixel in its first num_samples columns, used with max_compressed > 0:
+                    coh is then only read for the images of the mini stacks up to max_compressed apart, see the
+                    lag of est_corr_batch_cy in process_patch_c, and the coherence of the squeezed images for the
+                    datum is estimated from their samples. num_samples = 0 to use the full coh instead
+    :param vec: estimated phase vector
+    :param quality: temporal coherence, average of the mini stacks for the sequential estimator
+    :param ws: work space, tid: its thread slice
+    Returns 0 on success, nonzero if the kernel failed
+    """
+    cdef int i, t, k, s, status, first_line, last_line, num_lines, m, c0, nc, n = coh.shape[0]
+    cdef int num_squeezed = num_stored + num_mini_stacks, reach
+    cdef bint from_samples = max_compressed > 0 and num_samples > 0
+    cdef float complex[:, ::1] mini_coh, zsamples
+    cdef timespec start
+    cdef float complex[:, ::1] weights, cross, squeezed
+    cdef float complex[::1] res
+    cdef float complex temp
+    cdef float norm
+
+    if not estimator.sequential:
+        status = estimator.kernel(coh, lag, vec, ws, tid)
+        quality[0] = gam_pta_banded_cy(coh, lag if estimator.needs & ESTIMATOR_BANDED and lag > 0 else n, vec)
+        return status
+
+    # squeezed image k is sum_i weights[k, i] y_i of the unit power images y_i = x_i / scale_i,
+    # cross[k, j] its covariance with y_j and squeezed[k, l] the covariance of two squeezed images
+    weights = ws.cvecs[tid, 0:num_squeezed]
+    cross = ws.cvecs[tid, num_squeezed:2 * num_squeezed]
+    res = ws.cvecs[tid, 2 * num_squeezed]
+    squeezed = ws.cmats[tid, 4]
+    quality[0] = 0
+    ws.stats[tid, STAT_SEQUENTIAL_PIXELS] += 1
+    clock_gettime(CLOCK_MONOTONIC, &start)
+
+    # the stored compressed images are squeezed images with unit power
+    for k in range(num_stored):
+        for i in range(num_stored):
+            squeezed[k, i] = coh[k, i]
+        reach = mini_stack_end_cy(k + max_compressed, num_stored, num_squeezed, mini_stack_size, n) \
+            if from_samples else n
+        for i in range(num_stored, reach):
+            cross[k, i] = coh[k, i]
+
+    for s in range(num_stored, num_squeezed):
+        first_line = num_stored + (s - num_stored) * mini_stack_size
+        if s == num_squeezed - 1:
+            last_line = n
         else:
-            last_line = first_line + mini_stack_default_size
+            last_line = first_line + mini_stack_size
         num_lines = last_line - first_line
+        # the compressed images c0, ..., s - 1 are carried to mini stack s
+        c0 = s - max_compressed if 0 < max_compressed < s else 0
+        nc = s - c0
+        m = nc + num_lines
+
+        mini_coh = ws.cmats[tid, 3, :m, :m]
+        for k in range(nc):
+            for i in range(k, nc):
+                mini_coh[k, i] = normalize_cov_cy(squeezed[c0 + k, c0 + i], squeezed[c0 + k, c0 + k],
+                                                  squeezed[c0 + i, c0 + i])
+                mini_coh[i, k] = conjf(mini_coh[k, i])
+            for t in range(num_lines):
+                mini_coh[k, nc + t] = normalize_cov_cy(cross[c0 + k, first_line + t], squeezed[c0 + k, c0 + k],
+                                                       coh[first_line + t, first_line + t])
+                mini_coh[nc + t, k] = conjf(mini_coh[k, nc + t])
+        for i in range(num_lines):
+            for t in range(num_lines):
+                mini_coh[nc + i, nc + t] = coh[first_line + i, first_line + t]
+
+        status = estimator.kernel(mini_coh, lag, res[:m], ws, tid)
+        if status != 0:
+            return status
+        quality[0] += gam_pta_coh_cy(mini_coh, res[:m])
+
+        # squeeze_images: the raw images weighted by the conjugate unit phasors of the estimate,
+        # their covariances are only needed with the images of the mini stacks they are carried to
+        norm = sqrtf(num_lines)
+        reach = mini_stack_end_cy(s + max_compressed, num_stored, num_squeezed, mini_stack_size, n) \
+            if from_samples else n
+        for t in range(num_lines):
+            vec[first_line + t] = res[nc + t]
+            weights[s, first_line + t] = conjf(unit_phasor_cy(res[nc + t])) * scale[first_line + t] / norm
+        for i in range(first_line, reach):
+            temp = 0
+            for t in range(num_lines):
+                temp = temp + weights[s, first_line + t] * coh[first_line + t, i]
+            cross[s, i] = temp
+        for k in range(s - max_compressed if from_samples and max_compressed < s else 0, s + 1):
+            temp = 0
+            for t in range(num_lines):
+                temp = temp + cross[k, first_line + t] * conjf(weights[s, first_line + t])
+            squeezed[k, s] = temp
+            squeezed[s, k] = conjf(temp)
+        ws.stack_time[tid, s - num_stored] += elapsed_cy(&start)
+
+    quality[0] /= num_mini_stacks
+
+    if from_samples:
+        # covariance of the squeezed images from their samples, the far apart mini stacks are not in coh
+        zsamples = ws.csamples[tid, :num_squeezed, :num_samples]
+        for k in range(num_squeezed):
+            for t in range(num_samples):
+                zsamples[k, t] = samples[k, t] / scale[k] if k < num_stored else 0
+        for s in range(num_stored, num_squeezed):
+            first_line = num_stored + (s - num_stored) * mini_stack_size
+            last_line = n if s == num_squeezed - 1 else first_line + mini_stack_size
+            for i in range(first_line, last_line):
+                for t in range(num_samples):
+                    zsamples[s, t] = zsamples[s, t] + weights[s, i] * samples[i, t] / scale[i]
+        for k in range(num_squeezed):
+            for i in range(k + 1):
+                temp = 0
+                for t in range(num_samples):
+                    temp = temp + zsamples[k, t] * conjf(zsamples[i, t])
+                squeezed[k, i] = temp / num_samples
+                squeezed[i, k] = conjf(squeezed[k, i])
+
+    # datum_connect_cy: EMI of the squeezed images gives the shift of each mini stack
+    mini_coh = ws.cmats[tid, 3, :num_squeezed, :num_squeezed]
+    for k in range(num_squeezed):
+        for i in range(num_squeezed):
+            mini_coh[k, i] = normalize_cov_cy(squeezed[k, i], squeezed[k, k], squeezed[i, i])
+    status = emi_kernel_cy(mini_coh, 0, res[:num_squeezed], ws, tid)
+    if status != 0:
+        return status
+    for k in range(num_stored):
+        vec[k] = unit_phasor_cy(res[k])
+    for s in range(num_stored, num_squeezed):
+        first_line = num_stored + (s - num_stored) * mini_stack_size
+        if s == num_squeezed - 1:
+            last_line = n
+        else:
+            last_line = first_line + mini_stack_size
+        for i in range(first_line, last_line):
+            vec[i] = vec[i] * unit_phasor_cy(res[s])
+    return 0
 
-        if sstep == 0:
 
-            mini_stack_complex_samples = np.zeros((num_lines, ns), dtype=np.complex64)
+cdef inline tuple phase_linking_process_cy(float complex[:, ::1] ccg_sample, int stepp, bytes method, bint squeez, int lag,
+                                           int[::1] inversion_stats=None, float complex[:, ::1] coh=None):
+    """Inversion of phase with a registered estimator (PTA, EVD, EMI, StBAS, ...), see phase_linking_estimators
+    :param coh: coherence matrix of ccg_sample if already estimated
+    """
 
-            for i in range(ns):
-                for t in range(num_lines):
-                    mini_stack_complex_samples[t, i] = full_stack_complex_samples[t, i]
+    cdef float complex[:, ::1] coh_mat
+    cdef float complex[::1] res
+    cdef float complex[::1] squeezed
+    cdef float quality
+    cdef int n = ccg_sample.shape[0], status
+    cdef estimator_t estimator = get_estimator_cy(method)
+    cdef PhaseLinkWorkspace ws = PhaseLinkWorkspace(n, 1, 1)
 
-            res, squeezed_images_0, temp_quality = phase_linking_process_cy(mini_stack_complex_samples, sstep, method, True, 0)
-            #res, squeezed_images_0 = phase_linking_process_cy(mini_stack_complex_samples, sstep, method, True, 0)
-        else:
+    if coh is None:
+        coh_mat = est_corr_cy(ccg_sample)
+    else:
+        coh_mat = coh
 
-            mini_stack_complex_samples = np.zeros((sstep + num_lines, ns), dtype=np.complex64)
+    res = np.zeros(n, dtype=np.complex64)
+    status = estimator.kernel(coh_mat, lag, res, ws, 0)
+    if status != 0:
+        raise RuntimeError('phase linking with {} failed'.format(method.decode('UTF-8')))
+    if inversion_stats is not None:
+        for n in range(NUM_STATS):
+            inversion_stats[n] += ws.stats[0, n]
 
-            for i in range(ns):
-                for t in range(sstep):
-                    mini_stack_complex_samples[t, i] = squeezed_images[t, i]
-                for t in range(num_lines):
-                    mini_stack_complex_samples[t + sstep, i] = full_stack_complex_samples[first_line + t, i]
+    quality = gam_pta_banded_cy(coh_mat, lag if estimator.needs & ESTIMATOR_BANDED and lag > 0 else res.shape[0],
+                                res)
 
-            res, squeezed_images_0, temp_quality = phase_linking_process_cy(mini_stack_complex_samples, sstep, method, True, 0)
-            #res, squeezed_images_0 = phase_linking_process_cy(mini_stack_complex_samples, sstep, method, True, 0)
+    if squeez:
+        squeezed = squeeze_images(res, ccg_sample, stepp)
 
-        quality += temp_quality
+        return res, squeezed, quality
+    else:
+        return res, 0, quality
 
-        for i in range(num_lines):
-            vec_refined[first_line + i] = res[sstep + i]
 
-        for i in range(squeezed_images_0.shape[0]):
-                squeezed_images[sstep, i] = squeezed_images_0[i]
+cpdef tuple phase_linking_process_py(float complex[:, ::1] ccg_sample, int stepp, bytes method, bint squeez, int lag):
+    """Inversion of phase with a registered estimator (PTA, EVD, EMI, StBAS, ...), see phase_linking_estimators """
+    return phase_linking_process_cy(ccg_sample, stepp, method, squeez, lag)
 
-    quality /= total_num_mini_stacks
 
-    return vec_refined, squeezed_images, quality
+cpdef tuple phase_linking_coh_py(float complex[:, ::1] coh, float[::1] scale, bytes method, int lag=0,
+                                 int mini_stack_size=10, int max_compressed=0):
+    """ Phase linking of one pixel from its full stack coherence matrix and the root mean power of its images,
+    as saved in coherence_matrix.h5, same as process_patch_c without the SHP samples
+    :param max_compressed: compressed images carried to each mini stack of the sequential methods, all if 0
+    :return: phase vector (datum connected for the sequential methods), temporal coherence
+    """
+    cdef int n = coh.shape[0], status
+    cdef estimator_t estimator = get_estimator_cy(method)
+    cdef int num_mini_stacks = max(1, n // mini_stack_size) if estimator.sequential else 1
+    cdef PhaseLinkWorkspace ws = PhaseLinkWorkspace(n, num_mini_stacks, 1)
+    cdef float complex[::1] vec = np.zeros(n, dtype=np.complex64)
+    cdef float quality = 0
 
+    status = phase_linking_pixel_cy(coh, scale, estimator, lag, mini_stack_size, num_mini_stacks, max_compressed, 0,
+                                    coh, 0, vec, &quality, ws, 0)
+    if status != 0:
+        raise RuntimeError('phase linking with {} failed'.format(method.decode('UTF-8')))
+    return np.asarray(vec), quality
 
-cpdef tuple sequential_phase_linking_py(float complex[:,::1] full_stack_complex_samples,
+
+cdef inline tuple sequential_phase_linking_cy(float complex[:,::1] full_stack_complex_samples,
                                         bytes method, int mini_stack_default_size,
-                                        int total_num_mini_stacks):
-    """ phase linking of each pixel sequentially and applying a datum shift at the end """
+                                        int total_num_mini_stacks, int[::1] inversion_stats=None,
+                                        int max_compressed=0):
+    """ phase linking of each pixel sequentially and applying a datum shift at the end,
+    max_compressed > 0 limits the compressed images carried forward to each mini stack """
 
-    cdef int i, t, sstep, first_line, last_line, num_lines
+    cdef int i, t, sstep, first_line, last_line, num_lines, c0, nc
     cdef int a1, a2, ns = full_stack_complex_samples.shape[1]
     cdef cnp.intp_t n_image = full_stack_complex_samples.shape[0]
     cdef float complex[::1] vec_refined = np.zeros((n_image), dtype=np.complex64)
     cdef float complex[:, ::1] mini_stack_complex_samples
     cdef float complex[::1] res, squeezed_images_0
-    cdef float  temp_quality, quality
+    cdef float temp_quality, quality
     cdef float complex[:, ::1] squeezed_images = np.zeros((total_num_mini_stacks,
                                                            full_stack_complex_samples.shape[1]),
                                                            dtype=np.complex64)
@@ -687,34 +1530,25 @@ cpdef tuple sequential_phase_linking_py(float complex[:,::1] full_stack_complex_
         else:
             last_line = first_line + mini_stack_default_size
         num_lines = last_line - first_line
+        # only the last max_compressed compressed images are carried forward
+        c0 = sstep - max_compressed if 0 < max_compressed < sstep else 0
+        nc = sstep - c0
 
-        if sstep == 0:
-
-            mini_stack_complex_samples = np.zeros((num_lines, ns), dtype=np.complex64)
-
-            for i in range(ns):
-                for t in range(num_lines):
-                    mini_stack_complex_samples[t, i] = full_stack_complex_samples[t, i]
+        mini_stack_complex_samples = np.zeros((nc + num_lines, ns), dtype=np.complex64)
 
-            res, squeezed_images_0, temp_quality = phase_linking_process_cy(mini_stack_complex_samples, sstep, method, True, 0)
-            #res, squeezed_images_0 = phase_linking_process_cy(mini_stack_complex_samples, sstep, method, True, 0)
-        else:
-
-            mini_stack_complex_samples = np.zeros((sstep + num_lines, ns), dtype=np.complex64)
-
-            for i in range(ns):
-                for t in range(sstep):
-                    mini_stack_complex_samples[t, i] = squeezed_images[t, i]
-                for t in range(num_lines):
-                    mini_stack_complex_samples[t + sstep, i] = full_stack_complex_samples[first_line + t, i]
+        for i in range(ns):
+            for t in range(nc):
+                mini_stack_complex_samples[t, i] = squeezed_images[c0 + t, i]
+            for t in range(num_lines):
+                mini_stack_complex_samples[t + nc, i] = full_stack_complex_samples[first_line + t, i]
 
-            res, squeezed_images_0, temp_quality = phase_linking_process_cy(mini_stack_complex_samples, sstep, method, True, 0)
-            #res, squeezed_images_0 = phase_linking_process_cy(mini_stack_complex_samples, sstep, method, True, 0)
+        res, squeezed_images_0, temp_quality = phase_linking_process_cy(mini_stack_complex_samples, nc, method, True, 0,
+                                                                        inversion_stats)
 
         quality += temp_quality
 
         for i in range(num_lines):
-            vec_refined[first_line + i] = res[sstep + i]
+            vec_refined[first_line + i] = res[nc + i]
 
         for i in range(squeezed_images_0.shape[0]):
                 squeezed_images[sstep, i] = squeezed_images_0[i]
@@ -724,6 +1558,14 @@ cpdef tuple sequential_phase_linking_py(float complex[:,::1] full_stack_complex_
     return vec_refined, squeezed_images, quality
 
 
+cpdef tuple sequential_phase_linking_py(float complex[:,::1] full_stack_complex_samples,
+                                        bytes method, int mini_stack_default_size,
+                                        int total_num_mini_stacks, int max_compressed=0):
+    """ phase linking of each pixel sequentially and applying a datum shift at the end,
+    max_compressed > 0 limits the compressed images carried forward to each mini stack """
+    return sequential_phase_linking_cy(full_stack_complex_samples, method, mini_stack_default_size,
+                                       total_num_mini_stacks, None, max_compressed)
+
 
 cdef inline float complex[::1] datum_connect_cy(float complex[:, ::1] squeezed_images,
                                         float complex[::1] vector_refined, int mini_stack_size):
@@ -843,7 +1685,8 @@ cdef void sorting(cnp.ndarray[float, ndim=1] x):
     return
 
 
-cdef float ecdf_distance(cnp.ndarray[float, ndim=1] data1, cnp.ndarray[float, ndim=1] data2):
+cpdef float ecdf_distance_loop_py(cnp.ndarray[float, ndim=1] data1, cnp.ndarray[float, ndim=1] data2):
+    """ Reference KS distance of two sorted samples searching the union of the samples, O(n^2) """
     cdef cnp.ndarray[float, ndim=1] data_all = concat_cy(data1, data2)
     cdef float distance
     sorting(data_all)
@@ -852,7 +1695,7 @@ cdef float ecdf_distance(cnp.ndarray[float, ndim=1] data1, cnp.ndarray[float, nd
     return distance
 
 
-cdef inline float ks_lut_cy(int N1, int N2, float alpha):
+cpdef float ks_lut_cy(int N1, int N2, float alpha):
     cdef float N = (N1 * N2) / (N1 + N2)
     cdef float[::1] distances = np.arange(0.01, 1, 0.001, dtype=np.float32)
     cdef float value, pvalue, critical_distance = 0.1
@@ -885,15 +1728,284 @@ cdef cnp.ndarray[float, ndim=1] concat_cy(cnp.ndarray[float, ndim=1] x, cnp.ndar
 
 
 
-cdef int count(cnp.ndarray[long, ndim=2]  x, long value):
-    cdef int n1 = x.shape[0]
-    cdef int n2 = x.shape[1]
-    cdef int i, t, out = 0
-    for i in range(n1):
-        for t in range(n2):
-            if x[i, t] == value:
-                out += 1
-    return out
+cdef int compare_float(const void* a, const void* b) noexcept nogil:
+    cdef float x = (<float*>a)[0]
+    cdef float y = (<float*>b)[0]
+    return (x > y) - (x < y)
+
+
+cdef float ks_distance_cy(float* x1, float* x2, int n1, int n2, float distance_threshold) noexcept nogil:
+    """ Kolmogorov-Smirnov distance of two sorted samples, both are walked once in a merge.
+    The distance is returned as soon as it exceeds distance_threshold, pass 1 to get the exact distance.
+    """
+    cdef int i = 0, t = 0
+    cdef double value, distance, out = 0
+
+    while i < n1 and t < n2:
+        value = min(x1[i], x2[t])
+        while i < n1 and x1[i] <= value:
+            i += 1
+        while t < n2 and x2[t] <= value:
+            t += 1
+        distance = fabs(<double>i * n2 - <double>t * n1) / (<double>n1 * n2)
+        if distance > out:
+            out = distance
+            if out > distance_threshold:
+                break
+    return <float>out
+
+
+cdef void ks_window_test_cy(float complex[:, :, ::1] input_slc, int row_0, int col_0, int[::1] def_sample_rows,
+                            int[::1] def_sample_cols, float distance_threshold, int[:, ::1] test_mask,
+                            float[::1] buffer) noexcept nogil:
+    """ Kolmogorov-Smirnov test of the amplitude of each pixel in the window against the center pixel.
+    :param test_mask: window sized output, 1 where the test passes, 0 where it fails or outside of the image
+    """
+    cdef int i, t, m, row, col, n_image = input_slc.shape[0]
+    cdef float* ref = &buffer[0]
+    cdef float* test = &buffer[n_image]
+
+    for m in range(n_image):
+        ref[m] = cabsf(input_slc[m, row_0, col_0])
+    qsort(ref, n_image, sizeof(float), compare_float)
+
+    for i in range(def_sample_rows.shape[0]):
+        row = row_0 + def_sample_rows[i]
+        for t in range(def_sample_cols.shape[0]):
+            col = col_0 + def_sample_cols[t]
+            test_mask[i, t] = 0
+            if row < 0 or row >= input_slc.shape[1] or col < 0 or col >= input_slc.shape[2]:
+                continue
+            for m in range(n_image):
+                test[m] = cabsf(input_slc[m, row, col])
+            qsort(test, n_image, sizeof(float), compare_float)
+            if ks_distance_cy(ref, test, n_image, n_image, distance_threshold) <= distance_threshold:
+                test_mask[i, t] = 1
+    return
+
+
+cdef float* sorted_amplitude_cy(float[:, :, ::1] amp_sorted, float complex[:, :, ::1] input_slc, bint use_amp_cache,
+                                int row, int col, float* buffer) noexcept nogil:
+    """ Time sorted amplitude of a pixel, from the cache if it is used otherwise sorted in buffer """
+    cdef int m, n_image = input_slc.shape[0]
+    if use_amp_cache:
+        return &amp_sorted[row, col, 0]
+    for m in range(n_image):
+        buffer[m] = cabsf(input_slc[m, row, col])
+    qsort(buffer, n_image, sizeof(float), compare_float)
+    return buffer
+
+
+cdef void ks_pair_test_cy(float[:, :, ::1] amp_sorted, float complex[:, :, ::1] input_slc, bint use_amp_cache,
+                          unsigned char[:, ::1] center, int row_0, int[::1] def_sample_rows, int[::1] def_sample_cols,
+                          int reference_row, int reference_col, float distance_threshold,
+                          unsigned char[:, :, ::1] pair_test, float[::1] buffer) noexcept nogil:
+    """ Kolmogorov-Smirnov test of the pixels of a row against the neighbours after them in the window.
+    The neighbours before them are the same pairs seen from the other pixel, pairs without a center pixel are skipped.
+    :param pair_test: length x width x ceil(half window size / 8) bit packed output, see window_from_pairs_cy
+    :param buffer: work space of size 2 * n_image
+    """
+    cdef int i, t, k, col_0, row, col, n_image = input_slc.shape[0]
+    cdef int ref_index = reference_row * def_sample_cols.shape[0] + reference_col
+    cdef float* ref
+    cdef float* test
+
+    for col_0 in range(center.shape[1]):
+        for k in range(pair_test.shape[2]):
+            pair_test[row_0, col_0, k] = 0
+        ref = NULL
+        for i in range(reference_row, def_sample_rows.shape[0]):
+            row = row_0 + def_sample_rows[i]
+            for t in range(def_sample_cols.shape[0]):
+                col = col_0 + def_sample_cols[t]
+                k = i * def_sample_cols.shape[0] + t - ref_index - 1
+                if k < 0 or row >= center.shape[0] or col < 0 or col >= center.shape[1]:
+                    continue
+                if not (center[row_0, col_0] or center[row, col]):
+                    continue
+                if ref == NULL:
+                    ref = sorted_amplitude_cy(amp_sorted, input_slc, use_amp_cache, row_0, col_0, &buffer[0])
+                test = sorted_amplitude_cy(amp_sorted, input_slc, use_amp_cache, row, col, &buffer[n_image])
+                if ks_distance_cy(ref, test, n_image, n_image, distance_threshold) <= distance_threshold:
+                    pair_test[row_0, col_0, k >> 3] |= 1 << (k & 7)
+    return
+
+
+cdef void pair_test_cy(cnp.ndarray[float, ndim=3] amp_sorted, float complex[:, :, ::1] input_slc, bint use_amp_cache,
+                       unsigned char[:, ::1] center, int row_0, int[::1] def_sample_rows, int[::1] def_sample_cols,
+                       int reference_row, int reference_col, float distance_threshold, bytes shp_test,
+                       unsigned char[:, :, ::1] pair_test):
+    """ Anderson-Darling or t-test of the pixels of a row against the neighbours after them in the window """
+    cdef int i, t, k, col_0, row, col, res
+    cdef int ref_index = reference_row * def_sample_cols.shape[0] + reference_col
+    cdef cnp.ndarray[float, ndim=1] ref, test
+
+    for col_0 in range(center.shape[1]):
+        for k in range(pair_test.shape[2]):
+            pair_test[row_0, col_0, k] = 0
+        ref = None
+        for i in range(reference_row, def_sample_rows.shape[0]):
+            row = row_0 + def_sample_rows[i]
+            for t in range(def_sample_cols.shape[0]):
+                col = col_0 + def_sample_cols[t]
+                k = i * def_sample_cols.shape[0] + t - ref_index - 1
+                if k < 0 or row >= center.shape[0] or col < 0 or col >= center.shape[1]:
+                    continue
+                if not (center[row_0, col_0] or center[row, col]):
+                    continue
+                if ref is None:
+                    ref = amp_sorted[row_0, col_0] if use_amp_cache else np.sort(np.abs(input_slc[:, row_0, col_0]))
+                test = amp_sorted[row, col] if use_amp_cache else np.sort(np.abs(input_slc[:, row, col]))
+                if shp_test == b'ad':
+                    res = ADtest_cy(ref, test, distance_threshold)
+                else:
+                    res = ttest_indtest_cy(ref, test, distance_threshold)
+                if res:
+                    pair_test[row_0, col_0, k >> 3] |= 1 << (k & 7)
+    return
+
+
+cdef void window_from_pairs_cy(unsigned char[:, :, ::1] pair_test, int row_0, int col_0, int[::1] def_sample_rows,
+                               int[::1] def_sample_cols, int reference_row, int reference_col,
+                               int[:, ::1] test_mask) noexcept nogil:
+    """ Window test of a center pixel from the pair decisions, each unordered pair is stored once:
+    the k-th offset after the reference in the window at the first pixel of the pair and
+    the k-th offset before the reference at the neighbour.
+    """
+    cdef int i, t, k, index, row, col
+    cdef int ref_index = reference_row * def_sample_cols.shape[0] + reference_col
+
+    for i in range(def_sample_rows.shape[0]):
+        row = row_0 + def_sample_rows[i]
+        for t in range(def_sample_cols.shape[0]):
+            col = col_0 + def_sample_cols[t]
+            test_mask[i, t] = 0
+            if row < 0 or row >= pair_test.shape[0] or col < 0 or col >= pair_test.shape[1]:
+                continue
+            index = i * def_sample_cols.shape[0] + t
+            if index > ref_index:
+                k = index - ref_index - 1
+                test_mask[i, t] = (pair_test[row_0, col_0, k >> 3] >> (k & 7)) & 1
+            elif index < ref_index:
+                k = ref_index - index - 1
+                test_mask[i, t] = (pair_test[row, col, k >> 3] >> (k & 7)) & 1
+            else:
+                test_mask[i, t] = 1
+    return
+
+
+cdef void window_test_cy(float complex[:, :, ::1] input_slc, int row_0, int col_0, int[::1] def_sample_rows,
+                         int[::1] def_sample_cols, float distance_threshold, bytes shp_test, int[:, ::1] test_mask):
+    """ Anderson-Darling or t-test of the amplitude of each pixel in the window against the center pixel. """
+    cdef int i, t, m, row, col, n_image = input_slc.shape[0]
+    cdef cnp.ndarray[float, ndim=1] ref = np.zeros(n_image, dtype=np.float32)
+    cdef cnp.ndarray[float, ndim=1] test
+
+    for m in range(n_image):
+        ref[m] = cabsf(input_slc[m, row_0, col_0])
+    sorting(ref)
+
+    for i in range(def_sample_rows.shape[0]):
+        row = row_0 + def_sample_rows[i]
+        for t in range(def_sample_cols.shape[0]):
+            col = col_0 + def_sample_cols[t]
+            test_mask[i, t] = 0
+            if row < 0 or row >= input_slc.shape[1] or col < 0 or col >= input_slc.shape[2]:
+                continue
+            test = np.zeros(n_image, dtype=np.float32)
+            for m in range(n_image):
+                test[m] = cabsf(input_slc[m, row, col])
+            sorting(test)
+            if shp_test == b'ad':
+                test_mask[i, t] = ADtest_cy(ref, test, distance_threshold)
+            else:
+                test_mask[i, t] = ttest_indtest_cy(ref, test, distance_threshold)
+    return
+
+
+cdef int shp_flood_fill_cy(int[:, ::1] test_mask, int row_0, int col_0, int[::1] def_sample_rows,
+                           int[::1] def_sample_cols, int reference_row, int reference_col,
+                           int[:, ::1] shp) noexcept nogil:
+    """ SHPs are the pixels passing the test and connected to the center pixel (8-connectivity), found by a flood
+    fill from the reference pixel that marks them with 2 in test_mask.
+    :param shp: work space of window size x 2, holds the row/col of the SHPs on return
+    :return: number of SHPs
+    """
+    cdef int i, t, i1, t1, top, num_shp = 0
+    cdef int num_rows = def_sample_rows.shape[0], num_cols = def_sample_cols.shape[0]
+
+    # the center pixel is always its own SHP
+    test_mask[reference_row, reference_col] = 2
+    shp[0, 0] = reference_row
+    shp[0, 1] = reference_col
+    top = 1
+    while top > 0:
+        top -= 1
+        i = shp[top, 0]
+        t = shp[top, 1]
+        for i1 in range(max(i - 1, 0), min(i + 2, num_rows)):
+            for t1 in range(max(t - 1, 0), min(t + 2, num_cols)):
+                if test_mask[i1, t1] == 1:
+                    test_mask[i1, t1] = 2
+                    shp[top, 0] = i1
+                    shp[top, 1] = t1
+                    top += 1
+
+    for i in range(num_rows):
+        for t in range(num_cols):
+            if test_mask[i, t] == 2:
+                shp[num_shp, 0] = row_0 + def_sample_rows[i]
+                shp[num_shp, 1] = col_0 + def_sample_cols[t]
+                num_shp += 1
+    return num_shp
+
+
+cdef void shp_to_mask_cy(int[:, ::1] test_mask, unsigned char[::1] shp_mask) noexcept nogil:
+    """ Packs the SHPs marked with 2 by shp_flood_fill_cy, window pixel i * num_cols + t is bit (i * num_cols + t) % 8
+    of byte (i * num_cols + t) // 8 """
+    cdef int i, t, bit, num_cols = test_mask.shape[1]
+
+    for i in range(shp_mask.shape[0]):
+        shp_mask[i] = 0
+    for i in range(test_mask.shape[0]):
+        for t in range(num_cols):
+            if test_mask[i, t] == 2:
+                bit = i * num_cols + t
+                shp_mask[bit >> 3] |= 1 << (bit & 7)
+    return
+
+
+cdef int shp_from_mask_cy(unsigned char[::1] shp_mask, int row_0, int col_0, int[::1] def_sample_rows,
+                          int[::1] def_sample_cols, int[:, ::1] shp) noexcept nogil:
+    """ Row/col of the SHPs of a pixel from its packed window mask, in the order of shp_flood_fill_cy
+    :return: number of SHPs
+    """
+    cdef int i, t, bit, num_shp = 0, num_cols = def_sample_cols.shape[0]
+
+    for i in range(def_sample_rows.shape[0]):
+        for t in range(num_cols):
+            bit = i * num_cols + t
+            if shp_mask[bit >> 3] & (1 << (bit & 7)):
+                shp[num_shp, 0] = row_0 + def_sample_rows[i]
+                shp[num_shp, 1] = col_0 + def_sample_cols[t]
+                num_shp += 1
+    return num_shp
+
+
+cpdef str shp_cache_key(bytes shp_test, float distance_threshold, int azimuth_window, int range_window, int n_image):
+    """ Name of the packed SHP masks in the SHP cache, the SHPs depend only on the test, its threshold,
+    the window and the images """
+    return '{}_{:.6g}_{}x{}_{}'.format(shp_test.decode('UTF-8'), distance_threshold, azimuth_window, range_window,
+                                       n_image)
+
+
+cdef int[:, ::1] shp_from_test_cy(int[:, ::1] test_mask, int row_0, int col_0, int[::1] def_sample_rows,
+                                  int[::1] def_sample_cols, int reference_row, int reference_col):
+    """ Row/col of the SHPs of a pixel from its window test """
+    cdef int[:, ::1] shps = np.zeros((def_sample_rows.shape[0] * def_sample_cols.shape[0], 2), dtype=np.int32)
+    cdef int num_shp = shp_flood_fill_cy(test_mask, row_0, col_0, def_sample_rows, def_sample_cols,
+                                         reference_row, reference_col, shps)
+    return shps[0:num_shp]
 
 
 cdef int[:, ::1] get_shp_row_col_c((int, int) data, float complex[:, :, ::1] input_slc,
@@ -901,97 +2013,19 @@ cdef int[:, ::1] get_shp_row_col_c((int, int) data, float complex[:, :, ::1] inp
                         int azimuth_window, int range_window, int reference_row,
                         int reference_col, float distance_threshold, bytes shp_test):
 
-    cdef int row_0, col_0, i, temp, ref_row, ref_col, t1, t2, s_rows, s_cols
-    cdef long ref_label
-    cdef cnp.intp_t width, length, n_image = input_slc.shape[0]
-    cdef int[::1] sample_rows, sample_cols
-    cdef cnp.ndarray[long, ndim=2] ks_label, distance
-    cdef int[:, ::1] shps
-    cdef cnp.ndarray[float, ndim=1] ref = np.zeros(n_image, dtype=np.float32)
-    cdef cnp.ndarray[float, ndim=1] test = np.zeros(n_image, dtype=np.float32)
-
-    row_0 = data[0]
-    col_0 = data[1]
-    length = input_slc.shape[1]
-    width = input_slc.shape[2]
-    t1 = 0
-    t2 = def_sample_rows.shape[0]
-    for i in range(def_sample_rows.shape[0]):
-        temp = row_0 + def_sample_rows[i]
-        if temp < 0:
-            t1 += 1
-        if temp >= length:
-            t2 = i
-            break
-    s_rows = t2 - t1
-    ref_row = reference_row - t1
-
-    sample_rows = np.zeros(s_rows, dtype=np.int32)
-    for i in range(s_rows):
-        sample_rows[i] = row_0 + def_sample_rows[i + t1]
-
-    t1 = 0
-    t2 = def_sample_cols.shape[0]
-    for i in range(def_sample_cols.shape[0]):
-        temp = col_0 + def_sample_cols[i]
-        if temp < 0:
-            t1 += 1
-        if temp >= width:
-            t2 = i
-            break
-    s_cols = t2 - t1
-    ref_col = reference_col - t1
-
-    sample_cols = np.zeros((s_cols), dtype=np.int32)
-    for i in range(s_cols):
-        sample_cols[i] = col_0 + def_sample_cols[i + t1]
+    cdef int[:, ::1] test_mask = np.zeros((def_sample_rows.shape[0], def_sample_cols.shape[0]), dtype=np.int32)
+    cdef float[::1] buffer
 
-    for i in range(n_image):
-        ref[i] = cabsf(input_slc[i, row_0, col_0])
-    sorting(ref)
-    distance = np.zeros((s_rows, s_cols), dtype='long')
-
-    if shp_test == b'ad':
-        for t1 in range(s_rows):
-            for t2 in range(s_cols):
-                test = np.zeros(n_image, dtype=np.float32)
-                for temp in range(n_image):
-                    test[temp] = cabsf(input_slc[temp, sample_rows[t1], sample_cols[t2]])
-                sorting(test)
-                distance[t1, t2] = ADtest_cy(ref, test, distance_threshold)
-
-    elif shp_test == b'ttest':
-        for t1 in range(s_rows):
-            for t2 in range(s_cols):
-                test = np.zeros(n_image, dtype=np.float32)
-                for temp in range(n_image):
-                    test[temp] = cabsf(input_slc[temp, sample_rows[t1], sample_cols[t2]])
-                sorting(test)
-                distance[t1, t2] = ttest_indtest_cy(ref, test, distance_threshold)
+    if shp_test == b'ad' or shp_test == b'ttest':
+        window_test_cy(input_slc, data[0], data[1], def_sample_rows, def_sample_cols, distance_threshold,
+                       shp_test, test_mask)
     else:
-        for t1 in range(s_rows):
-            for t2 in range(s_cols):
-                test = np.zeros(n_image, dtype=np.float32)
-                for temp in range(n_image):
-                    test[temp] = cabsf(input_slc[temp, sample_rows[t1], sample_cols[t2]])
-                sorting(test)
-                distance[t1, t2] = ks2smapletest_cy(ref, test, distance_threshold)
-
-    ks_label = clabel(distance, connectivity=2)
-    ref_label = ks_label[ref_row, ref_col]
-
-    temp = count(ks_label, ref_label)
-    shps = np.zeros((temp, 2), dtype=np.int32)
-
-    temp = 0
-    for t1 in range(s_rows):
-        for t2 in range(s_cols):
-            if ks_label[t1, t2] == ref_label:
-
-                shps[temp, 0] = sample_rows[t1]
-                shps[temp, 1] = sample_cols[t2]
-                temp += 1
-    return shps
+        buffer = np.zeros(2 * input_slc.shape[0], dtype=np.float32)
+        ks_window_test_cy(input_slc, data[0], data[1], def_sample_rows, def_sample_cols, distance_threshold,
+                          test_mask, buffer)
+
+    return shp_from_test_cy(test_mask, data[0], data[1], def_sample_rows, def_sample_cols, reference_row,
+                            reference_col)
 
 cdef inline float[::1] mean_along_axis_x(float[:, ::1] x):
     cdef int i, t, n = x.shape[0]
@@ -1025,6 +2059,67 @@ cdef inline float gam_pta_c(float[:, ::1] ph_filt, float complex[::1] vec):
     return temp_coh
 
 
+cdef inline float complex unit_phasor_cy(float complex x) noexcept nogil:
+    """ x / |x|, 1 where the phase is not defined like cargf_r """
+    cdef float amp = cabsf(x)
+    if amp == 0 or isnan(amp):
+        return 1
+    return x / amp
+
+
+cdef inline float gam_pta_coh_cy(float complex[:, ::1] coh_mat, float complex[::1] vec) noexcept nogil:
+    """ Returns squeesar PTA coherence between the coherence matrix and the estimated phase vector.
+    Same as gam_pta_c computed as Re(u^H (coh / |coh|) u) over the upper triangle, u = vec / |vec|,
+    without phase differences and complex exponentials.
+    """
+    cdef int i, k, n = vec.shape[0]
+    cdef float complex temp
+    cdef float out = 0
+
+    for i in range(n - 1):
+        temp = 0
+        for k in range(i + 1, n):
+            temp = temp + unit_phasor_cy(coh_mat[i, k]) * unit_phasor_cy(vec[k])
+        out += crealf(conjf(unit_phasor_cy(vec[i])) * temp)
+
+    return out * 2 / (n * n - n)
+
+
+cdef inline float gam_pta_band_cy(float complex[:, ::1] coh_mat, int lag, float complex[::1] vec) noexcept nogil:
+    """ gam_pta_coh_cy averaged over the pairs of images less than lag apart, the ones of a coherence matrix
+    estimated with a lag (est_corr_batch_cy). Unlike gam_pta_banded_cy the other pairs are left out.
+    """
+    cdef int i, k, num_pairs = 0, n = vec.shape[0]
+    cdef float complex temp
+    cdef float out = 0
+
+    for i in range(n - 1):
+        temp = 0
+        for k in range(i + 1, min(n, i + lag)):
+            temp = temp + unit_phasor_cy(coh_mat[i, k]) * unit_phasor_cy(vec[k])
+        out += crealf(conjf(unit_phasor_cy(vec[i])) * temp)
+        num_pairs += min(n, i + lag) - i - 1
+
+    return out / max(num_pairs, 1)
+
+
+cdef void gam_pta_batch_cy(float complex[:, :, ::1] coh_mats, float complex[:, ::1] vecs, float[::1] quality,
+                           int num_threads) noexcept nogil:
+    """ squeesar PTA coherence of a stack of pixels, see gam_pta_coh_cy """
+    cdef cnp.intp_t p
+
+    for p in prange(coh_mats.shape[0], nogil=True, num_threads=num_threads, schedule='static'):
+        quality[p] = gam_pta_coh_cy(coh_mats[p], vecs[p])
+    return
+
+
+cpdef cnp.ndarray gam_pta_batch_py(float complex[:, :, ::1] coh_mats, float complex[:, ::1] vecs, int num_threads=1):
+    """ squeesar PTA coherence of a stack of pixels """
+    cdef float[::1] quality = np.zeros(coh_mats.shape[0], dtype=np.float32)
+    gam_pta_batch_cy(coh_mats, vecs, quality, num_threads)
+    return np.asarray(quality)
+
+
 cdef float complex[:, ::1] normalize_samples(float complex[:, ::1] X):
     cdef float[:, ::1] amp = absmat2(X)
     cdef float[::1] norma = np.zeros(X.shape[1], dtype=np.float32)
@@ -1044,11 +2139,109 @@ cdef float complex[:, ::1] normalize_samples(float complex[:, ::1] X):
     return y
 
 
+cpdef cnp.ndarray amplitude_dispersion_py(cnp.ndarray slc):
+    """ Amplitude dispersion (std / mean of the amplitude along the first axis) of each pixel of an SLC stack,
+    nan where the amplitude is zero.
+    """
+    cdef cnp.ndarray amplitude = np.abs(slc)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (np.std(amplitude, axis=0) / np.mean(amplitude, axis=0)).astype(np.float32)
+
+
+cpdef cnp.ndarray compress_slc_py(cnp.ndarray phase_ref, cnp.ndarray slc, int mini_stack_size, int num_mini_stacks):
+    """ Compressed SLC of each mini stack: its images weighted by the conjugate unit phasors of the inverted
+    phases, as squeeze_images for the pixel itself. The compressed SLCs replace the inverted images when new
+    images are added to the inversion.
+    :param phase_ref: inverted phase series of the patch (n_image, length, width)
+    :param slc: SLCs of the patch (n_image, length, width)
+    """
+    cdef int s, first_line, last_line
+    cdef cnp.ndarray compressed = np.zeros((num_mini_stacks, slc.shape[1], slc.shape[2]), dtype=np.complex64)
+
+    for s in range(num_mini_stacks):
+        first_line = s * mini_stack_size
+        if s == num_mini_stacks - 1:
+            last_line = slc.shape[0]
+        else:
+            last_line = first_line + mini_stack_size
+        compressed[s] = np.sum(np.exp(-1j * np.angle(phase_ref[first_line:last_line])) * slc[first_line:last_line],
+                               axis=0) / np.sqrt(last_line - first_line)
+    return compressed
+
+
+cpdef void write_patch_file(str file_name, cnp.ndarray rslc_ref, cnp.ndarray SHP, cnp.ndarray tempCoh,
+                            cnp.ndarray mask_ps):
+    """ Writes the phase, amplitude, SHPs, temporal coherence and PS mask of a patch to its HDF5 file, the source
+    of the virtual datasets of phase_series.h5 and maskPS.h5, see CPhaseLink.unpatch_virtual """
+    cdef object f
+    with h5py.File(file_name, 'w') as f:
+        f.create_dataset('phase', data=np.angle(rslc_ref), chunks=True)
+        f.create_dataset('amplitude', data=np.abs(rslc_ref), chunks=True)
+        f.create_dataset('shp', data=SHP.astype(np.int32), chunks=True)
+        f.create_dataset('temporalCoherence', data=np.maximum(tempCoh, 0), chunks=True)
+        f.create_dataset('mask', data=mask_ps.astype(np.int32), chunks=True)
+    return
+
+
+cdef void write_patch_outputs(bytes out_folder, cnp.ndarray rslc_ref, cnp.ndarray SHP, cnp.ndarray tempCoh,
+                              cnp.ndarray mask_ps, cnp.ndarray amp_dispersion, object compressed_slc,
+                              int num_compressed, object shp_mask, object box, object output_queue,
+                              bint patch_file):
+    """ Saves the outputs of a patch and its completion flag.
+    The first num_compressed images of rslc_ref are the stored compressed SLCs, saved as the datum shifts of
+    their mini stacks. compressed_slc, if not None, are the compressed SLCs of the inverted mini stacks and
+    shp_mask the packed SHP masks of the pixels for the SHP cache.
+    With an output_queue, the outputs of phase_series.h5, maskPS.h5 and ampDispersion are sent with the box to the
+    single writer of the streaming inversion instead, see invert.write_stream, and no flag is saved.
+    With patch_file, the phases are written to the patch file phase_series.h5 instead of phase_ref.npy.
+    """
+    if output_queue is not None:
+        if compressed_slc is not None:
+            np.save(out_folder.decode('UTF-8') + '/compressed_slc.npy', compressed_slc)
+        if shp_mask is not None:
+            np.save(out_folder.decode('UTF-8') + '/shp_mask.npy', shp_mask)
+        output_queue.put((out_folder, np.array(box[:4], dtype=np.int32),
+                          {'phase': np.angle(rslc_ref[num_compressed:]), 'amplitude': np.abs(rslc_ref[num_compressed:]),
+                           'shp': SHP, 'tempCoh': tempCoh, 'mask_ps': mask_ps, 'amp_dispersion': amp_dispersion}))
+        return
+    if patch_file:
+        write_patch_file(out_folder.decode('UTF-8') + '/phase_series.h5', rslc_ref[num_compressed:], SHP, tempCoh,
+                         mask_ps)
+    else:
+        np.save(out_folder.decode('UTF-8') + '/phase_ref.npy', rslc_ref[num_compressed:])
+    if num_compressed > 0:
+        np.save(out_folder.decode('UTF-8') + '/datum_shift.npy', np.angle(rslc_ref[:num_compressed]))
+    if compressed_slc is not None:
+        np.save(out_folder.decode('UTF-8') + '/compressed_slc.npy', compressed_slc)
+    if shp_mask is not None:
+        np.save(out_folder.decode('UTF-8') + '/shp_mask.npy', shp_mask)
+    np.save(out_folder.decode('UTF-8') + '/shp.npy', SHP)
+    np.save(out_folder.decode('UTF-8') + '/tempCoh.npy', tempCoh)
+    np.save(out_folder.decode('UTF-8') + '/mask_ps.npy', mask_ps)
+    np.save(out_folder.decode('UTF-8') + '/amp_dispersion.npy', amp_dispersion)
+    np.save(out_folder.decode('UTF-8') + '/flag.npy', [1])
+    return
+
+
 def process_patch_c(cnp.ndarray[int, ndim=1] box, int range_window, int azimuth_window, int width, int length, int n_image,
                     object slcStackObj, float distance_threshold, cnp.ndarray[int, ndim=1] def_sample_rows,
                     cnp.ndarray[int, ndim=1] def_sample_cols, int reference_row, int reference_col,
                     bytes phase_linking_method, int total_num_mini_stacks, int default_mini_stack_size,
-                    int ps_shp, bytes shp_test, bytes out_dir, int lag, bytes mask_file):
+                    int ps_shp, bytes shp_test, bytes out_dir, int lag, bytes mask_file, bytes eig_solver,
+                    int num_threads, float amp_cache_size, float eig_tolerance, int max_compressed_slc,
+                    int num_compressed=0, bytes shp_cache_file=b'None', bint save_coherence=False,
+                    object output_queue=None, bint patch_file=False):
+    """ Inverts the phase of the pixels of a patch and saves the outputs in out_dir/PATCHES/PATCH_<index>.
+    For an update of a sequential inversion, the stack has num_compressed compressed SLCs of the inverted images
+    followed by the new images and total_num_mini_stacks is the number of mini stacks of the new images.
+    The SHPs of the patch are loaded from shp_cache_file if it has them for the same test and windows,
+    otherwise they are tested and saved for it, no cache if shp_cache_file is 'None'.
+    With save_coherence, the packed coherence matrix and the root mean power of the images of each pixel are saved
+    for coherence_matrix.h5, see pack_coherence_cy.
+    With an output_queue, the outputs are sent to the single writer of the streaming inversion, see
+    write_patch_outputs. With patch_file, the phases are written to the patch HDF5 file for the virtual
+    concatenation.
+    """
 
     cdef cnp.ndarray[int, ndim=1] big_box = get_big_box_cy(box, range_window, azimuth_window, width, length)
     cdef int box_width = box[2] - box[0]
@@ -1065,11 +2258,18 @@ def process_patch_c(cnp.ndarray[int, ndim=1] box, int range_window, int azimuth_
     cdef int overlap_length = row2 - row1
     cdef int[::1] sam = np.arange(col1, col2, dtype=np.int32)
     cdef int overlap_width = col2 - col1
-    cdef int[:, ::1] coords = np.zeros((overlap_length*overlap_width, 2), dtype=np.int32)
-    cdef int noval, num_points, num_shp, i, t, p, m = 0
+    cdef int[:, ::1] coords
+    cdef cnp.ndarray invalid
+    cdef int noval, num_points, num_shp, i, t, p, status, m = 0
+    cdef cnp.ndarray stack_time
+    cdef unsigned char[:, :, ::1] shp_masks
+    cdef bint save_shp_cache = shp_cache_file != b'None', load_shp_cache = False
+    cdef str shp_key
+    cdef object coh_file
+    cdef float complex[:, :, ::1] coh_packed
+    cdef float[:, :, ::1] coh_scale
     cdef (int, int) data
-    cdef int[:, ::1] shp
-    cdef cnp.ndarray[float complex, ndim=3] patch_slc_images = slcStackObj.read(datasetName='slc', box=big_box, print_msg=False)
+    cdef cnp.ndarray[float complex, ndim=3] patch_slc_images
     cdef float complex[:, ::1] CCG, coh_mat, squeezed_images
     cdef float complex[::1] vec, vec_refined = np.empty(n_image, dtype=np.complex64)
     cdef float[::1] amp_refined =  np.zeros(n_image, dtype=np.float32)
@@ -1082,6 +2282,42 @@ def process_patch_c(cnp.ndarray[int, ndim=1] box, int range_window, int azimuth_
     cdef float complex x0
     cdef float mi, se
     cdef int[:, ::1] mask = np.ones((box_length, box_width), dtype=np.int32)
+    cdef int b0, b1, k, tid, block_size, max_shp = def_sample_rows.shape[0] * def_sample_cols.shape[0]
+    cdef int[::1] sample_rows = def_sample_rows, sample_cols = def_sample_cols
+    cdef float complex[:, :, ::1] patch_slc_view
+    cdef float complex[:, :, ::1] block_samples, block_coh, block_mats
+    cdef int[:, :, ::1] block_test, shp_buffers
+    cdef float[:, ::1] test_buffers
+    cdef unsigned char[:, ::1] center
+    cdef unsigned char[:, :, ::1] pair_test
+    cdef cnp.ndarray[float, ndim=3] amp_sorted
+    cdef float[:, :, ::1] amp_sorted_view
+    cdef double cache_size
+    cdef bint use_amp_cache
+    cdef int[::1] block_num_shp, block_which, block_info
+    cdef float[::1] block_eig_values, block_quality, block_quality_full
+    cdef float complex[:, ::1] block_eig_vectors
+    cdef float[:, ::1] block_amp
+    cdef bint iterative_eig = eig_solver == b'iterative'
+    cdef bint batch_eig = eig_solver == b'batch' or iterative_eig
+    cdef int[::1] eig_stats = np.zeros(3, dtype=np.int32)
+    cdef int[::1] inversion_stats = np.zeros(NUM_STATS, dtype=np.int32)
+    cdef estimator_t estimator = get_estimator_cy(phase_linking_method)
+    cdef estimator_t evd_estimator = get_estimator_cy(b'EVD')
+    cdef bint sequential = estimator.sequential
+    cdef bint batch_phase_linking = batch_eig and not sequential and estimator.needs & ESTIMATOR_EIGEN_PAIR
+    cdef bint batch_emi_matrix = estimator.needs & ESTIMATOR_EMI_MATRIX
+    # with max_compressed_slc, the distributed scatterers only need the coherence of the images of the mini stacks
+    # up to max_compressed_slc apart (phase_linking_pixel_cy), the last mini stack may be longer than the others
+    cdef bint coh_band = sequential and max_compressed_slc > 0 and not save_coherence
+    cdef int coh_lag = min(n_image, max_compressed_slc * default_mini_stack_size + max(
+        default_mini_stack_size, n_image - num_compressed - (total_num_mini_stacks - 1) * default_mini_stack_size)) \
+        if coh_band else n_image
+    cdef PhaseLinkWorkspace ws = PhaseLinkWorkspace(n_image, num_compressed + total_num_mini_stacks if sequential else 1,
+                                                    num_threads, max_shp if coh_band else 0)
+    cdef cnp.ndarray[float, ndim=2] amp_dispersion
+    cdef unsigned char[:, ::1] ps_candidate
+    cdef int num_candidates
 
     if os.path.exists(mask_file.decode('UTF-8')):
         mask = (readfile.read(mask_file.decode('UTF-8'),
@@ -1090,62 +2326,252 @@ def process_patch_c(cnp.ndarray[int, ndim=1] box, int range_window, int azimuth_
     out_folder = out_dir + ('/PATCHES/PATCH_{:04.0f}'.format(index)).encode('UTF-8')
 
     os.makedirs(out_folder.decode('UTF-8'), exist_ok=True)
-    if os.path.exists(out_folder.decode('UTF-8') + '/flag.npy'):
+    if output_queue is None and os.path.exists(out_folder.decode('UTF-8') + '/flag.npy'):
         return
 
-    for i in range(overlap_length):
-        for t in range(overlap_width):
-            coords[m, 0] = i + row1
-            coords[m, 1] = t + col1
-            m += 1
+    # worklist of the pixels in the mask, a patch without any is written without reading its SLCs
+    invalid = np.asarray(mask) == 0
+    coords = np.ascontiguousarray(np.argwhere(~invalid) + np.array([row1, col1]), dtype=np.int32)
+    num_points = coords.shape[0]
+    print('    Valid pixels of PATCH_{:04.0f}: {} of {}'.format(index, num_points, box_length * box_width))
+
+    tempCoh[:, invalid] = 0.1    # Average and full stack temporal coherence of masked pixels
+    SHP[invalid] = 1
+
+    # packed SHP masks of the pixels, reused if an earlier run with the same SHP test found them all
+    shp_masks = np.zeros((box_length, box_width, (max_shp + 7) // 8), dtype=np.uint8)
+    if save_shp_cache and os.path.exists(shp_cache_file.decode('UTF-8')):
+        shp_key = shp_cache_key(shp_test, distance_threshold, azimuth_window, range_window, n_image)
+        with h5py.File(shp_cache_file.decode('UTF-8'), 'r') as f:
+            if shp_key in f:
+                shp_masks = np.ascontiguousarray(f[shp_key][box[1]:box[3], box[0]:box[2]], dtype=np.uint8)
+        load_shp_cache = num_points > 0 and np.all(np.asarray(shp_masks)[~invalid].any(axis=-1))
+        if load_shp_cache:
+            print('    SHPs of PATCH_{:04.0f} loaded from {}'.format(index, shp_cache_file.decode('UTF-8')))
+
+    if num_points == 0:
+        write_patch_outputs(out_folder, rslc_ref, SHP, tempCoh, mask_ps,
+                            np.full((box_length, box_width), np.nan, dtype=np.float32),
+                            np.zeros((total_num_mini_stacks, box_length, box_width), dtype=np.complex64)
+                            if sequential else None, num_compressed, None, box, output_queue, patch_file)
+        return
+
+    patch_slc_images = slcStackObj.read(datasetName='slc', box=big_box, print_msg=False)
+    patch_slc_view = patch_slc_images
+    cache_size = 4. * patch_slc_images.shape[0] * patch_slc_images.shape[1] * patch_slc_images.shape[2]
+    use_amp_cache = cache_size <= amp_cache_size * 1024 ** 2
+    rslc_ref[:, invalid] = patch_slc_images[:, row1:row2, col1:col2][:, invalid] * \
+                           np.conj(patch_slc_images[0, row1:row2, col1:col2][invalid])
+
+    # PS pre-screen: only the pixels with a low amplitude dispersion are tested with the eigen values
+    amp_dispersion = amplitude_dispersion_py(patch_slc_images[num_compressed:, row1:row2, col1:col2])
+    ps_candidate = ((amp_dispersion < PS_AMP_DISPERSION) & ~invalid).astype(np.uint8)
+    num_candidates = np.count_nonzero(ps_candidate)
+    print('    PS candidates of PATCH_{:04.0f} from amplitude dispersion: {} of {} pixels'.format(
+        index, num_candidates, num_points))
+
+    if not load_shp_cache:
+        # amplitudes sorted once per patch for the SHP tests, the complex samples keep the original order
+        if use_amp_cache:
+            amp_sorted = np.ascontiguousarray(np.sort(np.abs(patch_slc_images), axis=0).transpose(1, 2, 0))
+            print('    Sorted amplitude cache of PATCH_{:04.0f}: {:.1f} MB'.format(index, cache_size / 1024 ** 2))
+        else:
+            amp_sorted = np.zeros((1, 1, 1), dtype=np.float32)
+            print('    Sorted amplitude cache of PATCH_{:04.0f} needs {:.1f} MB, more than {:.1f} MB, '
+                  'amplitudes are sorted for each window'.format(index, cache_size / 1024 ** 2, amp_cache_size))
+        amp_sorted_view = amp_sorted
+
+        # each unordered pair of pixels is tested once, only the pairs with a center pixel in the mask are needed
+        center = np.zeros((patch_slc_images.shape[1], patch_slc_images.shape[2]), dtype=np.uint8)
+        for i in range(num_points):
+            center[coords[i, 0], coords[i, 1]] = 1
+        pair_test = np.zeros((center.shape[0], center.shape[1],
+                              (reference_row * sample_cols.shape[0] + reference_col + 7) // 8), dtype=np.uint8)
+        test_buffers = np.zeros((num_threads, 2 * n_image), dtype=np.float32)
+        if shp_test == b'ad' or shp_test == b'ttest':
+            for i in range(center.shape[0]):
+                pair_test_cy(amp_sorted, patch_slc_view, use_amp_cache, center, i, sample_rows, sample_cols,
+                             reference_row, reference_col, distance_threshold, shp_test, pair_test)
+        else:
+            with nogil, parallel(num_threads=num_threads):
+                tid = threadid()
+                for k in prange(center.shape[0], schedule='dynamic'):
+                    ks_pair_test_cy(amp_sorted_view, patch_slc_view, use_amp_cache, center, k, sample_rows, sample_cols,
+                                    reference_row, reference_col, distance_threshold, pair_test, test_buffers[tid])
+    else:
+        pair_test = np.zeros((1, 1, 1), dtype=np.uint8)
+
+    if save_coherence:
+        # on disk as the packed matrices of a patch can be larger than its SLCs
+        coh_file = np.lib.format.open_memmap(out_folder.decode('UTF-8') + '/coherence.npy', mode='w+',
+                                             dtype=np.complex64,
+                                             shape=(box_length, box_width, n_image * (n_image - 1) // 2))
+        coh_packed = coh_file
+        coh_scale = np.zeros((box_length, box_width, n_image), dtype=np.float32)
+
+    block_size = min(num_points, max(1, <int>(BATCH_MEMORY_SIZE / (8 * n_image * (2 * n_image + max_shp)))))
+    block_samples = np.zeros((block_size, n_image, max_shp), dtype=np.complex64)
+    block_coh = np.zeros((block_size, n_image, n_image), dtype=np.complex64)
+    block_num_shp = np.zeros(block_size, dtype=np.int32)
+    block_test = np.zeros((block_size, def_sample_rows.shape[0], def_sample_cols.shape[0]), dtype=np.int32)
+    shp_buffers = np.zeros((num_threads, max_shp, 2), dtype=np.int32)
+    block_info = np.zeros(block_size, dtype=np.int32)
+    block_eig_values = np.zeros(block_size, dtype=np.float32)
+    block_eig_vectors = np.zeros((block_size, n_image), dtype=np.complex64)
+    block_quality = np.zeros(block_size, dtype=np.float32)
+    block_quality_full = np.zeros(block_size, dtype=np.float32)
+    block_amp = np.zeros((block_size, n_image), dtype=np.float32)
+    if batch_eig:
+        block_mats = np.zeros((block_size, n_image, n_image), dtype=np.complex64)
+        block_which = np.zeros(block_size, dtype=np.int32)
 
-    num_points = m
     prog_bar = ptime.progressBar(maxValue=num_points)
-    p = 0
-    for i in range(num_points):
-        ps = 0
-        data = (coords[i,0], coords[i,1])
-        if mask[data[0] - row1, data[1] - col1]:
-
-            #num_shp = SHP[data[0] - row1, data[1] - col1]
-            #if num_shp == 0:
-            shp = get_shp_row_col_c(data, patch_slc_images, def_sample_rows, def_sample_cols, azimuth_window,
-                                    range_window, reference_row, reference_col, distance_threshold, shp_test)
-            num_shp = shp.shape[0]
+    for b0 in range(0, num_points, block_size):
+        b1 = min(b0 + block_size, num_points)
+
+        # window tests from the pair decisions, SHPs and their samples stacked for the batched coherence estimation
+        with nogil, parallel(num_threads=num_threads):
+            tid = threadid()
+            for k in prange(b1 - b0, schedule='static'):
+                if load_shp_cache:
+                    block_num_shp[k] = shp_from_mask_cy(shp_masks[coords[b0 + k, 0] - row1, coords[b0 + k, 1] - col1],
+                                                        coords[b0 + k, 0], coords[b0 + k, 1], sample_rows, sample_cols,
+                                                        shp_buffers[tid])
+                else:
+                    window_from_pairs_cy(pair_test, coords[b0 + k, 0], coords[b0 + k, 1], sample_rows, sample_cols,
+                                         reference_row, reference_col, block_test[k])
+                    block_num_shp[k] = shp_flood_fill_cy(block_test[k], coords[b0 + k, 0], coords[b0 + k, 1],
+                                                         sample_rows, sample_cols, reference_row, reference_col,
+                                                         shp_buffers[tid])
+                    if save_shp_cache:
+                        shp_to_mask_cy(block_test[k], shp_masks[coords[b0 + k, 0] - row1, coords[b0 + k, 1] - col1])
+                for t in range(block_num_shp[k]):
+                    for m in range(n_image):
+                        block_samples[k, m, t] = patch_slc_view[m, shp_buffers[tid, t, 0], shp_buffers[tid, t, 1]]
+
+        est_corr_batch_cy(block_samples[0:b1 - b0], block_num_shp, block_coh, num_threads, coh_lag, ps_shp)
+
+        if save_coherence:
+            with nogil, parallel(num_threads=num_threads):
+                for k in prange(b1 - b0, schedule='static'):
+                    if block_num_shp[k] > 0:
+                        pack_coherence_cy(block_coh[k], coh_packed[coords[b0 + k, 0] - row1, coords[b0 + k, 1] - col1])
+                        sample_moments_cy(block_samples[k], block_num_shp[k], block_amp[k],
+                                          coh_scale[coords[b0 + k, 0] - row1, coords[b0 + k, 1] - col1])
+
+        if batch_eig:
+            # stack the matrices to decompose: coherence for PS candidates and EVD, |coh|^-1 o coh for EMI
+            with nogil, parallel(num_threads=num_threads):
+                tid = threadid()
+                for k in prange(b1 - b0, schedule='dynamic'):
+                    block_which[k] = EIG_SKIP
+                    if block_num_shp[k] == 0 or (block_num_shp[k] > ps_shp and not batch_phase_linking):
+                        continue
+                    block_which[k] = EIG_LARGEST
+                    if block_num_shp[k] > ps_shp and batch_emi_matrix:
+                        status = emi_matrix_cy(block_coh[k], block_mats[k], ws.fmats[tid], ws.rwork[tid],
+                                               ws.iwork[tid])
+                        if status == 1:
+                            ws.stats[tid, STAT_REGULARIZED] += 1
+                        if status >= 0:
+                            block_which[k] = EIG_SMALLEST
+                            continue
+                    block_mats[k, :, :] = block_coh[k, :, :]
+
+            # the iterative solver leaves the matrices that did not converge to the full solver
+            if iterative_eig:
+                eigh_iterative_batch_cy(block_mats[0:b1 - b0], block_which, block_eig_values, block_eig_vectors,
+                                        eig_tolerance, eig_stats, num_threads)
+            eigh_select_batch_cy(block_mats[0:b1 - b0], block_which, block_eig_values, block_eig_vectors,
+                                 block_info, num_threads)
+
+        # phase linking of the distributed scatterers not solved in batch, from the coherence estimated above
+        with nogil, parallel(num_threads=num_threads):
+            tid = threadid()
+            for k in prange(b1 - b0, schedule='dynamic'):
+                if 0 < block_num_shp[k] <= ps_shp and not ps_candidate[coords[b0 + k, 0] - row1,
+                                                                       coords[b0 + k, 1] - col1]:
+                    # not a PS, phase from the eigen vector of its small ensemble
+                    if not batch_eig or block_info[k] != 0:
+                        block_info[k] = phase_linking_pixel_cy(block_coh[k], ws.scale[tid], evd_estimator, 0,
+                                                               default_mini_stack_size, 1, 0, 0, block_samples[k], 0,
+                                                               block_eig_vectors[k], &block_quality[k], ws, tid)
+                    else:
+                        block_quality[k] = gam_pta_coh_cy(block_coh[k], block_eig_vectors[k])
+                elif block_num_shp[k] > ps_shp:
+                    sample_moments_cy(block_samples[k], block_num_shp[k], block_amp[k], ws.scale[tid])
+                    if batch_phase_linking and block_info[k] == 0:
+                        block_quality[k] = gam_pta_coh_cy(block_coh[k], block_eig_vectors[k])
+                    else:
+                        block_info[k] = phase_linking_pixel_cy(block_coh[k], ws.scale[tid], estimator, lag,
+                                                               default_mini_stack_size, total_num_mini_stacks,
+                                                               max_compressed_slc, num_compressed, block_samples[k],
+                                                               block_num_shp[k] if coh_band else 0,
+                                                               block_eig_vectors[k], &block_quality[k], ws, tid)
+                    if coh_band:
+                        block_quality_full[k] = gam_pta_band_cy(block_coh[k], coh_lag, block_eig_vectors[k])
+                    else:
+                        block_quality_full[k] = gam_pta_coh_cy(block_coh[k], block_eig_vectors[k])
+
+        for i in range(b0, b1):
+            data = (coords[i,0], coords[i,1])
+            num_shp = block_num_shp[i - b0]
             SHP[data[0] - row1, data[1] - col1] = num_shp
-            CCG = np.zeros((n_image, num_shp), dtype=np.complex64)
-            for t in range(num_shp):
-                for m in range(n_image):
-                    CCG[m, t] = patch_slc_images[m, shp[t,0], shp[t,1]]
-
-            coh_mat = est_corr_cy(CCG)
+            coh_mat = block_coh[i - b0]
             #temp_quality = 0
             if num_shp <= ps_shp:
                 x0 = conjf(patch_slc_images[0, data[0], data[1]])
                 for m in range(n_image):
                     vec_refined[m] = patch_slc_images[m, data[0], data[1]]  * x0
                     amp_refined[m] = cabsf(patch_slc_images[m, data[0], data[1]])
-                temp_quality, vec = test_PS_cy(coh_mat, amp_refined)
-                if temp_quality == 1:
-                    mask_ps[data[0] - row1, data[1] - col1] = 1
+                if not ps_candidate[data[0] - row1, data[1] - col1] and block_info[i - b0] == 0:
+                    for m in range(n_image):
+                        vec_refined[m] = block_eig_vectors[i - b0, m]
+                    temp_quality = block_quality[i - b0]
                 else:
-                    vec_refined = vec
+                    if batch_eig and block_info[i - b0] == 0:
+                        temp_quality, vec = test_PS_eig_cy(coh_mat, amp_dispersion[data[0] - row1, data[1] - col1],
+                                                           block_eig_values[i - b0],
+                                                           block_eig_vectors[i - b0].copy())
+                    else:
+                        temp_quality, vec = test_PS_cy(coh_mat, amp_dispersion[data[0] - row1, data[1] - col1])
+                    if temp_quality == 1:
+                        mask_ps[data[0] - row1, data[1] - col1] = 1
+                    else:
+                        vec_refined = vec
                 temp_quality_full = temp_quality
 
-            else:
-
-                if len(phase_linking_method) > 10 and phase_linking_method[0:10] == b'sequential':
+            elif block_info[i - b0] != 0:
+                # the eigen solver failed, inverted again from the samples
+                CCG = np.array(block_samples[i - b0, :, 0:num_shp], dtype=np.complex64)
+                if num_compressed > 0:
+                    # the configured estimator on the compressed and new images, the compressed ones give the
+                    # datum shifts
+                    vec_refined, noval, temp_quality = phase_linking_process_cy(CCG, 0, phase_linking_method, False,
+                                                                                lag, ws.stats[0],
+                                                                                None if coh_band else coh_mat)
+                elif sequential:
                     vec_refined, squeezed_images, temp_quality = sequential_phase_linking_cy(CCG, phase_linking_method,
                                                                                default_mini_stack_size,
-                                                                               total_num_mini_stacks)
+                                                                               total_num_mini_stacks, ws.stats[0],
+                                                                               max_compressed_slc)
 
                     vec_refined = datum_connect_cy(squeezed_images, vec_refined, default_mini_stack_size)
-
                 else:
-                    vec_refined, noval, temp_quality = phase_linking_process_cy(CCG, 0, phase_linking_method, False, lag)
-
+                    vec_refined, noval, temp_quality = phase_linking_process_cy(CCG, 0, phase_linking_method, False, lag,
+                                                                                ws.stats[0], coh_mat)
                 amp_refined = mean_along_axis_x(absmat2(CCG))
-                temp_quality_full = gam_pta_c(angmat2(coh_mat), vec_refined)
+                if coh_band:
+                    temp_quality_full = gam_pta_band_cy(coh_mat, coh_lag, vec_refined)
+                else:
+                    temp_quality_full = gam_pta_coh_cy(coh_mat, vec_refined)
+
+            else:
+                for m in range(n_image):
+                    vec_refined[m] = block_eig_vectors[i - b0, m]
+                    amp_refined[m] = block_amp[i - b0, m]
+                temp_quality = block_quality[i - b0]
+                temp_quality_full = block_quality_full[i - b0]
 
 
             for m in range(n_image):
@@ -1163,32 +2589,59 @@ def process_patch_c(cnp.ndarray[int, ndim=1] box, int range_window, int azimuth_
                 temp_quality_full = 0
             tempCoh[0, data[0] - row1, data[1] - col1] = temp_quality         # Average temporal coherence from mini stacks
             tempCoh[1, data[0] - row1, data[1] - col1] = temp_quality_full    # Full stack temporal coherence
-        else:
-            x0 = conjf(patch_slc_images[0, data[0], data[1]])
-            tempCoh[0, data[0] - row1, data[1] - col1] = 0.1    # Average temporal coherence from mini stacks
-            tempCoh[1, data[0] - row1, data[1] - col1] = 0.1    # Full stack temporal coherence
-            SHP[data[0] - row1, data[1] - col1] = 1
-            for m in range(n_image):
-                    rslc_ref[m, data[0] - row1, data[1] - col1] = patch_slc_images[m, data[0], data[1]]  * x0
-
-
-        prog_bar.update(p + 1, every=500, suffix='{}/{} pixels, patch {}'.format(p + 1, num_points, index))
-        p += 1
 
-    np.save(out_folder.decode('UTF-8') + '/phase_ref.npy', rslc_ref)
-    np.save(out_folder.decode('UTF-8') + '/shp.npy', SHP)
-    np.save(out_folder.decode('UTF-8') + '/tempCoh.npy', tempCoh)
-    np.save(out_folder.decode('UTF-8') + '/mask_ps.npy', mask_ps)
-    np.save(out_folder.decode('UTF-8') + '/flag.npy', [1])
+        prog_bar.update(b1, every=1, suffix='{}/{} pixels, patch {}'.format(b1, num_points, index))
+
+    for t in range(num_threads):
+        for m in range(NUM_STATS):
+            inversion_stats[m] += ws.stats[t, m]
+
+    if save_coherence:
+        coh_file.flush()
+        np.save(out_folder.decode('UTF-8') + '/coherence_scale.npy', coh_scale)
+
+    write_patch_outputs(out_folder, rslc_ref, SHP, tempCoh, mask_ps, amp_dispersion,
+                        compress_slc_py(rslc_ref[num_compressed:], patch_slc_images[num_compressed:, row1:row2, col1:col2],
+                                        default_mini_stack_size, total_num_mini_stacks) if sequential else None,
+                        num_compressed, np.asarray(shp_masks) if save_shp_cache and not load_shp_cache else None,
+                        box, output_queue, patch_file)
+
+    if eig_stats[0] > 0:
+        print('    Iterative eigen solver of PATCH_{:04.0f}: {} pixels, {:.1f} iterations on average, {} fallbacks'.format(
+            index, eig_stats[0], <float>eig_stats[1] / max(1, eig_stats[0] - eig_stats[2]), eig_stats[2]))
+    if inversion_stats[STAT_PTA_INVERSIONS] > 0:
+        print('    PTA of PATCH_{:04.0f}: {} inversions, {:.1f} sweeps on average, {} not converged'.format(
+            index, inversion_stats[STAT_PTA_INVERSIONS],
+            <float>inversion_stats[STAT_PTA_SWEEPS] / inversion_stats[STAT_PTA_INVERSIONS],
+            inversion_stats[STAT_PTA_NOT_CONVERGED]))
+    if inversion_stats[STAT_REGULARIZED] > 0:
+        print('    |coh| of {} inversions in PATCH_{:04.0f} regularized to be positive definite'.format(
+            inversion_stats[STAT_REGULARIZED], index))
+    if inversion_stats[STAT_SEQUENTIAL_PIXELS] > 0:
+        stack_time = np.asarray(ws.stack_time).sum(axis=0)
+        print('    Sequential phase linking of PATCH_{:04.0f}: {} pixels'.format(
+            index, inversion_stats[STAT_SEQUENTIAL_PIXELS]))
+        for i in range(total_num_mini_stacks):
+            p = num_compressed + i
+            t = p - max_compressed_slc if 0 < max_compressed_slc < p else 0
+            print('      mini stack {}: {} compressed + {} images, {:.0f} pixels/s per thread'.format(
+                i, p - t, n_image - num_compressed - i * default_mini_stack_size
+                if i == total_num_mini_stacks - 1 else default_mini_stack_size,
+                inversion_stats[STAT_SEQUENTIAL_PIXELS] / max(stack_time[i], 1e-9)))
 
     mi, se = divmod(time.time()-time0, 60)
     print('    Phase inversion of PATCH_{:04.0f} is Completed in {:02.0f} mins {:02.0f} secs\n'.format(index, mi, se))
 
     return
 
+cpdef float ks_distance_py(cnp.ndarray[float, ndim=1] S1, cnp.ndarray[float, ndim=1] S2,
+                           float distance_threshold=1):
+    return ks_distance_cy(&S1[0], &S2[0], S1.shape[0], S2.shape[0], distance_threshold)
+
+
 cdef int ks2smapletest_cy(cnp.ndarray[float, ndim=1] S1, cnp.ndarray[float, ndim=1] S2, float threshold):
     cdef int res
-    cdef float distance = ecdf_distance(S1, S2)
+    cdef float distance = ks_distance_cy(&S1[0], &S2[0], S1.shape[0], S2.shape[0], threshold)
     if distance <= threshold:
         res = 1
     else:
@@ -1197,7 +2650,7 @@ cdef int ks2smapletest_cy(cnp.ndarray[float, ndim=1] S1, cnp.ndarray[float, ndim
 
 cpdef int ks2smapletest_py(cnp.ndarray[float, ndim=1] S1, cnp.ndarray[float, ndim=1] S2, float threshold):
     cdef int res
-    cdef float distance = ecdf_distance(S1, S2)
+    cdef float distance = ks_distance_cy(&S1[0], &S2[0], S1.shape[0], S2.shape[0], threshold)
     if distance <= threshold:
         res = 1
     else:
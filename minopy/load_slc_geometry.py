@@ -100,7 +100,10 @@ def main(iargs=None):
                             xstep=xyStep[0],
                             ystep=xyStep[1],
                             compression=comp,
-                            extra_metadata=extraDict)
+                            extra_metadata=extraDict,
+                            range_window=int(iDict.get('minopy.inversion.rangeWindow', 19)),
+                            azimuth_window=int(iDict.get('minopy.inversion.azimuthWindow', 9)),
+                            patch_size=int(iDict.get('minopy.inversion.patchSize', 200)))
 
     if geomRadarObj and update_object(inps.out_file[1], geomRadarObj, box, updateMode=updateMode):
         print('-' * 50)
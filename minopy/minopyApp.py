@@ -15,12 +15,14 @@ import sys
 import time
 import shutil
 import math
+import h5py
 
 from mintpy.utils import writefile, readfile, utils as ut
 from mintpy.smallbaselineApp import TimeSeriesAnalysis
 from minopy.objects.arg_parser import MinoPyParser
 from minopy.defaults.auto_path import autoPath, PathFind
 from minopy.find_short_baselines import find_baselines, plot_baselines
+from minopy.objects.slcStack import tune_patch_size
 from minopy.objects.utils import (check_template_auto_value,
                                   log_message, get_latest_template_minopy,
                                   read_initial_info)
@@ -268,14 +270,27 @@ class minopyTimeSeriesAnalysis(TimeSeriesAnalysis):
         run_inversion = os.path.join(self.run_dir, RUN_FILES[sname])
         print('Generate {}'.format(run_inversion))
 
-        num_length_patch = math.ceil(self.metadata['LENGTH'] / int(self.template['minopy.inversion.patchSize']))
-        num_width_patch = math.ceil(self.metadata['WIDTH'] / int(self.template['minopy.inversion.patchSize']))
+        slc_stack = os.path.join(self.workDir, 'inputs/slcStack.h5')
+        patch_size = int(self.template['minopy.inversion.patchSize'])
+        if self.template['minopy.inversion.tunePatchSize'] == 'yes' and os.path.exists(slc_stack):
+            # tuned here so that all the inversion tasks and the concatenation use the same patches
+            with h5py.File(slc_stack, 'r') as f:
+                chunks, num_slc = f['slc'].chunks, f['slc'].shape[0]
+            patch_size = tune_patch_size(patch_size, chunks, num_slc, int(self.metadata['LENGTH']),
+                                         int(self.metadata['WIDTH']),
+                                         int(self.template['minopy.inversion.rangeWindow']),
+                                         int(self.template['minopy.inversion.azimuthWindow']), self.num_workers,
+                                         float(self.template['minopy.inversion.memoryBudget']))
+            print('Patch size tuned to {} for the chunks {} of slcStack.h5'.format(patch_size, chunks))
+
+        num_length_patch = math.ceil(self.metadata['LENGTH'] / patch_size)
+        num_width_patch = math.ceil(self.metadata['WIDTH'] / patch_size)
         num_patches = num_length_patch * num_width_patch
 
         number_of_nodes = math.ceil(num_patches / self.num_workers)
-        num_bursts = int(self.template['minopy.inversion.patchSize'])**2 // 40000
+        num_cores_per_task = self.num_workers * int(self.template['minopy.multiprocessing.numThreads'])
+        num_bursts = patch_size**2 // 40000
 
-        slc_stack = os.path.join(self.workDir, 'inputs/slcStack.h5')
         if self.copy_to_tmp:
             tmp_slc_stack = '/tmp/slcStack.h5'
         else:
@@ -285,7 +300,16 @@ class minopyTimeSeriesAnalysis(TimeSeriesAnalysis):
 
         scp_args = '--work_dir {a0} --range_window {a1} --azimuth_window {a2} --patch_size {a3}'.format(
             a0=self.workDir, a1=self.template['minopy.inversion.rangeWindow'],
-            a2=self.template['minopy.inversion.azimuthWindow'], a3=self.template['minopy.inversion.patchSize'])
+            a2=self.template['minopy.inversion.azimuthWindow'], a3=patch_size)
+
+        if self.template['minopy.inversion.update'] == 'yes':
+            scp_args += ' --update --mini_stack_size {}'.format(self.template['minopy.inversion.ministackSize'])
+        if self.template['minopy.inversion.shpCache'] == 'no':
+            scp_args += ' --no_shp_cache'
+        if self.template['minopy.inversion.saveCoherenceMatrix'] == 'yes':
+            scp_args += ' --coherence_matrix'
+        if self.template['minopy.inversion.virtualDataset'] == 'yes':
+            scp_args += ' --virtual'
 
         if sname == 'concatenate_patch':
             command_line = '{a} phase_inversion.py {b} --slc_stack {c} --concatenate\n'.format(
@@ -297,12 +321,22 @@ class minopyTimeSeriesAnalysis(TimeSeriesAnalysis):
             print('Number of tasks for step phase inversion: {}'.format(number_of_nodes))
 
             scp_args += ' --method {a1} --test {a2} --num_worker {a3} ' \
-                        '--mini_stack_size {a4} --time_lag {a5} --ps_num_shp {a6}'.format(
+                        '--mini_stack_size {a4} --time_lag {a5} --ps_num_shp {a6} --eig_solver {a7}'.format(
                 a1=self.template['minopy.inversion.phaseLinkingMethod'],
                 a2=self.template['minopy.inversion.shpTest'],
                 a3=self.num_workers, a4=self.template['minopy.inversion.ministackSize'],
                 a5=self.template['minopy.inversion.stbas_time_lag'],
-                a6=self.template['minopy.inversion.PsNumShp'])
+                a6=self.template['minopy.inversion.PsNumShp'],
+                a7=self.template['minopy.inversion.eigenSolver'])
+            scp_args += ' --num_threads {}'.format(self.template['minopy.multiprocessing.numThreads'])
+            scp_args += ' --amp_cache_size {}'.format(self.template['minopy.inversion.ampCacheSize'])
+            scp_args += ' --eig_tolerance {}'.format(self.template['minopy.inversion.eigenTolerance'])
+            scp_args += ' --max_compressed_slc {}'.format(self.template['minopy.inversion.maxCompressedSlc'])
+            if self.template['minopy.inversion.splitPatches'] == 'yes':
+                scp_args += ' --split_patches'
+            if self.template['minopy.inversion.sharedStripReader'] == 'yes':
+                scp_args += ' --shared_strips --memory_budget {}'.format(
+                    self.template['minopy.inversion.memoryBudget'])
 
             if not self.template['minopy.inversion.mask'] in [None, 'None']:
                 scp_args += ' --mask {}'.format(os.path.abspath(self.template['minopy.inversion.mask']))
@@ -315,6 +349,9 @@ class minopyTimeSeriesAnalysis(TimeSeriesAnalysis):
                                                                                          c=tmp_slc_stack)
                     run_commands.append(command_line)
             else:
+                if self.template['minopy.inversion.streamOutput'] == 'yes' and \
+                        self.template['minopy.inversion.update'] != 'yes':
+                    scp_args += ' --stream'
                 command_line = '{a} phase_inversion.py {b} --slc_stack {c}\n'.format(a=self.text_cmd.strip("'"),
                                                                                      b=scp_args,
                                                                                      c=tmp_slc_stack)
@@ -326,10 +363,10 @@ class minopyTimeSeriesAnalysis(TimeSeriesAnalysis):
         if self.write_job or not job_obj is None:
             job_obj.num_bursts = num_bursts
             if self.copy_to_tmp:
-                job_obj.write_batch_jobs(batch_file=run_inversion, num_cores_per_task=self.num_workers,
+                job_obj.write_batch_jobs(batch_file=run_inversion, num_cores_per_task=num_cores_per_task,
                                          distribute=slc_stack)
             else:
-                job_obj.write_batch_jobs(batch_file=run_inversion, num_cores_per_task=self.num_workers)
+                job_obj.write_batch_jobs(batch_file=run_inversion, num_cores_per_task=num_cores_per_task)
 
         return slc_stack
 
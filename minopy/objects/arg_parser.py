@@ -293,22 +293,72 @@ class MinoPyParser:
                            help='Inversion method (EMI, EVD, PTA, sequential_EMI, ...)')
         patch.add_argument('-l', '--time_lag', type=int, dest='time_lag', default=10,
                            help='Time lag in case StBAS is used')
+        patch.add_argument('-mc', '--max_compressed_slc', type=int, dest='max_compressed_slc', default=0,
+                           help='Number of previous compressed SLCs carried to each mini stack of the sequential '
+                                'methods, keeps the time and memory per mini stack constant for long stacks: the '
+                                'coherence is only estimated for the images of the mini stacks this far apart and the '
+                                'full stack temporal coherence is over these pairs. The datum of the mini stacks is '
+                                'still connected with all the compressed SLCs, from their samples. With '
+                                '--coherence_matrix the full matrices are estimated, default: 0 for all')
         patch.add_argument('-t', '--test', type=str, dest='shp_test', default='ks',
                            help='Shp statistical test (ks, ad, ttest)')
         patch.add_argument('-psn', '--ps_num_shp', type=int, dest='ps_shp', default=10,
                            help='Number of SHPs for PS candidates')
+        patch.add_argument('-e', '--eig_solver', type=str, dest='eig_solver', default='batch',
+                           choices=['batch', 'pixel', 'iterative'],
+                           help='Eigen solver for EVD, EMI and PS test: batch (only the needed eigen pair of a '
+                                'block of pixels), pixel (full spectrum of each pixel) or iterative (power/inverse '
+                                'iteration started from the previous pixel, batch where it does not converge), '
+                                'default: batch')
+        patch.add_argument('-et', '--eig_tolerance', type=float, dest='eig_tolerance', default=1e-4,
+                           help='Relative residual of the eigen pair to stop the iterative eigen solver, default: 1e-4')
+        patch.add_argument('-ac', '--amp_cache_size', type=float, dest='amp_cache_size', default=1024,
+                           help='Maximum size (MB) of the time sorted amplitudes of a patch kept in memory for the '
+                                'SHP tests, larger patches sort the amplitudes of each window, default: 1024')
         patch.add_argument('-p', '--patch_size', type=int, dest='patch_size', default=200,
                            help='Azimuth window size for shp finding')
+        patch.add_argument('--tune_patch_size', dest='tune_patch_size', action='store_true',
+                           help='Reduce the patch size to give every worker a patch and to fit the memory budget, '
+                                'aligned to the chunks of the slc dataset')
+        patch.add_argument('--memory_budget', type=float, dest='memory_budget', default=0,
+                           help='Memory (GB) of all the workers for --tune_patch_size, and of the two strips in memory '
+                                'for --shared_strips, default: 0 for no limit')
         patch.add_argument('-mss', '--mini_stack_size', type=int, dest='ministack_size', default=10,
                            help='Number of images in each mini stack')
         patch.add_argument('-s', '--slc_stack', type=str, dest='slc_stack', help='SLC stack file')
         patch.add_argument('-ms', '--mask', type=str, dest='mask_file', default='None', help='mask file for inversion')
         patch.add_argument('-n', '--num_worker', dest='num_worker', type=int, default=1,
                            help='Number of parallel tasks (default: 1)')
+        patch.add_argument('-nt', '--num_threads', dest='num_threads', type=int, default=1,
+                           help='Number of OpenMP threads sharing the pixels of each patch (default: 1)')
         patch.add_argument('-i', '--index', dest='sub_index', type=str, default=None,
                            help='The list containing patches of i*num_worker:(i+1)*num_worker')
         patch.add_argument('-c', '--concatenate', dest='do_concatenate', action='store_false',
                            help='Concatenate all phase inverted patches')
+        patch.add_argument('-u', '--update', dest='update', action='store_true',
+                           help='Invert only the images added since the last sequential inversion, from the '
+                                'compressed SLCs of its mini stacks, and extend phase_series.h5 in place')
+        patch.add_argument('--no_shp_cache', dest='shp_cache', action='store_false',
+                           help='Test the SHPs of every patch instead of reusing the ones saved in shp_cache.h5 '
+                                'for the same test, threshold, window and images')
+        patch.add_argument('--coherence_matrix', dest='save_coherence', action='store_true',
+                           help='Save the coherence matrix of each pixel to coherence_matrix.h5 for the coherence '
+                                'viewer and re-estimation of single pixels')
+        patch.add_argument('--split_patches', dest='split_patches', action='store_true',
+                           help='Split the patches estimated to take more than half the average time of a worker '
+                                'into sub patches, the patches are always dispatched longest first')
+        patch.add_argument('--shared_strips', dest='shared_strips', action='store_true',
+                           help='Read the SLCs once per strip of patches to shared memory for the workers instead '
+                                'of once per patch, the next strip is read while the current one is inverted. '
+                                'The rows of patches are split into strips within --memory_budget')
+        patch.add_argument('--stream', dest='stream_output', action='store_true',
+                           help='Write the patches to phase_series.h5 and maskPS.h5 as they finish from a single '
+                                'writer process with a journal for resuming, concatenation is then not needed. '
+                                'Not supported with --index and --update')
+        patch.add_argument('--virtual', dest='virtual_dataset', action='store_true',
+                           help='Write the phases of each patch to its own HDF5 file and concatenate them as virtual '
+                                'datasets of phase_series.h5 and maskPS.h5 without copying, the PATCHES folder '
+                                'must then be kept')
 
 
         return parser
@@ -207,7 +207,43 @@ def regularize_matrix_cy(M):
             t += 1
     return status, N
 
-def process_pixel(coord, stackfile, range_window=19, azimuth_window=9, phase_linking_method=b'sequential'):
+def read_coherence_matrix(coh_file, coord):
+    """ Coherence matrix and root mean power of the images of pixel coord = (row, col) from coherence_matrix.h5
+    of phase_inversion.py --coherence_matrix, the upper triangles of the matrices are packed row by row """
+    with h5py.File(coh_file, 'r') as f:
+        packed = f['coherence'][coord[0], coord[1], :]
+        scale = f['scale'][coord[0], coord[1], :]
+
+    n_image = scale.shape[0]
+    rows, cols = np.triu_indices(n_image, 1)
+    coh_mat = np.eye(n_image, dtype=np.complex64)
+    coh_mat[rows, cols] = packed
+    coh_mat[cols, rows] = np.conj(packed)
+    return coh_mat, scale
+
+
+def read_shp_cache(shp_cache_file, coord, azimuth_window, range_window, n_image):
+    """ Row/col of the SHPs of pixel coord = (row, col) from the packed SHP masks in shp_cache.h5,
+    None if it has no SHPs of the pixel for the window and number of images """
+    with h5py.File(shp_cache_file, 'r') as f:
+        for key in f:
+            attrs = f[key].attrs
+            if (attrs['azimuth_window'], attrs['range_window'], attrs['n_image']) != (azimuth_window, range_window,
+                                                                                         n_image):
+                continue
+            mask = np.unpackbits(f[key][coord[0], coord[1], :], bitorder='little')[0:azimuth_window * range_window]
+            if mask.any():
+                rows, cols = np.nonzero(mask.reshape(azimuth_window, range_window))
+                return np.stack((rows + coord[0] - (azimuth_window - 1) // 2,
+                                 cols + coord[1] - (range_window - 1) // 2), axis=1).astype(np.int32)
+    return None
+
+
+def process_pixel(coord, stackfile, range_window=19, azimuth_window=9, phase_linking_method=b'sequential_EMI',
+                  coh_file=None, shp_cache_file=None, max_compressed_slc=0):
+    """ Phase linking of one pixel, the coherence matrix is read from coh_file (coherence_matrix.h5) and the SHPs
+    from shp_cache_file (shp_cache.h5) if given, only the window of the pixel is read from the stack then.
+    max_compressed_slc is the --max_compressed_slc of the inversion for the sequential methods """
 
     default_mini_stack_size = 10
     sample_rows = np.arange(-((azimuth_window - 1) // 2), ((azimuth_window - 1) // 2) + 1, dtype=np.int32)
@@ -225,7 +261,11 @@ def process_pixel(coord, stackfile, range_window=19, azimuth_window=9, phase_lin
             n_image, length, width = f['phase'].shape
 
     distance_threshold = ks_lut_cy(n_image, n_image, 0.01)
-    box = [coord[1] - 100, coord[0] - 100, coord[1] + 100, coord[0] + 100]
+    if coh_file is None:
+        box = [coord[1] - 100, coord[0] - 100, coord[1] + 100, coord[0] + 100]
+    else:
+        box = [coord[1] - reference_col[0], coord[0] - reference_row[0],
+               coord[1] + reference_col[0] + 1, coord[0] + reference_row[0] + 1]
     row1 = box[1]
     row2 = box[3]
     col1 = box[0]
@@ -249,8 +289,14 @@ def process_pixel(coord, stackfile, range_window=19, azimuth_window=9, phase_lin
     amp_refined = np.zeros(n_image, dtype=np.float32)
     total_num_mini_stacks = n_image // default_mini_stack_size
 
-    shp = get_shp_row_col_c(data, patch_slc_images, sample_rows, sample_cols,
-                            reference_row, reference_col, distance_threshold)
+    shp = None
+    if shp_cache_file is not None:
+        shp = read_shp_cache(shp_cache_file, coord, azimuth_window, range_window, n_image)
+    if shp is None:
+        shp = get_shp_row_col_c(data, patch_slc_images, sample_rows, sample_cols,
+                                reference_row, reference_col, distance_threshold)
+    else:
+        shp -= np.array([row1, col1], dtype=np.int32)
 
     num_shp = shp.shape[0]
     CCG = np.zeros((n_image, num_shp), dtype=np.complex64)
@@ -258,7 +304,10 @@ def process_pixel(coord, stackfile, range_window=19, azimuth_window=9, phase_lin
         for m in range(n_image):
             CCG[m, t] = patch_slc_images[m, shp[t, 0], shp[t, 1]]
 
-    coh_mat = iut.est_corr_py(CCG)
+    if coh_file is None:
+        coh_mat = iut.est_corr_py(CCG)
+    else:
+        coh_mat, scale = read_coherence_matrix(coh_file, coord)
     temp_quality = 0
 
     if num_shp < 20:
@@ -271,10 +320,15 @@ def process_pixel(coord, stackfile, range_window=19, azimuth_window=9, phase_lin
 
     else:
 
-        if len(phase_linking_method) > 10 and phase_linking_method[0:10] == b'sequential':
+        if coh_file is not None:
+            vec_refined, temp_quality = iut.phase_linking_coh_py(coh_mat, scale, phase_linking_method, 10,
+                                                                 default_mini_stack_size, max_compressed_slc)
+
+        elif len(phase_linking_method) > 10 and phase_linking_method[0:10] == b'sequential':
             vec_refined, squeezed_images, temp_quality = iut.sequential_phase_linking_py(CCG, phase_linking_method,
                                                                                          default_mini_stack_size,
-                                                                                         total_num_mini_stacks)
+                                                                                         total_num_mini_stacks,
+                                                                                         max_compressed_slc)
 
             vec_refined = iut.datum_connect_py(squeezed_images, vec_refined, default_mini_stack_size)
 
@@ -39,6 +39,54 @@ datasetUnitDict['slc'] = 'i'
 ########################################################################################
 
 
+def slc_chunk_shape(num_slc, length, width, range_window=19, azimuth_window=9, patch_size=200,
+                    min_chunk_mb=1., max_chunk_mb=8.):
+    '''Chunk shape of the slc dataset: all the images of a square tile of pixels, so that a patch of the
+    inversion is read from whole chunks. The tile is the smallest divisor of patch_size that covers the half
+    window halo of the patches and is at least min_chunk_mb, or the largest one below max_chunk_mb.
+
+    Parameters: num_slc : int, number of images
+                length, width : int, size of the images
+                range_window, azimuth_window : int, window of the SHP test of the inversion
+                patch_size : int, patch size of the inversion
+    Returns:    chunks : tuple of 3 int, (num_slc, rows, cols)
+    '''
+    halo = (max(range_window, azimuth_window) - 1) // 2
+    chunk_bytes = lambda tile: 8. * num_slc * tile * tile
+    tiles = [t for t in range(max(1, halo), patch_size + 1)
+             if patch_size % t == 0 and chunk_bytes(t) <= max_chunk_mb * 1024 ** 2]
+    if len(tiles) == 0:
+        tiles = [max(1, int(np.sqrt(max_chunk_mb * 1024 ** 2 / chunk_bytes(1))))]
+    tile = next((t for t in tiles if chunk_bytes(t) >= min_chunk_mb * 1024 ** 2), tiles[-1])
+    return (num_slc, min(tile, length), min(tile, width))
+
+
+def tune_patch_size(patch_size, chunks, num_slc, length, width, range_window=19, azimuth_window=9,
+                    num_worker=1, memory_budget=0):
+    '''Patch size of the inversion within the core and memory budget and aligned to the chunks of the slc
+    dataset: no larger than needed to give each worker a patch, no larger than the share of memory_budget of a
+    worker for the SLCs of a patch with its halo, its sorted amplitudes and its inverted phases, then rounded
+    down to whole chunk tiles.
+
+    Parameters: patch_size : int, requested patch size
+                chunks : tuple of int or None, chunk shape of the slc dataset, None if contiguous
+                num_worker : int, number of parallel patches
+                memory_budget : float, memory (GB) of all the workers, 0 for no limit
+    Returns:    patch_size : int
+    '''
+    window = max(range_window, azimuth_window)
+    if num_worker > 1:
+        patch_size = min(patch_size, int(np.sqrt(length * width / num_worker)))
+    if memory_budget > 0:
+        pixel_bytes = 20. * num_slc
+        patch_size = min(patch_size, int(np.sqrt(memory_budget * 1024 ** 3 / num_worker / pixel_bytes)) - window + 1)
+    tile = 1 if chunks is None else int(np.lcm(chunks[1], chunks[2]))
+    if tile <= patch_size:
+        patch_size = patch_size // tile * tile
+    return max(patch_size, window)
+
+
+
 class slcStackDict:
     '''
     slcStack object for a set of coregistered SLCs from the same platform and track.
@@ -98,7 +146,8 @@ class slcStackDict:
         return dsDataType
 
     def write2hdf5(self, outputFile='slcStack.h5', access_mode='a', box=None, xstep=1,
-                            ystep=1, compression=None, extra_metadata=None):
+                            ystep=1, compression=None, extra_metadata=None, range_window=19, azimuth_window=9,
+                            patch_size=200):
         '''Save/write an slcStackDict object into an HDF5 file with the structure below:
 
         /                  Root level
@@ -110,6 +159,8 @@ class slcStackDict:
                     access_mode : str, access mode of output File, e.g. w, r+
                     box : tuple, subset range in (x0, y0, x1, y1)
                     extra_metadata : dict, extra metadata to be added into output file
+                    range_window, azimuth_window, patch_size : int, inversion setting for the chunks of slc,
+                    see slc_chunk_shape
         Returns:    outputFile
         '''
         self.outputFile = outputFile
@@ -133,16 +184,18 @@ class slcStackDict:
             dsShape = (self.numSlc, self.length, self.width)
             dsDataType = dataType
             dsCompression = compression
+            dsChunks = slc_chunk_shape(self.numSlc, self.length, self.width, range_window, azimuth_window, patch_size)
             if dsName in ['connectComponent']:
                 dsDataType = np.int16
                 dsCompression = 'lzf'
 
             print(('create dataset /{d:<{w}} of {t:<25} in size of {s}'
-                   ' with compression = {c}').format(d=dsName,
-                                                     w=maxDigit,
-                                                     t=str(dsDataType),
-                                                     s=dsShape,
-                                                     c=dsCompression))
+                   ' with compression = {c}, chunks = {k}').format(d=dsName,
+                                                                  w=maxDigit,
+                                                                  t=str(dsDataType),
+                                                                  s=dsShape,
+                                                                  c=dsCompression,
+                                                                  k=dsChunks))
 
             if dsName in f.keys():
                 ds = f[dsName]
@@ -151,24 +204,33 @@ class slcStackDict:
                                       shape=dsShape,
                                       maxshape=(None, dsShape[1], dsShape[2]),
                                       dtype=dsDataType,
-                                      chunks=True,
+                                      chunks=dsChunks,
                                       compression=dsCompression)
 
-                prog_bar = ptime.progressBar(maxValue=self.numSlc)
-
+                if not box:
+                    box = (0, 0, self.width, self.length)
+                dsSlcs = []
                 for i in range(self.numSlc):
                     slcObj = self.pairsDict[self.dates[i]]
-                    # fname, metadata = slcObj.read(dsName, box=box)
                     fname, metadata = slcObj.read(dsName)
-
-                    if not box:
-                        box = (0, 0, self.width, self.length)
-                    dsSlc = gdal.Open(fname + '.vrt', gdal.GA_ReadOnly)
-                    ds[i, :, :] = dsSlc.GetRasterBand(1).ReadAsArray(int(box[0]), int(box[1]), int(self.width), int(self.length))
-
+                    dsSlcs.append(gdal.Open(fname + '.vrt', gdal.GA_ReadOnly))
                     self.bperp[i] = slcObj.get_perp_baseline()
-                    prog_bar.update(i+1, suffix='{}'.format(self.dates[i][0]))
 
+                # blocks of whole chunks with all the images (up to 512 MB), each chunk is written once
+                num_cols = max(1, int(512 * 1024 ** 2 / (8. * self.numSlc * dsChunks[1] * dsChunks[2]))) * dsChunks[2]
+                prog_bar = ptime.progressBar(maxValue=self.length)
+                block = np.zeros((self.numSlc, dsChunks[1], min(num_cols, self.width)), dtype=dsDataType)
+                for row in range(0, self.length, dsChunks[1]):
+                    num_rows = min(dsChunks[1], self.length - row)
+                    for col in range(0, self.width, num_cols):
+                        ncol = min(num_cols, self.width - col)
+                        for i in range(self.numSlc):
+                            block[i, :num_rows, :ncol] = dsSlcs[i].GetRasterBand(1).ReadAsArray(
+                                int(box[0]) + col, int(box[1]) + row, ncol, num_rows)
+                        ds[:, row:row + num_rows, col:col + ncol] = block[:, :num_rows, :ncol]
+                    prog_bar.update(row + num_rows, suffix='{} lines'.format(row + num_rows))
+
+                dsSlcs = None
                 prog_bar.close()
             ds.attrs['MODIFICATION_TIME'] = str(time.time())
 
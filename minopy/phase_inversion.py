@@ -18,13 +18,162 @@ from minopy.objects.arg_parser import MinoPyParser
 from minopy.lib import utils as iut
 from minopy.lib import invert as iv
 import multiprocessing as mp
+from queue import SimpleQueue
+from multiprocessing import resource_tracker
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import signal
 
 #################################
 
-def init_worker():
+# queue of the single writer of the streaming inversion, inherited by the workers
+output_queue = None
+
+
+def init_worker(queue=None):
+    global output_queue
     signal.signal(signal.SIGINT, signal.SIG_IGN)
+    output_queue = queue
+
+
+def run_task(task, func):
+    """ Inverts a patch or a sub patch, returns its task index, worker and run time for the utilisation summary """
+    start_time = time.time()
+    func(task[1], out_dir=task[2], output_queue=output_queue)
+    return task[0], os.getpid(), start_time, time.time()
+
+
+def schedule_tasks(inversionObj, box_list, costs, num_cores, split_patches):
+    """
+    Tasks of the patches, longest first from their estimated cost so that the last tasks are the short ones.
+    With split_patches, the patches costing more than half the average load of a worker are split into sub patches
+    Returns the tasks (index, box, out_dir, cost, index of the split patch or -1) and the sub patches (box, sub boxes)
+    of each split patch
+    """
+    tasks, sub_patches = [], {}
+    if len(box_list) == 0:
+        return tasks, sub_patches
+
+    target_cost = costs.sum() / (2 * num_cores)
+    out_dir = inversionObj.patch_out_dir
+    split_patches = split_patches and num_cores > 1 and target_cost > 0
+
+    for box, cost in zip(box_list, costs):
+        num_sub = min(int(np.ceil(cost / target_cost)), box[3] - box[1]) if split_patches else 1
+        if num_sub > 1:
+            sub_boxes = inversionObj.split_patch(box, num_sub)
+            sub_patches[box[4]] = (box, sub_boxes)
+            sub_dir = out_dir + '/PATCHES/PATCH_{:04.0f}'.format(box[4]).encode('UTF-8')
+            for sub_box in sub_boxes:
+                tasks.append((len(tasks), sub_box, sub_dir, cost * (sub_box[3] - sub_box[1]) / (box[3] - box[1]),
+                              box[4]))
+        else:
+            tasks.append((len(tasks), box, out_dir, cost, -1))
+
+    tasks.sort(key=lambda task: -task[3])
+    print('Estimated cost of the patches: max/mean {:.1f}, {} patches split into {} sub patches'.format(
+        costs.max() / max(costs.mean(), 1e-12), len(sub_patches),
+        sum([len(sub_boxes) for box, sub_boxes in sub_patches.values()])))
+    return tasks, sub_patches
+
+
+def print_utilisation(results, start_time, end_time):
+    """ Busy time and utilisation of each worker from the (index, worker, start, end) of its tasks """
+    wall_time = max(end_time - start_time, 1e-6)
+    print('Worker utilisation of {:.1f} s:'.format(wall_time))
+    for pid in sorted(set([result[1] for result in results])):
+        busy = [result[3] - result[2] for result in results if result[1] == pid]
+        print('    worker {}: {} tasks, busy {:.1f} s, {:.0f}%'.format(pid, len(busy), sum(busy),
+                                                                       100 * sum(busy) / wall_time))
+    return
+
+
+def box_union_area(boxes):
+    """ Number of pixels covered by a list of boxes (x0, y0, x1, y1) """
+    cols = np.unique([box[i] for box in boxes for i in (0, 2)])
+    rows = np.unique([box[i] for box in boxes for i in (1, 3)])
+    covered = np.zeros((rows.shape[0] - 1, cols.shape[0] - 1), dtype=np.bool_)
+    for box in boxes:
+        covered[np.searchsorted(rows, box[1]):np.searchsorted(rows, box[3]),
+                np.searchsorted(cols, box[0]):np.searchsorted(cols, box[2])] = True
+    return int(np.sum(np.outer(np.diff(rows), np.diff(cols))[covered]))
+
+
+def print_read_volume(inversionObj, tasks, strips, n_image):
+    """ Bytes of SLCs read for the tasks, by patch or by strip, against the bytes they need """
+    halo_boxes = [inversionObj.halo_box(task[1]) for task in tasks]
+    if strips[0][0] is None:
+        num_read = sum([(box[2] - box[0]) * (box[3] - box[1]) for box in halo_boxes])
+    else:
+        num_read = sum([(box[2] - box[0]) * (box[3] - box[1]) for box, patches in strips])
+    num_needed = box_union_area(halo_boxes)
+    print('SLC data read: {:.3f} GB, needed by the patches with their half window halo: {:.3f} GB, '
+          'read/needed: {:.2f}'.format(8. * n_image * num_read / 1024 ** 3, 8. * n_image * num_needed / 1024 ** 3,
+                                       num_read / max(num_needed, 1)))
+    return
+
+
+def dispatch_tasks(pool, inversionObj, func, tasks, strips, slc_stack_obj):
+    """
+    Submits the tasks strip by strip to the pool, one at a time so that idle workers take the next longest task.
+    The next strip is read while the current one is inverted and its tasks are queued as soon as it is read, so the
+    workers go on to it while the last tasks of the current strip finish. A strip is released once its last task
+    returns and the one after is read then, at most two strips are in memory. Without shared strips (strip box None)
+    the tasks read slc_stack_obj.
+    Yields the results of the tasks as they finish
+    """
+    events = SimpleQueue()
+    strip_of = {index: k for k, (strip_box, patches) in enumerate(strips) for index in patches}
+    strip_tasks = [[] for strip in strips]
+    for task in tasks:
+        strip_tasks[strip_of[task[4] if task[4] >= 0 else task[1][4]]].append(task)
+    remaining = [len(item) for item in strip_tasks]
+    loads = {}
+
+    def load(k):
+        return slc_stack_obj if strips[k][0] is None else inversionObj.load_strip(strips[k][0])
+
+    with ThreadPoolExecutor(max_workers=1) as reader:
+        def read(k):
+            loads[k] = reader.submit(load, k)
+            loads[k].add_done_callback(lambda future: events.put(('strip', k, future)))
+
+        def release(k):
+            stack = loads.pop(k).result()
+            if strips[k][0] is not None:
+                stack.release()
+
+        num_pending, next_strip = len(tasks), min(2, len(strips))
+        for k in range(next_strip):
+            read(k)
+        try:
+            while num_pending > 0:
+                kind, k, value = events.get()
+                if kind == 'strip':
+                    run = partial(run_task, func=partial(func, slcStackObj=value.result()))
+                    for task in strip_tasks[k]:
+                        pool.apply_async(run, (task,), callback=lambda result, k=k: events.put(('task', k, result)),
+                                         error_callback=lambda error, k=k: events.put(('error', k, error)))
+                elif kind == 'error':
+                    raise value
+                else:
+                    num_pending -= 1
+                    remaining[k] -= 1
+                    if remaining[k] == 0:
+                        release(k)
+                        if next_strip < len(strips):
+                            read(next_strip)
+                            next_strip += 1
+                    yield value
+        finally:
+            for k in list(loads.keys()):
+                if loads[k].exception() is None:
+                    release(k)
+                else:
+                    loads.pop(k)
+    return
+
 
 def main(iargs=None):
     '''
@@ -59,6 +208,12 @@ def main(iargs=None):
 
 def phase_invert(inps, inversionObj):
 
+    if inps.update and not inversionObj.sequential:
+        raise ValueError('Updating the inversion with new images needs a sequential phase linking method')
+
+    if inps.stream_output and not inps.sub_index is None:
+        raise ValueError('The streaming output is written by a single process, it is not supported with --index')
+
     if not inps.sub_index is None:
         inps.sub_index = int(inps.sub_index)
         indx1 = int(inps.sub_index * inps.num_worker)
@@ -71,14 +226,28 @@ def phase_invert(inps, inversionObj):
         indx2 = len(inversionObj.box_list)
         print('Total number of PATCHES/tasks: {}'.format(len(inversionObj.box_list)))
 
+    # estimated from the SHPs of the previous inversion, before the streaming output resets phase_series.h5
+    patch_costs = dict(zip([box[4] for box in inversionObj.box_list[indx1:indx2]],
+                           inversionObj.estimate_patch_cost(inversionObj.box_list[indx1:indx2])))
+
+    if inps.stream_output:
+        # patches are written to phase_series.h5 as they finish, the journal of the written ones is for resuming
+        inversionObj.initiate_stream()
+        written = inversionObj.stream_journal_entries()
+    elif os.path.exists(inversionObj.stream_journal.decode('UTF-8')):
+        os.remove(inversionObj.stream_journal.decode('UTF-8'))
+
     box_list = []
     for box in inversionObj.box_list[indx1:indx2]:
         index = box[4]
-        out_dir = inversionObj.out_dir.decode('UTF-8')
+        out_dir = inversionObj.patch_out_dir.decode('UTF-8')
         out_folder = out_dir + '/PATCHES/PATCH_{:04.0f}'.format(index)
         os.makedirs(out_folder, exist_ok=True)
 
-        if not os.path.exists(out_folder + '/flag.npy'):
+        if inps.stream_output:
+            if not 'PATCHES/PATCH_{:04.0f}'.format(index) in written:
+                box_list.append(box)
+        elif not os.path.exists(out_folder + '/flag.npy'):
             box_list.append(box)
 
     #print('Total number of PATCHES: {}'.format(len(inversionObj.box_list)))
@@ -95,7 +264,7 @@ def phase_invert(inps, inversionObj):
         num_cores = num_workers
 
     print('Number of parallel tasks: {}'.format(num_cores))
-    pool = mp.Pool(num_cores, init_worker)
+    print('Number of threads per task: {}'.format(inps.num_threads))
     data_kwargs = inversionObj.get_datakwargs()
     os.makedirs(data_kwargs['out_dir'].decode('UTF-8') + '/PATCHES', exist_ok=True)
 
@@ -118,26 +287,93 @@ def phase_invert(inps, inversionObj):
                    def_sample_cols=data_kwargs['def_sample_cols'],
                    out_dir=data_kwargs['out_dir'],
                    lag=data_kwargs['time_lag'],
-                   mask_file=data_kwargs['mask_file'])
+                   mask_file=data_kwargs['mask_file'],
+                   eig_solver=data_kwargs['eig_solver'],
+                   num_threads=data_kwargs['num_threads'],
+                   amp_cache_size=data_kwargs['amp_cache_size'],
+                   eig_tolerance=data_kwargs['eig_tolerance'],
+                   max_compressed_slc=data_kwargs['max_compressed_slc'],
+                   num_compressed=data_kwargs['num_compressed'],
+                   shp_cache_file=data_kwargs['shp_cache_file'],
+                   save_coherence=data_kwargs['save_coherence'],
+                   patch_file=data_kwargs['patch_file'])
+
+    tasks, sub_patches = schedule_tasks(inversionObj, box_list,
+                                        np.array([patch_costs[box[4]] for box in box_list], dtype=np.float64),
+                                        num_cores, inps.split_patches)
+    task_of = {task[0]: task for task in tasks}
+    remaining_subs = {index: len(sub_boxes) for index, (box, sub_boxes) in sub_patches.items()}
+    results = []
+    if len(tasks) == 0:
+        strips = []
+    elif inps.shared_strips:
+        # strips of the patch grid read once to shared memory for all their patches, the two strips in memory
+        # are bounded by the memory budget
+        strips = inversionObj.strip_boxes(box_list, inps.memory_budget * 1024 ** 3 / 2)
+    else:
+        strips = [(None, [box[4] for box in box_list])]
+    if len(tasks) > 0:
+        print_read_volume(inversionObj, tasks, strips, data_kwargs['n_image'])
+
+    if inps.shared_strips:
+        # the workers attaching to the shared memory strips share the resource tracker of this process
+        resource_tracker.ensure_running()
+    writer = None
+    if inps.stream_output:
+        sub_patch_of = {}
+        for index, (box, sub_boxes) in sub_patches.items():
+            for sub_box in sub_boxes:
+                sub_patch_of['PATCHES/PATCH_{:04.0f}/PATCHES/PATCH_{:04.0f}'.format(index, sub_box[4])] = (
+                    'PATCHES/PATCH_{:04.0f}'.format(index), len(sub_boxes))
+        queue = mp.Queue()
+        writer = mp.Process(target=iv.write_stream, args=(queue,) + inversionObj.stream_writer_args(sub_patch_of))
+        writer.start()
+        pool = mp.Pool(num_cores, init_worker, (queue,))
+    else:
+        pool = mp.Pool(num_cores, init_worker)
 
     print('Reading SLC data from {} and inverting patches in parallel ...'.format(inps.slc_stack))
 
+    dispatch = dispatch_tasks(pool, inversionObj, func, tasks, strips, data_kwargs['slcStackObj'])
     try:
-        pool.map(func, box_list)
+        start_time = time.time()
+        for result in dispatch:
+            results.append(result)
+            parent = task_of[result[0]][4]
+            if parent >= 0:
+                remaining_subs[parent] -= 1
+                if remaining_subs[parent] == 0:
+                    inversionObj.merge_sub_patches(*sub_patches[parent])
         pool.close()
         pool.join()
+        print_utilisation(results, start_time, time.time())
     except KeyboardInterrupt:
         print("\nCaught KeyboardInterrupt, terminating workers")
         pool.terminate()
         pool.join()
+    finally:
+        dispatch.close()
+        if writer is not None:
+            queue.put(None)
+            writer.join()
+
+    if writer is not None:
+        if writer.exitcode != 0:
+            raise RuntimeError('The writer of phase_series.h5 failed, rerun to resume from its journal')
+        if inversionObj.stream_complete():
+            inversionObj.finish_stream()
+            print('All patches written to phase_series.h5, concatenation is not needed')
 
     return
 
 def concatenate_patches(inversionObj):
+    if inversionObj.stream_complete():
+        print('phase_series.h5 is already written by the streaming inversion, nothing to concatenate')
+        return
     completed = True
     for box in inversionObj.box_list:
         index = box[4]
-        out_dir = inversionObj.out_dir.decode('UTF-8')
+        out_dir = inversionObj.patch_out_dir.decode('UTF-8')
         out_folder = out_dir + '/PATCHES/PATCH_{:04.0f}'.format(index)
         while not os.path.exists(out_folder + '/flag.npy'):
             completed = False
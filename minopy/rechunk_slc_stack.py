@@ -0,0 +1,89 @@
+#! /usr/bin/env python3
+############################################################
+# Copyright(c) 2017, Sara Mirzaee                          #
+############################################################
+import os
+import argparse
+import numpy as np
+import h5py
+from mintpy.utils import ptime
+from minopy.objects.slcStack import slc_chunk_shape
+
+
+def cmd_line_parse(iargs=None):
+    parser = argparse.ArgumentParser(description='Rewrite the slc dataset of an slcStack.h5 file with chunks of all '
+                                                 'the images of a tile aligned to the patches of the inversion')
+    parser.add_argument('slc_stack', type=str, help='SLC stack file')
+    parser.add_argument('-o', '--output', dest='out_file', type=str, default=None,
+                        help='Output file, default: replace the input file')
+    parser.add_argument('-r', '--range_window', dest='range_window', type=int, default=19,
+                        help='Range window size of the inversion (default: 19)')
+    parser.add_argument('-a', '--azimuth_window', dest='azimuth_window', type=int, default=9,
+                        help='Azimuth window size of the inversion (default: 9)')
+    parser.add_argument('-p', '--patch_size', dest='patch_size', type=int, default=200,
+                        help='Patch size of the inversion (default: 200)')
+    parser.add_argument('-c', '--chunks', dest='chunks', type=int, nargs=2, default=None, metavar=('ROWS', 'COLS'),
+                        help='Tile of the chunks instead of the one derived from the windows and patch size')
+    parser.add_argument('--compression', dest='compression', choices={'gzip', 'lzf', None}, default=None,
+                        help='Compression of the rewritten slc dataset, default: None')
+    parser.add_argument('-m', '--memory', dest='memory', type=float, default=512,
+                        help='Size (MB) of the blocks copied at a time (default: 512)')
+    inps = parser.parse_args(args=iargs)
+    return inps
+
+
+def main(iargs=None):
+    inps = cmd_line_parse(iargs)
+
+    out_file = inps.out_file if inps.out_file else inps.slc_stack + '.rechunk'
+
+    with h5py.File(inps.slc_stack, 'r', rdcc_nbytes=int(inps.memory * 1024 ** 2)) as fi, \
+            h5py.File(out_file, 'w') as fo:
+        num_slc, length, width = fi['slc'].shape
+        old_chunks = fi['slc'].chunks
+        if inps.chunks:
+            chunks = (num_slc, min(inps.chunks[0], length), min(inps.chunks[1], width))
+        else:
+            chunks = slc_chunk_shape(num_slc, length, width, inps.range_window, inps.azimuth_window,
+                                     inps.patch_size)
+        print('rechunk /slc of {} in size of {} from chunks {} to {}'.format(inps.slc_stack, fi['slc'].shape,
+                                                                             old_chunks, chunks))
+
+        for key, value in fi.attrs.items():
+            fo.attrs[key] = value
+        for name in fi.keys():
+            if name != 'slc':
+                fi.copy(name, fo)
+
+        ds = fo.create_dataset('slc',
+                               shape=(num_slc, length, width),
+                               maxshape=(None, length, width),
+                               dtype=fi['slc'].dtype,
+                               chunks=chunks,
+                               compression=inps.compression)
+        for key, value in fi['slc'].attrs.items():
+            ds.attrs[key] = value
+
+        # blocks of whole new chunks covering whole rows of the old chunks, each new chunk is written once
+        old_rows = old_chunks[1] if old_chunks else 1
+        num_rows = int(np.ceil(old_rows / chunks[1])) * chunks[1]
+        col_step = int(np.lcm(chunks[2], old_chunks[2])) if old_chunks else chunks[2]
+        num_cols = max(1, int(inps.memory * 1024 ** 2 / (8. * num_slc * num_rows * col_step))) * col_step
+        prog_bar = ptime.progressBar(maxValue=length)
+        for row in range(0, length, num_rows):
+            row_end = min(row + num_rows, length)
+            for col in range(0, width, num_cols):
+                col_end = min(col + num_cols, width)
+                ds[:, row:row_end, col:col_end] = fi['slc'][:, row:row_end, col:col_end]
+            prog_bar.update(row_end, suffix='{} lines'.format(row_end))
+        prog_bar.close()
+
+    if not inps.out_file:
+        os.replace(out_file, inps.slc_stack)
+        out_file = inps.slc_stack
+    print('finished writing to {}'.format(out_file))
+    return
+
+
+if __name__ == '__main__':
+    main()
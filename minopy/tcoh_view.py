@@ -8,7 +8,8 @@ import os
 import sys
 import numpy as np
 from matplotlib import pyplot as plt
-from minopy.objects.invert_pixel import ks_lut_cy, get_shp_row_col_c, custom_cmap, gam_pta
+from minopy.objects.invert_pixel import ks_lut_cy, get_shp_row_col_c, custom_cmap, gam_pta, read_coherence_matrix, \
+    read_shp_cache
 from mintpy.utils import arg_group, ptime, time_func, readfile, plot as pp
 from minopy.objects.slcStack import slcStack
 import minopy.lib.utils as iut
@@ -39,6 +40,15 @@ def tcoh_create_parser():
                         , help='SHP searching window size in range direction. -- Default : 19')
     parser.add_argument('-aw', '--azimuthWindow', dest='azimuth_win', type=str, default='9'
                         , help='SHP searching window size in azimuth direction. -- Default : 9')
+    parser.add_argument('--coh', dest='coh_file', type=str, default=None,
+                        help='coherence matrices of the pixels saved by phase_inversion.py --coherence_matrix\n'
+                             'i.e.: inverted/coherence_matrix.h5, read instead of estimated from the slc stack\n')
+    parser.add_argument('--shp', dest='shp_cache_file', type=str, default=None,
+                        help='SHPs of the pixels saved by phase_inversion.py\n'
+                             'i.e.: inverted/shp_cache.h5, read instead of tested from the slc stack\n')
+    parser.add_argument('--max_compressed_slc', dest='max_compressed_slc', type=int, default=0,
+                        help='--max_compressed_slc of phase_inversion.py, compressed SLCs carried to each mini stack. '
+                             '-- Default : 0 for all')
 
     return parser
 
@@ -151,6 +161,9 @@ class CoherenceViewer(tsview.timeseriesViewer):
         self.slcStack = inps.slc_file[0]
         self.range_window = int(inps.range_win)
         self.azimuth_window = int(inps.azimuth_win)
+        self.coh_file = inps.coh_file
+        self.shp_cache_file = inps.shp_cache_file
+        self.max_compressed_slc = inps.max_compressed_slc
 
         self.StackObj = slcStack(self.slcStack)
         self.n_image, self.length, self.width = self.StackObj.get_size()
@@ -239,7 +252,11 @@ class CoherenceViewer(tsview.timeseriesViewer):
         reference_col = np.array([(self.range_window - 1) // 2], dtype=np.int32)
 
         distance_threshold = ks_lut_cy(self.n_image, self.n_image, 0.01)
-        box = [yx[1] - 50, yx[0] - 50, yx[1] + 50, yx[0] + 50]
+        if self.coh_file is None:
+            box = [yx[1] - 50, yx[0] - 50, yx[1] + 50, yx[0] + 50]
+        else:
+            box = [yx[1] - reference_col[0], yx[0] - reference_row[0],
+                   yx[1] + reference_col[0] + 1, yx[0] + reference_row[0] + 1]
         row1 = box[1]
         row2 = box[3]
         col1 = box[0]
@@ -252,27 +269,37 @@ class CoherenceViewer(tsview.timeseriesViewer):
         default_mini_stack_size = 10
         total_num_mini_stacks = self.n_image // default_mini_stack_size
 
-        shp = get_shp_row_col_c(data, patch_slc_images, sample_rows, sample_cols,
-                                reference_row, reference_col, distance_threshold)
-
-        num_shp = shp.shape[0]
-        CCG = np.zeros((self.n_image, num_shp), dtype=np.complex64)
-        for t in range(num_shp):
-            CCG[:, t] = patch_slc_images[:, shp[t, 0], shp[t, 1]]
-
-        coh_mat = iut.est_corr_py(CCG)
-
-        vec_refined, squeezed_images, temp_quality = iut.sequential_phase_linking_py(CCG, b'sequential_EMI',
-                                                                                 default_mini_stack_size,
-                                                                                 total_num_mini_stacks)
-        vec_refined = iut.datum_connect_py(squeezed_images, vec_refined, default_mini_stack_size)
-
-        amp_refined = np.mean(np.abs(CCG), axis=1)
-
-        vec_refined = amp_refined * np.exp(1j * np.angle(vec_refined))
-        vec_refined[0] = amp_refined[0] + 0j
-
-        temp_quality_full = gam_pta(np.angle(coh_mat), vec_refined)
+        shp = None
+        if self.shp_cache_file is not None:
+            shp = read_shp_cache(self.shp_cache_file, yx, self.azimuth_window, self.range_window, self.n_image)
+        if shp is None:
+            shp = get_shp_row_col_c(data, patch_slc_images, sample_rows, sample_cols,
+                                    reference_row, reference_col, distance_threshold)
+        else:
+            shp -= np.array([row1, col1], dtype=np.int32)
+
+        if self.coh_file is not None:
+            coh_mat = read_coherence_matrix(self.coh_file, yx)[0]
+        else:
+            num_shp = shp.shape[0]
+            CCG = np.zeros((self.n_image, num_shp), dtype=np.complex64)
+            for t in range(num_shp):
+                CCG[:, t] = patch_slc_images[:, shp[t, 0], shp[t, 1]]
+
+            coh_mat = iut.est_corr_py(CCG)
+
+            vec_refined, squeezed_images, temp_quality = iut.sequential_phase_linking_py(CCG, b'sequential_EMI',
+                                                                                     default_mini_stack_size,
+                                                                                     total_num_mini_stacks,
+                                                                                     self.max_compressed_slc)
+            vec_refined = iut.datum_connect_py(squeezed_images, vec_refined, default_mini_stack_size)
+
+            amp_refined = np.mean(np.abs(CCG), axis=1)
+
+            vec_refined = amp_refined * np.exp(1j * np.angle(vec_refined))
+            vec_refined[0] = amp_refined[0] + 0j
+
+            temp_quality_full = gam_pta(np.angle(coh_mat), vec_refined)
 
         sample_rows = data[0] + sample_rows
         sample_rows[sample_rows < 0] = -1